@@ -0,0 +1,89 @@
+"""
+認証ユーザーIDの許可リスト（stale-while-revalidate）。
+
+取得関数（スプレッドシートなど）の呼び出しはバックグラウンドスレッドで行い、
+更新中や取得失敗中は手元の古いリストをそのまま使います。
+取得に成功するたびにローカルのスナップショットへ保存するので、
+再起動直後やスプレッドシート障害時もスナップショットから認証できます。
+"""
+import json
+import os
+import threading
+import time
+
+
+class UserAllowlist:
+    """ユーザーIDを frozenset で保持し、`user_id in allowlist` を O(1) で判定します。"""
+
+    def __init__(self, fetch, snapshot_path, ttl=300):
+        self._fetch = fetch
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._user_ids = frozenset()
+        self._refresh_thread = None
+        self.loaded_at = 0.0
+        self.last_error = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f: user_ids = json.load(f)
+            self._user_ids = frozenset(user_ids)
+            self.loaded_at = os.path.getmtime(self.snapshot_path)
+            self._done.set()
+        except (OSError, ValueError):
+            pass
+
+    def _save_snapshot(self, user_ids):
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(sorted(user_ids), f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)  # 書き込み途中のファイルを読ませない
+
+    @property
+    def is_stale(self):
+        return time.time() - self.loaded_at >= self.ttl
+
+    @property
+    def is_refreshing(self):
+        thread = self._refresh_thread
+        return thread is not None and thread.is_alive()
+
+    def user_ids(self):
+        """現在のリストを返します。期限切れなら裏で更新を始めますが、完了は待ちません。"""
+        if self.is_stale: self.refresh_async()
+        return self._user_ids
+
+    def __contains__(self, user_id):
+        return user_id in self.user_ids()
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def refresh_async(self):
+        """更新スレッドを起動します。すでに更新中なら何もせず False を返します。"""
+        with self._lock:
+            if self.is_refreshing: return False
+            self._refresh_thread = threading.Thread(target=self._refresh, name="allowlist-refresh", daemon=True)
+            self._refresh_thread.start()
+        return True
+
+    def _refresh(self):
+        try:
+            user_ids = frozenset(self._fetch())
+            self._user_ids, self.loaded_at, self.last_error = user_ids, time.time(), None
+            try: self._save_snapshot(user_ids)
+            except OSError: pass
+        except Exception as e:
+            # 失敗時は古いリストを使い続け、TTL の間は再取得しない
+            self.last_error, self.loaded_at = e, time.time()
+        finally:
+            self._done.set()
+
+    def wait_until_loaded(self, timeout):
+        """一度もリストを持っていない（スナップショットも無い）ときだけ、初回取得を待ちます。"""
+        if not self._done.is_set():
+            if not self.is_refreshing: self.refresh_async()
+            self._done.wait(timeout)
+        return bool(self._user_ids)
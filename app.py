@@ -1,24 +1,44 @@
+import time
+# スクリプトの開始時刻（起動時間の計測の起点。import_profile.report_startup_once に渡す）。
+# 下の import にかかる時間も含めるので、ほかの import より先に記録する
+SCRIPT_STARTED = time.perf_counter()
+
 import streamlit as st
 from streamlit_cookies_manager import EncryptedCookieManager
-import time
-import re
-from collections import Counter
-import io
-import traceback
+STREAMLIT_IMPORTED = time.perf_counter()
 import os
-import json
+import functools
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-# AIとデータ分析関連のライブラリ
-import google.generativeai as genai
-import matplotlib.pyplot as plt
-import japanize_matplotlib
-from wordcloud import WordCloud
-from fpdf import FPDF
-
-# ★★★ 追加：Googleスプレッドシート連携ライブラリ ★★★
-import gspread
-from google.oauth2.service_account import Credentials
+# ★★★ 変更：AI・グラフ・PDF・スプレッドシート関連の重いライブラリは使う時に読み込む ★★★
+# （google.generativeai / matplotlib / fpdf / gspread は timed_import 経由。import 時間は記録される）
+from import_profile import timed_import, record_import_time, report_startup_once
+
+# トーク履歴の解析（Streamlit非依存のモジュール）
+from line_chat import MessageStore, sniff_encoding
+from history_store import HistoryStore
+from allowlist import UserAllowlist
+from context_selector import CONTEXT_TOKEN_BUDGET, UPDATE_CONTEXT_TOKEN_BUDGET, TokenEstimator, select_context, select_update_context
+from response_cache import ResponseCache, make_cache_key
+from charts import SCREEN_DPI, PRINT_DPI, ChartCache, graph_colors, temperature_data_hash
+from diagnosis_jobs import JobManager, JobLimitError
+from llm_retry import MODEL_UNAVAILABLE_MARKERS, generate_with_fallback, is_retryable
+from report_parser import parse_report
+from prompt_builder import CHARACTER_MAP, build_prompt, character_name
+from report_generation import GENERATION_CONFIG, JSON_OUTPUT_INSTRUCTION, MODEL_CANDIDATES, SAFETY_SETTINGS, json_generation_config
+from llm_backend import create_backend, requires_api_key
+from stage_metrics import METRICS_FILE_NAME, PROMETHEUS_ENV_VAR, StageMetrics
+from talk_spool import MEMORY_BUDGET_ENV_VAR, SpooledTalk, TalkSpool, memory_budget_bytes, process_rss_bytes, talk_bytes
+
+# ★★★ 起動時間の確認：先頭の import 文の時間も記録し、下の st.stop() で止まる前にレポートを出す ★★★
+# （KOI_ORACLE_IMPORT_REPORT=1 でモジュール別の内訳をログ出力）
+record_import_time("streamlit + streamlit_cookies_manager (top-level)", SCRIPT_STARTED, STREAMLIT_IMPORTED)
+record_import_time("other app.py imports (top-level)", STREAMLIT_IMPORTED)
+report_startup_once(SCRIPT_STARTED)
 
 # ---------------------------------------------------------------------
 # --- ページの基本設定 ---
@@ -28,31 +48,47 @@ st.set_page_config(page_title="恋のオラクル AI恋星譚", page_icon="🌙"
 # --- 補助関数 (Googleスプレッドシート連携) ---
 # ---------------------------------------------------------------------
 # ★★★ 新設：Googleスプレッドシートから認証ユーザーを取得する関数 ★★★
-@st.cache_data(ttl=300)  # 5分間キャッシュ（頻繁に更新する場合は短くする）
-def load_valid_users_from_sheet():
-    """Googleスプレッドシートから有効なユーザーIDのリストを取得します。"""
-    try:
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets.readonly',
-            'https://www.googleapis.com/auth/drive.readonly'
-        ]
-        creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scope)
-        client = gspread.authorize(creds)
-        spreadsheet_id = st.secrets["spreadsheet"]["id"]
-        sheet = client.open_by_key(spreadsheet_id).sheet1
-        user_ids = sheet.col_values(1)[1:]  # A列の2行目以降を取得
-        valid_user_ids = [uid.strip() for uid in user_ids if uid.strip()]
-        return valid_user_ids
-    except Exception as e:
-        st.error(f"スプレッドシートからユーザー情報の取得に失敗しました。管理者に連絡してください。")
-        st.code(f"エラー詳細: {e}")
-        return []
+def load_valid_users_from_sheet(service_account_info, spreadsheet_id):
+    """Googleスプレッドシートから有効なユーザーIDの集合を取得します。失敗時は例外をそのまま投げます。"""
+    scope = [
+        'https://www.googleapis.com/auth/spreadsheets.readonly',
+        'https://www.googleapis.com/auth/drive.readonly'
+    ]
+    gspread = timed_import("gspread")
+    Credentials = timed_import("google.oauth2.service_account").Credentials
+    creds = Credentials.from_service_account_info(service_account_info, scopes=scope)
+    client = gspread.authorize(creds)
+    sheet = client.open_by_key(spreadsheet_id).sheet1
+    user_ids = sheet.col_values(1)[1:]  # A列の2行目以降を取得
+    return {uid.strip() for uid in user_ids if uid.strip()}
+
+# ★★★ 変更：許可リストは裏で更新し、更新中・障害中は手元のリストを使う ★★★
+USER_LIST_TTL = 300  # 5分ごとに裏で再取得（頻繁に更新する場合は短くする）
+USER_LIST_COLD_START_WAIT = 15  # スナップショットが無い初回だけ、取得を待つ最大秒数
+DATA_DIR = "data"
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# ★★★ 新設：処理段階ごとの所要時間を記録（data/metrics.jsonl、管理者メニューで p50/p95/p99 を表示） ★★★
+# 環境変数 KOI_ORACLE_PROMETHEUS_FILE にパスを指定すると、Prometheus のテキスト形式でも書き出す
+@st.cache_resource
+def get_stage_metrics():
+    return StageMetrics(os.path.join(DATA_DIR, METRICS_FILE_NAME), prometheus_path=os.environ.get(PROMETHEUS_ENV_VAR) or None)
+
+@st.cache_resource
+def get_user_allowlist():
+    service_account_info = dict(st.secrets["gcp_service_account"])
+    spreadsheet_id = st.secrets["spreadsheet"]["id"]
+    metrics = get_stage_metrics()  # 取得は裏のスレッドで動くので、ここで受け取っておく
+    def fetch():
+        with metrics.span("allowlist_fetch"): return load_valid_users_from_sheet(service_account_info, spreadsheet_id)
+    return UserAllowlist(fetch, os.path.join(DATA_DIR, "valid_users.snapshot"), ttl=USER_LIST_TTL)
 
 
 # --- 初期設定と準備 ---
 try:
     COOKIE_PASSWORD = st.secrets["auth"]["cookie_password"]
-    VALID_USER_IDS = load_valid_users_from_sheet()
+    VALID_USER_IDS = get_user_allowlist()
+    VALID_USER_IDS.user_ids()  # 期限切れならここで裏の更新を始めておく（待たない）
 except (KeyError, FileNotFoundError):
     st.error("認証設定ファイル（secrets.toml）が見つからないか、内容が正しくありません。")
     st.stop()
@@ -74,42 +110,73 @@ if "session_initialized" not in st.session_state:
     st.session_state.user_id = cookies.get("user_id", None)
     st.session_state.session_initialized = True
 
-DATA_DIR = "data"
-os.makedirs(DATA_DIR, exist_ok=True)
-
 
 # ---------------------------------------------------------------------
 # 補助関数 (ここから下は既存の関数、変更なし)
 # ---------------------------------------------------------------------
-def get_japanese_font():
-    font_path = "./fonts/ipaexg.ttf"
-    if os.path.exists(font_path): return font_path
-    try: return japanize_matplotlib.get_font_path()
-    except: return None
+# ★★★ 新設：モデル疎通テストの並列化と結果キャッシュ ★★★
+MODEL_AVAILABILITY_TTL = 600  # 疎通に成功した結果を再利用する秒数
+MODEL_UNAVAILABLE_TTL = 60  # 「キーが無効」「モデルが無い」と確定した失敗を再利用する秒数（一時的なエラーは再利用しない）
+DEFINITIVE_PROBE_ERRORS = MODEL_UNAVAILABLE_MARKERS + ("api key not valid", "api_key_invalid")
+
+@st.cache_resource
+def get_model_availability_cache():
+    """(APIキーのハッシュ, モデル名) → (成否, エラー文, 有効期限) を全セッションで共有します。"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+def probe_model(backend, api_key, model_name, prompt="こんにちは", cache=None):
+    """
+    モデルに短い生成を1回投げて使えるか確かめ、(成否, エラー文) を返します。
+    同じキー・モデルで成功していれば MODEL_AVAILABILITY_TTL の間、キーの誤りやモデルが無いことが
+    確定していれば MODEL_UNAVAILABLE_TTL の間は、APIを呼ばずにその結果を返します。
+    通信エラーや 429 などの一時的な失敗は覚えないので、すぐにもう一度試せます。
+    別スレッドから呼ぶときは cache を渡すこと。
+    """
+    cache = cache or get_model_availability_cache()
+    cache_key = (backend.name, hashlib.sha256(api_key.encode('utf-8')).hexdigest(), model_name)
+    with cache["lock"]:
+        entry = cache["entries"].get(cache_key)
+    if entry and time.time() < entry[2]:
+        return entry[0], entry[1]
+    ttl = None
+    try:
+        backend.generate(model_name, prompt, generation_config={"max_output_tokens": 10})
+        result, ttl = (True, None), MODEL_AVAILABILITY_TTL
+    except Exception as e:
+        result = (False, str(e))
+        if not is_retryable(e) and any(marker in str(e).lower() for marker in DEFINITIVE_PROBE_ERRORS): ttl = MODEL_UNAVAILABLE_TTL
+    with cache["lock"]:
+        if ttl: cache["entries"][cache_key] = (*result, time.time() + ttl)
+        else: cache["entries"].pop(cache_key, None)
+    return result
+
+BACKEND_CACHE_MAX_ENTRIES = 32
+
+@st.cache_resource(max_entries=BACKEND_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_backend(api_key):
+    """APIキーごとのバックエンド。接続は全セッション・全ジョブで使い回します（鑑定処理には req で渡す）。"""
+    return create_backend(api_key)
 
 def validate_and_test_api_key(api_key):
-    if not api_key or not api_key.startswith("AIza") or len(api_key) < 39:
+    # 形式の確認はバックエンドを作る前に行う（空のキーで接続を作ろうとすると例外になる）
+    if requires_api_key() and (not api_key or not api_key.startswith("AIza") or len(api_key) < 39):
         return False, "APIキーの形式が正しくないようです。（'AIza'で始まり、39文字以上である必要があります）"
-    # ★★★ 修正：正しいモデルリストに戻す ★★★
-    model_candidates = [
-        "models/gemini-2.5-flash",
-        "models/gemini-flash-latest",
-        "models/gemini-2.5-pro",
-        "models/gemini-pro-latest",
-        "models/gemini-2.0-flash-001"
-    ]
+    backend = get_backend(api_key)
+    # 候補を同時にテストし、優先順位の高い順に結果を見て最初に成功したモデルを採用
+    cache = get_model_availability_cache()
+    executor = ThreadPoolExecutor(max_workers=len(MODEL_CANDIDATES))
+    futures = [executor.submit(probe_model, backend, api_key, model_name, cache=cache) for model_name in MODEL_CANDIDATES]
     last_error = None
-    for model_name in model_candidates:
-        try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
-            model.generate_content("こんにちは", generation_config={"max_output_tokens": 10})
-            st.session_state.selected_model = model_name
-            cookies["selected_model"] = model_name
-            return True, f"APIキーは有効です！AI鑑定師との接続に成功しました！（モデル: {model_name}）"
-        except Exception as e:
-            last_error = e
-            continue
+    try:
+        for model_name, future in zip(MODEL_CANDIDATES, futures):
+            is_available, error = future.result()
+            if is_available:
+                st.session_state.selected_model = model_name
+                cookies["selected_model"] = model_name
+                return True, f"APIキーは有効です！AI鑑定師との接続に成功しました！（モデル: {model_name}）"
+            last_error = error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     error_message = str(last_error).lower()
     if "api key not valid" in error_message: return False, "APIキーが正しくありません。"
     elif "billing" in error_message: return False, "APIキーは正しいですが、Google Cloudの「請求先アカウント」が有効になっていません。"
@@ -121,320 +188,435 @@ def test_model_name(api_key, model_name):
     """指定されたモデル名が有効かテストする"""
     if not model_name or "models/" not in model_name:
         return False, "モデル名の形式が正しくないようです。（例: models/gemini-2.5-flash）"
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name)
-        model.generate_content("test", generation_config={"max_output_tokens": 10})
+    is_available, error = probe_model(get_backend(api_key), api_key, model_name, prompt="test")
+    if is_available:
         return True, f"モデル「{model_name}」は有効です！"
-    except Exception as e:
-        error_message = str(e).lower()
-        if "not found" in error_message or "invalid" in error_message:
-            return False, "モデル名が正しくないようです。コピペミスかも？もう一度入力してみてね。"
-        else:
-            return False, f"モデルのテスト中にエラーが発生しました。"
-
-
-def parse_line_chat(text_data):
-    lines = text_data.strip().split('\n')
-    messages, full_text, current_date = [], [], "日付不明"
-    lines = [line for line in lines if not (line.startswith('[') and line.endswith(']'))]
-    message_pattern = re.compile(r'^(\d{1,2}:\d{2})\t([^\t]+)\t(.*)')
-    for line in lines:
-        line = line.strip()
-        if not line: continue
-        date_match = re.match(r'^\d{4}/\d{2}/\d{2}\(.\)', line)
-        if date_match:
-            current_date = date_match.group(0)
-            continue
-        message_match = message_pattern.match(line)
-        if message_match:
-            try:
-                _, sender, message = message_match.groups()
-                sender, message = sender.strip(), message.strip()
-                if message not in ["[写真]", "[動画]", "[スタンプ]", "[ファイル]"]:
-                    messages.append({'timestamp': f"{current_date} {message_match.group(1)}", 'sender': sender, 'message': message})
-                    full_text.append(message)
-            except Exception: continue
-            continue
-        if messages:
-            messages[-1]['message'] += '\n' + line
-            full_text[-1] += ' ' + line
-    return messages, " ".join(full_text)
-
-def smart_extract_text(messages, max_chars=8000):
-    text_lines = [f"{msg['sender']}: {msg['message']}" for msg in messages]
-    full_text = "\n".join(text_lines)
-    if len(full_text) <= max_chars: return full_text
-    truncated_text = ""
-    for line in reversed(text_lines):
-        if len(truncated_text) + len(line) > max_chars: break
-        truncated_text = line + "\n" + truncated_text
-    return truncated_text
-
-
-
-# smart_extract_text 関数のすぐ下にでも貼り付けてください
-
-def create_long_term_summary(messages, max_chars=4000):
-    """
-    トーク履歴全体から、関係性の流れがわかるようにダイジェストを作成します。
-    「初期」「中期」「後期」の3つの期間から均等に会話を抽出します。
-    """
-    text_lines = [f"{msg['sender']}: {msg['message']}" for msg in messages]
-    if not text_lines:
-        return "会話データがありません。"
-
-    full_text = "\n".join(text_lines)
-    if len(full_text) <= max_chars:
-        return full_text # 全文が指定文字数以下なら、そのまま返す
+    error_message = error.lower()
+    if "not found" in error_message or "invalid" in error_message:
+        return False, "モデル名が正しくないようです。コピペミスかも？もう一度入力してみてね。"
+    else:
+        return False, f"モデルのテスト中にエラーが発生しました。"
 
-    summary = []
-    
-    # 期間を3つに分割
-    total_lines = len(text_lines)
-    part_size = total_lines // 3
-    
-    # 各期間から抽出する目標文字数
-    chars_per_part = max_chars // 3
-
-    # パート1: 初期
-    part1_lines = text_lines[:part_size]
-    part1_text = ""
-    for line in part1_lines:
-        if len(part1_text) + len(line) > chars_per_part: break
-        part1_text += line + "\n"
-    summary.append("--- 関係の初期 ---\n" + part1_text)
-
-    # パート2: 中期
-    part2_lines = text_lines[part_size : part_size * 2]
-    part2_text = ""
-    for line in part2_lines:
-        if len(part2_text) + len(line) > chars_per_part: break
-        part2_text += line + "\n"
-    summary.append("--- 関係の中期 ---\n" + part2_text)
-    
-    # パート3: 後期
-    part3_lines = text_lines[part_size * 2 :]
-    part3_text = ""
-    for line in part3_lines:
-        if len(part3_text) + len(line) > chars_per_part: break
-        part3_text += line + "\n"
-    summary.append("--- 関係の後期 ---\n" + part3_text)
 
-    return "\n\n".join(summary)
+# ★★★ 新設：解析結果キャッシュ（全セッション共通・LRUで上限管理） ★★★
+PARSE_CACHE_MAX_ENTRIES = 8
+PREVIEW_LINES = 15
 
+def compute_talk_hash(talk_data):
+    """トーク履歴（貼り付けた文字列、アップロードされたバイト列、または一時ファイル）の内容ハッシュを返します。"""
+    if isinstance(talk_data, str): talk_data = talk_data.encode('utf-8')
+    with talk_bytes(talk_data) as raw: return hashlib.sha256(raw).hexdigest()
 
-
-def calculate_temperature(messages):
-    daily_scores = Counter()
-    for msg in messages:
-        try:
-            timestamp, message_text = msg.get('timestamp', ''), msg.get('message', '')
-            date_str = timestamp.split(' ')[0]
-            date_str_clean = re.sub(r'\([^)]*\)', '', date_str)
-            date_obj = datetime.strptime(date_str_clean, '%Y/%m/%d')
-            score = len(message_text) + message_text.count('!') * 2 + message_text.count('？') * 2
-            daily_scores[date_obj.strftime('%m/%d')] += score
-        except: continue
-    if not daily_scores: return {}, "データ不足"
-    sorted_scores = sorted(daily_scores.items())
-    labels, values = [i[0] for i in sorted_scores], [i[1] for i in sorted_scores]
-    trend = "安定"
-    if len(values) >= 4:
-        last_avg = sum(values[-3:]) / 3
-        prev_avg = sum(values[:-3]) / len(values[:-3]) if len(values[:-3]) > 0 else 0
-        if prev_avg > 0 and last_avg > prev_avg * 1.2: trend = "上昇傾向"
-        elif prev_avg > 0 and last_avg < prev_avg * 0.8: trend = "下降傾向"
-    return {'labels': labels, 'values': values}, trend
-
-def build_prompt(character, tone, your_name, partner_name, counseling_text, messages_summary, long_term_summary, trend, previous_data=None):
-    # ★★★ ここからが重要 ★★★
-    # キャラクターの「役割」と「名前」をセットで定義します
-    character_map = {
-        "1. 優しく包み込む、お姉さん系": ("優しく包み込むお姉さんタイプの鑑定師", "碧月（みつき）"),
-        "2. ロジカルに鋭く分析する、専門家系": ("ロジカルに鋭く分析する専門家タイプの鑑定師", "詩音（しおん）"),
-        "3. 星の言葉で語る、ミステリアスな占い師系": ("星の言葉で語るミステリアスな占い師", "セレスティア")
+@st.cache_resource(max_entries=PARSE_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_parsed_chat(talk_hash, _talk_data, _snapshot_loader=None):
+    """
+    トーク履歴を一度だけ解析し、メッセージ・プレビュー・統計をまとめて返します。
+    キーは内容ハッシュのみ（本文はハッシュ計算対象外）。戻り値は共有されるので書き換えないこと。
+    バイト列は少しずつデコードしながら解析し、プレビューもその途中で先頭の行から取ります。
+    _snapshot_loader() が前回のスナップショットを返し、今回のファイルがその続きなら、続きの部分だけを解析します。
+    一時ファイルに書き出したアップロード（SpooledTalk）は mmap で読みます。
+    """
+    metrics = get_stage_metrics()
+    temperature = timed_import("temperature")
+    loaded, encoding = None, None
+    with talk_bytes(_talk_data) as raw:
+        if _snapshot_loader is not None and not isinstance(raw, str):
+            snapshot = _snapshot_loader()
+            if snapshot is not None:
+                with metrics.span("parse", incremental=True):
+                    loaded = timed_import("chat_snapshot").load_with_snapshot(raw, snapshot, PREVIEW_LINES)
+                encoding = snapshot.encoding
+        if loaded is not None: messages, scores = loaded
+        else:
+            with metrics.span("parse", incremental=False):
+                if isinstance(raw, str): messages = MessageStore.from_source(raw, preview_lines=PREVIEW_LINES)
+                else:
+                    messages, encoding = MessageStore.from_export(raw, PREVIEW_LINES)
+                    messages = messages or MessageStore()
+            scores = None
+    preview = messages.preview
+    with metrics.span("temperature"):
+        if scores is None: scores = temperature.message_scores(messages)
+        profile = temperature.compute_temperature_profile(messages, scores)
+    with metrics.span("analytics"): conversation_stats = timed_import("chat_analytics").compute_conversation_stats(messages)
+    temp_data = {'labels': profile['daily']['labels'], 'values': profile['daily']['values']} if profile else {}
+    return {
+        "messages": messages,
+        "preview": preview,
+        "encoding": encoding,
+        "scores": scores,
+        "stats": {
+            "message_count": len(messages),
+            "sender_counts": messages.sender_counts(),
+            "temp_data": temp_data,
+            "trend": profile['trend'] if profile else "データ不足",
+            "temperature_profile": profile,
+            "conversation": conversation_stats,
+        },
     }
-    # character_mapから役割と名前を取り出します
-    char_info, char_name = character_map.get(character, (character, "AI鑑定師"))
-    # ★★★ ここまでを追加・修正 ★★★
 
-    tone_instruction = {"癒し 100%": "とにかく優しく、温かく包み込むような言葉遣いで。否定的な表現は避け、常に希望を見出してください。", "癒し 50% × 論理 50%": "優しさと客観性のバランスを保ちながら、事実も伝えつつ励ましてください。", "冷静にロジカル": "感情に流されず、客観的なデータと論理的な分析を中心に伝えてください。"}
-    
-    # ↓↓↓ これで char_info と char_name が正しく使われます
-    prompt = f"""あなたは【{char_info}】の**{char_name}**です。導入部分で「こんにちは、鑑定師の{char_name}よ。」のように、必ず自分の名前をはっきりと名乗ってから会話を始めてください。ユーザーは【{tone}】のスタイルでの鑑定を望んでいます。{tone_instruction.get(tone, '')} このトーンと言葉遣いを、出力の最後まで徹底して維持してください。**重要: あなたは鑑定の最初から最後まで、キャラクターの口調・語尾・ニュアンスを完全に一定に保ち、文体が途中で絶対に変化しないよう、強く意識してください。**以下のデータを基に、単なる占いではない、心理分析に基づいた詳細な「恋の心理レポート」を作成してください。
-
-# ユーザー情報
-- ユーザー名: {your_name}
-- 相手の名前: {partner_name}
-- ユーザーの悩み: {counseling_text}
-"""
-    comparison_instruction = ""
-    if previous_data:
-        prev_score = previous_data.get('pulse_score', 0)
-        prompt += f"""
-# 過去の鑑定データ
-- 前回の鑑定日: {previous_data.get('date', '不明')}
-- **前回の脈あり度: {prev_score}%**
-- 前回の鑑定サマリー: {previous_data.get('summary', 'なし')}
-
-**【最重要】過去データに関する指示**:
-- あなたはユーザーの{your_name}さんを覚えています。導入文で「{your_name}さん、こんにちは。前回の鑑定から少し時間が経ちましたね」のように、再会を喜ぶ自然な語り口で始めてください。
-- **前回の脈あり度は「{prev_score}%」でした。この数値を絶対に創作せず、そのまま使用してください。**
-"""
-        comparison_instruction = f"""   **【前回との比較】**: 前回の鑑定では脈あり度が **{prev_score}%** でした。今回の結果と比較し、「前回の{prev_score}%から、今回は〇〇%へと変化しました」のように、数値を正確に使って必ず言及してください。"""
-    prompt += f"""
-# 基本データ分析
-- 会話の温度グラフの傾向: {trend}
-
-# ★★★ 変更点2: AIへの指示に「関係性の歴史」の項目を追加 ★★★
-- 【関係性の歴史（全期間のダイジェスト）】:
-{long_term_summary}
-
-- 【直近の詳細な会話（分析対象）】:
-{messages_summary}
-
-
-# AIによる深層分析依頼
-1. **感情の波の分析**: トーク履歴全体を通して、「ポジティブ」「ネガティブ」な感情表現は、それぞれどのような傾向で推移していますか？
-2. **脈ありシグナルのスコア化**: 以下の項目を0〜10点で評価し、総合的な「脈あり度」をパーセンテージで算出してください。 (質問返しの積極性, ポジティブな絵文字・表現の使用頻度, 返信間隔の安定性・速さ, 相手からの賞賛・共感の言葉, 会話を広げようとする意図)
-   **【絶対厳守】出力形式:** 以下の形式を絶対に守ってください。他の表現は一切使わず、数値は太字（**）にしないでください。
-   【総合脈あり度】: 80%
-   （上記の例のように、必ず「【総合脈あり度】: 数字%」の形式で出力してください）
-{comparison_instruction}
-   - なぜそのスコアになったのか、根拠を優しく解説してください。
-3. **相手の"隠れ心理"抽出**: 会話の中から、相手が特に「大切にしている価値観」や「本音だと感じられる発言」を3つ抜粋し、解説してください。
-4. **コミュニケーション相性診断**: 二人の言葉遣いや会話のテンポから、コミュニケーションのスタイルを分析し、「〇〇で繋がりを深めるタイプ」といった形で相性を診断してください。
-5. **「最高の瞬間」ハイライト**: このトーク履歴の中で、二人の心が最も通い合ったと感じられる瞬間を1つ選び出し、その時の会話の素晴らしい点を解説してください。
-6. **恋の未来予測**: これまでの会話データと心理分析に基づき、二人の関係性がポジティブに進展するための、心理学的な観点からの**優しい未来予測**を記述してください。
-7. **恋の処方箋・アクションチェックリスト**: 以下の4項目について、具体的かつ実践的なアドバイスを箇条書きで作成してください。(今日送ると効果的なメッセージ例:（★★1つにつき80文字以内で、最大3つ★★）, 相手のタイプ別・心に刺さるキーワード, 今は控えるべきNG行動, 次回鑑定のおすすめタイミング)
-
-# 最終出力
-上記の分析結果をすべて含め、以下の構成でレポートを作成してください。
-- 導入文, **恋の温度グラフの解説**, 総合脈あり度と、その理由, 恋の心理レポート, 「最高の瞬間」の振り返り, **恋の未来予測**, **恋の処方箋・アクションチェックリスト**, ユーザーへのケアメッセージ, 最後に、ユーザーを温かく励ます一言
-重要: 必ず日本語で、{your_name}さんに語りかけるような親しみやすい文体で書いてください。出力は最大8000文字以内に抑えてください。
-"""
-    return prompt
+# ★★★ 新設：温度グラフの描画キャッシュ（画面用と印刷用を別々に保持） ★★★
+CHART_CACHE_MAX_ENTRIES = 32
+
+@st.cache_resource
+def get_chart_cache():
+    """(温度データのハッシュ, 配色, dpi) ごとの描画済みPNG。バックグラウンドの鑑定処理とも共有します。"""
+    return ChartCache(CHART_CACHE_MAX_ENTRIES, metrics=get_stage_metrics())
+
+# ★★★ 新設：鑑定書PDFは鑑定文の表示を待たせず裏で作り、同じレポートなら作り直さない ★★★
+PDF_CACHE_MAX_ENTRIES = 16
+
+@st.cache_resource
+def get_pdf_cache():
+    """レポートごとの鑑定書PDF。作成はバックグラウンドのスレッドで行い、作成時に使うフォントも先に決めておきます。"""
+    return timed_import("pdf_report").PdfCache(PDF_CACHE_MAX_ENTRIES, metrics=get_stage_metrics())
+
+# ★★★ 新設：大きなトーク履歴はセッションに持たせず一時ファイルに書き出す（talk_spool を参照） ★★★
+@st.cache_resource
+def get_talk_spool():
+    """セッションごとのアップロードの一時ファイル。しばらく使われていないセッションの分は削除します。"""
+    return TalkSpool()
+
+def get_session_key():
+    """一時ファイルをセッションにひも付けるためのキー（セッションごとに1つ）。"""
+    if "spool_session_key" not in st.session_state: st.session_state.spool_session_key = uuid.uuid4().hex
+    return st.session_state.spool_session_key
+
+# ★★★ 変更：プロンプト用の会話はトークン予算で選ぶ（context_selector を参照） ★★★
+@st.cache_resource
+def get_token_ratio_cache():
+    """モデル名 → トークン見積もりの補正係数（count_tokens で一度だけ測る）を全セッションで共有します。"""
+    return {}
+
+def get_token_estimator(backend, model_name, messages, ratios=None):
+    """モデルごとに一度だけ count_tokens で補正した TokenEstimator を返します。失敗したら補正なし。"""
+    ratios = get_token_ratio_cache() if ratios is None else ratios
+    if model_name not in ratios:
+        sample = "\n".join(messages.iter_lines(max(0, len(messages) - 100)))
+        try: ratios[model_name] = TokenEstimator().calibrate(sample, lambda t: backend.count_tokens(model_name, t))
+        except Exception: return TokenEstimator()
+    return TokenEstimator(ratios[model_name])
+
+def record_generation_timing(model_name, first_token_seconds, total_seconds, streamed):
+    """鑑定1回ごとの応答時間をセッションに記録します（最新50件まで）。"""
+    timings = st.session_state.setdefault("generation_timings", [])
+    timings.append({"date": datetime.now().isoformat(), "model": model_name, "streamed": streamed,
+                    "first_token_seconds": first_token_seconds, "total_seconds": total_seconds})
+    del timings[:-50]
+
+# ★★★ 変更：履歴はSQLiteに追記（旧JSONファイルは初回に自動で取り込み） ★★★
+@st.cache_resource
+def get_history_store():
+    store = HistoryStore(DATA_DIR)
+    try: store.migrate_json_files()
+    except Exception: pass
+    return store
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(DATA_DIR)
+
+# ★★★ 新設：鑑定のときのトーク履歴の解析結果を残し、次回は続きの部分だけを解析・鑑定する ★★★
+@st.cache_resource
+def get_snapshot_store():
+    return timed_import("chat_snapshot").SnapshotStore(DATA_DIR)
+
+def load_chat_snapshot(user_id, partner_name):
+    if not user_id: return None
+    try: return get_snapshot_store().load(user_id, partner_name)
+    except Exception: return None
+
+def find_new_messages_start(user_id, partner_name, previous_data, messages):
+    """前回の鑑定のスナップショットから、前回以降に増えたメッセージの開始位置を返します。増えていなければ None。"""
+    if not user_id or not previous_data: return None
+    try: info = get_snapshot_store().info(user_id, partner_name)
+    except Exception: return None
+    if not info or info["history_id"] != previous_data.get("id"): return None
+    since = timed_import("chat_snapshot").new_messages_start(messages, info["message_count"], info["last_timestamp"])
+    return since if since is not None and since < len(messages) else None
 
 def save_diagnosis_result(user_id, partner_name, pulse_score, summary):
-    if not user_id: return
-    file_path, data = os.path.join(DATA_DIR, f"{user_id}.json"), []
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
-        except: pass
-    data.append({"date": datetime.now().isoformat(), "partner_name": partner_name, "pulse_score": pulse_score, "summary": summary})
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=2)
-    except: pass
+    if not user_id: return None
+    try: return get_history_store().save(user_id, partner_name, pulse_score, summary)
+    except Exception: return None
 
 def load_previous_diagnosis(user_id, partner_name):
     if not user_id: return None
-    file_path = os.path.join(DATA_DIR, f"{user_id}.json")
-    if not os.path.exists(file_path): return None
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
-        for record in reversed(data):
-            if record.get("partner_name") == partner_name: return record
-    except: return None
-    return None
-
-def extract_pulse_score_from_response(ai_response):
-    patterns = [r'【総合脈あり度】\s*[:：]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])', r'総合脈あり度\s*[:：]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])', r'脈あり度[はが]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])', r'(\d{1,3})\s*[%％パーセント](?:くらい|ほど|程度)?(?:の)?(?:脈あり|可能性)', r'スコア[はが]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])']
-    for pattern in patterns:
-        match = re.search(pattern, ai_response, flags=re.DOTALL | re.IGNORECASE)
-        if match:
-            try:
-                score = int(match.group(1))
-                if 0 <= score <= 100: return score
-            except (ValueError, IndexError): continue
-    st.warning("⚠️ AIの応答から脈あり度のパーセンテージを自動で読み取れませんでした。")
-    return 0
-
-def extract_summary_from_response(ai_response):
-    lines, summary_parts = ai_response.split('\n'), []
-    for line in lines:
-        if '脈あり度' in line or '総合' in line:
-            summary_parts.append(line.strip())
-            break
-    for line in lines:
-        clean_line = line.strip()
-        if clean_line and not clean_line.startswith('#') and len(clean_line) > 15:
-            summary_parts.append(clean_line)
-            if len(" ".join(summary_parts)) > 150: break
-    summary = " ".join(summary_parts)
-    if not summary: return ai_response[:150] + '...'
-    return summary[:200] + '...' if len(summary) > 200 else summary
-
-class MyPDF(FPDF):
-    def footer(self): pass
-
-def create_pdf(ai_response_text, graph_img_buffer, character):
-    ai_response_text = re.sub(r'[\U0001F300-\U0001F9FF]+', '', ai_response_text)
-    ai_response_text = re.sub(r'[\u2600-\u26FF\u2700-\u27BF\uFE0F]+', '', ai_response_text)
-    pdf = MyPDF(orientation='P', unit='mm', format='A4')
-    pdf.set_auto_page_break(auto=True, margin=25)
-    pdf.set_margins(left=20, top=20, right=20)
-    font_path = get_japanese_font()
-    font_available = font_path is not None
-    if font_available:
+    try: return get_history_store().latest(user_id, partner_name)
+    except Exception: return None
+
+# ---------------------------------------------------------------------
+# --- 鑑定のバックグラウンド実行 ---
+# ---------------------------------------------------------------------
+# ★★★ 新設：鑑定はジョブとして裏で実行し、画面は結果を取りに来るだけにする ★★★
+DIAGNOSIS_POLL_SECONDS = 1.0
+HEDGE_AFTER_SECONDS = 8.0  # ヘッジ有効時、この秒数で出力が始まらなければ予備モデルにも依頼する
+
+@st.cache_resource
+def get_job_manager():
+    return JobManager()
+
+def run_diagnosis_job(job, req):
+    """
+    鑑定の本体（プロンプト作成 → 生成 → 脈あり度の抽出 → 履歴保存 → PDF作成の依頼）。
+    バックグラウンドのスレッドで動くので、st.* は呼ばずに job に進み具合を書き込みます。
+    """
+    metrics = req["metrics"]
+    with metrics.span("diagnosis_total"): result = _run_diagnosis_stages(job, req, metrics)
+    if not result["text"]: job.reusable = False  # ブロックされた・空の結果は、同じ依頼でもやり直せるようにする
+    return result
+
+def _prepare_reading(job, req, metrics, backend):
+    """鑑定師が何人でも共通の準備（会話の選択と数値データの集計）。(会話, 集計の文章, 前回以降の件数) を返します。"""
+    job.update(stage="トーク履歴から大切な会話を選んでいます...")
+    since = req["since"]
+    with metrics.span("context_select", update=since is not None):
+        estimator = get_token_estimator(backend, req["model_name"], req["messages"], req["token_ratios"])
+        # 前回からの変化を見る鑑定では、前回以降の会話だけを小さな予算で選ぶ
+        if since is not None: context = select_update_context(req["messages"], since, UPDATE_CONTEXT_TOKEN_BUDGET, estimator)
+        else: context = select_context(req["messages"], CONTEXT_TOKEN_BUDGET, estimator)
+    # 返信間隔などはAIに推測させず、ローカルで集計した数値を渡す（前回からの変化を見るときは前回以降の分だけ）
+    chat_analytics = timed_import("chat_analytics")
+    conversation_stats = req["conversation_stats"]
+    if since is not None:
+        with metrics.span("analytics", update=True): conversation_stats = chat_analytics.compute_conversation_stats(req["messages"], since)
+    return context, chat_analytics.format_conversation_stats(conversation_stats), None if since is None else len(req["messages"]) - since
+
+def _run_reading(req, metrics, backend, character, prepared, progress):
+    """
+    1人の鑑定師の鑑定（プロンプト作成 → 生成 → 脈あり度の抽出 → 履歴保存）。
+    進み具合は progress(stage=..., partial_text=...) に書き込みます。戻り値には解析済みの report と history_id も入ります。
+    """
+    context, conversation_stats, new_message_count = prepared
+    model_name = req["model_name"]
+    with metrics.span("prompt_build"):
+        final_prompt = build_prompt(character, req["tone"], req["your_name"], req["partner_name"], req["counseling_text"],
+                                    context["recent"], context["digest"], req["trend"], req["previous_data"],
+                                    new_message_count, conversation_stats)
+    # JSON出力モードでは脈あり度を型付きの項目で受け取る（途中経過は JSON のままなので書き上がり表示はしない）
+    stream_output = req["stream_output"] and not req["json_output"]
+    generation_config = GENERATION_CONFIG
+    if req["json_output"]:
+        final_prompt += JSON_OUTPUT_INSTRUCTION
+        generation_config = json_generation_config(GENERATION_CONFIG)
+    result = {"character": character, "model_name": model_name, "section_tokens": context["section_tokens"],
+              "total_tokens": context["total_tokens"], "attempts": [], "from_cache": False, "first_token_seconds": None,
+              "total_seconds": None, "streamed": stream_output, "history_id": None}
+
+    progress(stage="星々からのメッセージを読み解いています...✨")
+    with metrics.span("response_cache_lookup"):
+        cache_key = make_cache_key(final_prompt, model_name, generation_config, SAFETY_SETTINGS)
+        ai_response_text = None if req["force_fresh"] else req["response_cache"].get(cache_key)
+    feedback = None
+    if ai_response_text:
+        result["from_cache"] = True
+    else:
+        def generate_once(candidate, on_text):
+            if stream_output: return backend.stream(candidate, final_prompt, generation_config, SAFETY_SETTINGS, on_text=on_text)
+            return backend.generate(candidate, final_prompt, generation_config, SAFETY_SETTINGS)
+
+        # 一時的なエラーは待って再試行し、だめなら候補リストの次のモデルへ（ヘッジ時は並行して依頼）
+        candidates = [model_name] + [m for m in MODEL_CANDIDATES if m != model_name]
+        with metrics.span("generate", model=model_name, streamed=stream_output):
+            used_model, generated, result["attempts"] = generate_with_fallback(
+                candidates, generate_once, on_text=lambda partial: progress(partial_text=partial),
+                hedge_after=HEDGE_AFTER_SECONDS if req["hedge"] else None)
+        if generated[1] is not None: metrics.record("generate_first_token", generated[1], model=used_model)
+        ai_response_text, result["first_token_seconds"], result["total_seconds"], feedback = generated
+        result["model_name"] = used_model
+    if not ai_response_text:
+        result["text"] = ""
+        result["feedback"] = feedback
+        return result
+    if not result["from_cache"]: req["response_cache"].put(cache_key, model_name, ai_response_text)
+
+    progress(stage="鑑定書を仕上げています...")
+    # レポートは1回だけ解析し、画面表示・履歴保存・PDF作成で同じ結果を使う
+    with metrics.span("report_parse", json_output=req["json_output"]): report = parse_report(ai_response_text)
+    result["report"], result["text"] = report, report.text
+    pulse_score = report.pulse_score
+    result["pulse_score_found"] = pulse_score is not None
+    result["pulse_score"] = pulse_score = pulse_score or 0
+    # 保存済みの結果を表示し直しただけのときは、履歴を二重に記録しない
+    if not result["from_cache"] and req["user_id"]:
         try:
-            pdf.add_font('Japanese', '', font_path)
-            pdf.add_font('Japanese', 'B', font_path)
-        except Exception: font_available = False
-    font_name = 'Japanese' if font_available else 'Arial'
-    pdf.add_page()
-    color_map = {"1. 優しく包み込む、お姉さん系": (255, 182, 193), "2. ロジカルに鋭く分析する、専門家系": (135, 206, 235), "3. 星の言葉で語る、ミステリアスな占い師系": (186, 85, 211)}
-    theme_color = color_map.get(character, (200, 200, 200))
-    pdf.set_fill_color(*theme_color)
-    pdf.rect(0, 0, 210, 297, 'F')
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_y(110)
-    pdf.set_font(font_name, 'B', 26)
-    pdf.cell(0, 15, "恋のオラクル AI恋星譚", new_x="LMARGIN", new_y="NEXT", align='C')
-    pdf.set_font(font_name, '', 14)
-    pdf.cell(0, 10, "- 心の羅針盤 Edition -", new_x="LMARGIN", new_y="NEXT", align='C')
-    pdf.ln(40)
-    pdf.set_font(font_name, '', 11)
-    pdf.cell(0, 10, f"鑑定日: {datetime.now().strftime('%Y年%m月%d日')}", align='C')
-    pdf.add_page()
-    pdf.set_text_color(0, 0, 0)
-    LINE_HEIGHT_NORMAL, LINE_HEIGHT_H2 = 8, 12
-    lines = ai_response_text.split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            pdf.ln(LINE_HEIGHT_NORMAL / 2)
-            continue
-        if line.startswith('###'):
-            pdf.ln(LINE_HEIGHT_NORMAL)
-            pdf.set_font(font_name, 'B', 16)
-            pdf.multi_cell(0, LINE_HEIGHT_H2, line[4:].strip(), align='L')
-            pdf.set_font(font_name, '', 11)
-        else:
-            parts = re.split(r'(\*\*.*?\*\*)', line)
-            for part in parts:
-                if not part: continue
-                if part.startswith('**') and part.endswith('**'):
-                    pdf.set_font(font_name, 'B', 11)
-                    pdf.write(LINE_HEIGHT_NORMAL, part[2:-2])
-                    pdf.set_font(font_name, '', 11)
-                else:
-                    pdf.write(LINE_HEIGHT_NORMAL, part)
-            pdf.ln(LINE_HEIGHT_NORMAL)
-    pdf.add_page()
-    pdf.set_font(font_name, 'B', 15)
-    pdf.cell(0, 12, "二人の恋の温度グラフ", new_x="LMARGIN", new_y="NEXT", align='C')
-    pdf.ln(8)
-    graph_img_buffer.seek(0)
-    pdf.image(graph_img_buffer, x=20, y=pdf.get_y(), w=170)
-    pdf.set_auto_page_break(auto=False)
-    pdf.set_y(-25)
-    pdf.set_font(font_name, '', 8)
-    pdf.set_text_color(128, 128, 128)
-    pdf.cell(0, 10, "本鑑定はAIによる心理分析です。", new_x="LMARGIN", new_y="NEXT", align='C')
-    pdf.cell(0, 5, "あなたの恋を心から応援しています♡", align='C')
-    return bytes(pdf.output())
+            with metrics.span("history_save"):
+                result["history_id"] = req["history_store"].save(req["user_id"], req["partner_name"], pulse_score, report.summary)
+        except Exception: pass
+    return result
+
+def _save_chat_snapshot(req, metrics, history_id):
+    """今回の履歴の記録にひも付けてスナップショットを残します（ファイルでアップロードされたときだけ）。"""
+    if history_id is None or isinstance(req["talk_data"], str): return
+    try:
+        with metrics.span("snapshot_save"), talk_bytes(req["talk_data"]) as raw:
+            chat_snapshot = timed_import("chat_snapshot")
+            snapshot = chat_snapshot.make_snapshot(raw, req["encoding"], req["messages"], req["scores"],
+                                                   req["user_id"], req["partner_name"], history_id)
+            if snapshot is not None: req["snapshot_store"].save(snapshot)
+    except Exception: pass
+
+def _run_diagnosis_stages(job, req, metrics):
+    backend = req["backend"]
+    prepared = _prepare_reading(job, req, metrics, backend)
+    result = _run_reading(req, metrics, backend, req["character"], prepared, job.update)
+    if not result["text"]: return result
+    report = result["report"]
+    print_chart = req["chart_cache"].get(req["temp_hash"], req["temp_data"], *req["graph_colors"], PRINT_DPI)
+    # PDFは裏で作成を始めておき、鑑定文はすぐに表示する（画面側はできあがったらダウンロードボタンを出す）
+    result["pdf_key"] = hashlib.sha256("\0".join([report.text, req["temp_hash"], req["character"]]).encode('utf-8')).hexdigest()
+    result["pdf_args"] = (report, print_chart, req["character"])
+    req["pdf_cache"].request(result["pdf_key"], *result["pdf_args"])
+    _save_chat_snapshot(req, metrics, result["history_id"])
+    return result
+
+# ★★★ 新設：3人の鑑定師に同時に依頼して見比べる（準備とグラフは1回だけ） ★★★
+def run_comparison_job(job, req):
+    """
+    「鑑定師を見比べる」の本体。会話の選択と集計は1回だけ行い、全員の鑑定を同時に依頼します。
+    鑑定師ごとの進み具合と結果は job.parts に入るので、画面は終わった鑑定から表示できます。
+    """
+    metrics = req["metrics"]
+    with metrics.span("comparison_total"):
+        backend = req["backend"]
+        prepared = _prepare_reading(job, req, metrics, backend)
+        job.update(stage="鑑定師たちが同時に鑑定しています...✨")
+        characters = list(CHARACTER_MAP)
+        with ThreadPoolExecutor(max_workers=len(characters), thread_name_prefix="reading") as pool:
+            futures = {pool.submit(_run_reading, req, metrics, backend, character, prepared, functools.partial(job.update_part, character)): character
+                       for character in characters}
+            for future in as_completed(futures):
+                character = futures[future]
+                try: reading = future.result()
+                except Exception as e: reading = {"character": character, "text": "", "feedback": None, "error": f"{e}"}
+                job.update_part(character, result=reading)
+        readings = [job.parts[character]["result"] for character in characters]
+        result = {"readings": readings}
+        finished = [reading for reading in readings if reading["text"]]
+        if finished:
+            job.update(stage="鑑定書を仕上げています...")
+            print_chart = req["chart_cache"].get(req["temp_hash"], req["temp_data"], *req["graph_colors"], PRINT_DPI)
+            chapters = [(f"{character_name(reading['character'])}の鑑定（脈あり度 {reading['pulse_score']}%）", reading["character"], reading["report"])
+                        for reading in finished]
+            result["pdf_key"] = hashlib.sha256("\0".join([reading["text"] for reading in finished] + [req["temp_hash"], req["character"]]).encode('utf-8')).hexdigest()
+            result["pdf_args"] = (chapters, print_chart, req["character"])
+            req["pdf_cache"].request_comparison(result["pdf_key"], *result["pdf_args"])
+        # 全員分の履歴を保存したので、スナップショットは最後に保存した記録（次回の「前回」）にひも付ける
+        history_ids = [reading["history_id"] for reading in finished if reading["history_id"] is not None]
+        if history_ids: _save_chat_snapshot(req, metrics, max(history_ids))
+        if len(finished) < len(readings): job.reusable = False  # 1人でも失敗・空なら、同じ依頼でやり直せるようにする
+        return result
+
+def make_diagnosis_key(*parts):
+    """鑑定の依頼内容からジョブの重複判定用のキーを作ります。"""
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+def show_diagnosis_job(view):
+    """
+    ジョブの進み具合・結果を表示します。まだ終わっていなければ True を返します
+    （呼び出し側で少し待ってから再実行し、続きを取りに来る）。
+    """
+    job = get_job_manager().get(view["job_id"])
+    if job is None:
+        st.session_state.pop("diagnosis_view", None)
+        return False
+    if view["previous_data"]: st.info(f"📖 {view['partner_name']}さんとの前回の鑑定データが見つかりました。")
+    st.image(get_chart_cache().get(view["temp_hash"], view["temp_data"], *view["graph_colors"], SCREEN_DPI))
+    st.caption(f"（使用AIモデル: {view['model_name']}）")
+    if job.status == "error":
+        st.error("💫 ごめんなさい、星との交信が少し途切れちゃったみたいです...")
+        with st.expander("🔧 詳細"): st.code(f"{job.error}")
+        return False
+    if view.get("compare"): return show_comparison_job(job, view)
+    if not job.is_finished:
+        st.info(f"⏳ {job.stage}（画面を操作しても鑑定は続きます）")
+        if job.partial_text:
+            st.markdown("---"); st.markdown(f"{job.partial_text} ▌")
+        return True
+
+    result = job.result
+    if job.job_id not in st.session_state.setdefault("recorded_jobs", set()):
+        st.session_state.recorded_jobs.add(job.job_id)
+        if not result["from_cache"]: record_generation_timing(result["model_name"], result["first_token_seconds"], result["total_seconds"], result["streamed"])
+    st.caption("（会話の引用: " + " / ".join(f"{name} {tokens:,}" for name, tokens in result["section_tokens"].items()) + f" トークン、合計 約{result['total_tokens']:,}トークン）")
+    if not result["text"]:
+        st.error("💫 AIからの応答がブロックされたか、内容が空でした。")
+        if result["feedback"]: st.write("🔍 **AIからのフィードバック:**"); st.code(result["feedback"])
+        return False
+    st.markdown("---"); st.markdown(result["text"])
+    if result["from_cache"]:
+        st.caption("（💾 同じ内容の鑑定結果を保存済みのデータから表示しています。新しく鑑定するには上のチェックを入れてください）")
+    elif result["first_token_seconds"] is not None:
+        st.caption(f"（最初の応答まで {result['first_token_seconds']:.1f}秒 / 全体 {result['total_seconds']:.1f}秒）")
+    if result["model_name"] != view["model_name"]:
+        st.caption(f"（{view['model_name']} が混み合っていたため、予備のモデル {result['model_name']} で鑑定しました）")
+    if len(result["attempts"]) > 1:
+        with st.expander("🔧 AIへの接続の記録"):
+            for attempt in result["attempts"]:
+                st.write(f"- {attempt['model']}（{attempt['attempt'] + 1}回目）: {attempt['outcome']} / {attempt['latency']:.1f}秒" + (f" / {attempt['error']}" if attempt["error"] else ""))
+    pulse_score = result["pulse_score"]
+    if not result["pulse_score_found"]: st.warning("⚠️ AIの応答から脈あり度のパーセンテージを自動で読み取れませんでした。")
+    st.info(f"🔍 抽出された脈あり度: {pulse_score}% (この数値が保存されます)")
+    if view["previous_data"]: st.info(f"📊 比較: 前回の脈あり度 {view['previous_data'].get('pulse_score', 0)}% → 今回抽出された脈あり度 {pulse_score}%")
+    # キャッシュから追い出されていたら、ここで作り直しを依頼する
+    return show_pdf_download(get_pdf_cache().request(result["pdf_key"], *result["pdf_args"]), "📄 鑑定書をPDFでダウンロード", "恋の鑑定書.pdf")
+
+def show_pdf_download(pdf_future, label, file_name):
+    """PDFができていればダウンロードボタンを出します。作成中なら True を返します（呼び出し側で続きを取りに来る）。"""
+    if not pdf_future.done():
+        st.caption("📄 鑑定書PDFを作成しています...")
+        return True
+    if pdf_future.exception() is not None:
+        st.error("📄 鑑定書PDFを作成できませんでした。")
+        with st.expander("🔧 詳細"): st.code(f"{pdf_future.exception()}")
+        return False
+    st.download_button(label, pdf_future.result(), file_name, "application/pdf", use_container_width=True)
+    return False
+
+def show_comparison_job(job, view):
+    """
+    「鑑定師を見比べる」の表示。鑑定師ごとの脈あり度を横に並べ、終わった鑑定から本文をタブで見られるようにします。
+    まだ終わっていない鑑定があれば True を返します。
+    """
+    characters = list(CHARACTER_MAP)
+    if not job.parts: st.info(f"⏳ {job.stage}（画面を操作しても鑑定は続きます）")
+    previous_score = view["previous_data"].get("pulse_score", 0) if view["previous_data"] else None
+    for column, character in zip(st.columns(len(characters)), characters):
+        part = job.parts.get(character)
+        reading = part["result"] if part else None
+        with column:
+            st.markdown(f"**{character_name(character)}**")
+            if reading is None:
+                if part: st.caption(f"⏳ {part['stage']}" + (f"（{len(part['partial_text']):,}文字）" if part["partial_text"] else ""))
+            elif not reading["text"]:
+                st.error("💫 鑑定を受け取れませんでした。")
+                detail = reading.get("error") or reading.get("feedback")
+                if detail:
+                    with st.expander("🔧 詳細"): st.code(f"{detail}")
+            else:
+                delta = f"{reading['pulse_score'] - int(previous_score):+d}%（前回比）" if previous_score is not None else None
+                st.metric("脈あり度", f"{reading['pulse_score']}%", delta)
+                if not reading["pulse_score_found"]: st.caption("⚠️ 脈あり度を自動で読み取れませんでした")
+                if reading["from_cache"]: st.caption("（💾 保存済みの結果）")
+                elif reading["total_seconds"] is not None: st.caption(f"（全体 {reading['total_seconds']:.1f}秒）")
+    finished = [character for character in characters
+                if job.parts.get(character) and job.parts[character]["result"] and job.parts[character]["result"]["text"]]
+    if finished:
+        st.markdown("---")
+        for tab, character in zip(st.tabs([character_name(character) for character in finished]), finished):
+            with tab: st.markdown(job.parts[character]["result"]["text"])
+    if not job.is_finished: return True
+
+    result = job.result
+    if job.job_id not in st.session_state.setdefault("recorded_jobs", set()):
+        st.session_state.recorded_jobs.add(job.job_id)
+        for reading in result["readings"]:
+            if reading["text"] and not reading["from_cache"]:
+                record_generation_timing(reading["model_name"], reading["first_token_seconds"], reading["total_seconds"], reading["streamed"])
+    if "pdf_key" not in result: return False
+    st.caption("（それぞれの鑑定師の脈あり度を履歴に保存しました）")
+    return show_pdf_download(get_pdf_cache().request_comparison(result["pdf_key"], *result["pdf_args"]),
+                             "📄 鑑定師たちの鑑定をまとめた鑑定書をPDFでダウンロード", "恋の鑑定書_見比べ.pdf")
 
 # ---------------------------------------------------------------------
 # --- 画面表示と実行ロジック ---
@@ -442,7 +624,12 @@ def create_pdf(ai_response_text, graph_img_buffer, character):
 def show_login_screen():
     st.header("ようこそ、鑑定の世界へ")
     user_id = st.text_input("BOOTHの購入者IDを入力してください", key="login_user_id")
+    if VALID_USER_IDS.last_error and not len(VALID_USER_IDS):
+        st.error("スプレッドシートからユーザー情報の取得に失敗しました。管理者に連絡してください。")
+        st.code(f"エラー詳細: {VALID_USER_IDS.last_error}")
     if st.button("認証する", key="login_button"):
+        if user_id not in VALID_USER_IDS:
+            VALID_USER_IDS.wait_until_loaded(USER_LIST_COLD_START_WAIT)
         if user_id in VALID_USER_IDS:
             st.session_state.authenticated, st.session_state.user_id = True, user_id
             cookies["authenticated"], cookies["user_id"] = "True", user_id
@@ -482,6 +669,12 @@ def show_main_app():
     # セッション状態（再実行しても消えない記憶領域）を初期化
     if "talk_data" not in st.session_state:
         st.session_state.talk_data = None
+    # 使われているセッションの一時ファイルは残し、しばらく使われていないセッションの分を削除する
+    get_talk_spool().touch(get_session_key())
+    spool_expired = isinstance(st.session_state.talk_data, SpooledTalk) and not st.session_state.talk_data.exists()
+    if spool_expired:
+        # 削除されていたら読み込み直す（アップロード欄にファイルが残っていれば、下でそのまま書き出し直す）
+        st.session_state.talk_data, st.session_state.talk_hash, st.session_state.talk_file_id = None, None, None
 
     tab1, tab2 = st.tabs(["📁 ファイルをアップロード", "📝 テキストを貼り付け"])
 
@@ -495,24 +688,27 @@ def show_main_app():
         if uploaded_file is not None:
             # ファイルがアップロードされたら、すぐにセッション状態に保存
             try:
-                raw_data = uploaded_file.getvalue()
-                encodings = ['utf-8', 'utf-8-sig', 'shift_jis', 'cp932']
-                decoded_data = None
-                for encoding in encodings:
+                # 同じファイルの再実行では取り出し直さない（全体のデコードは解析時に1回だけ）
+                if st.session_state.get("talk_file_id") != uploaded_file.file_id:
+                    # 大きなファイルは一時ファイルに書き出し（内容ハッシュも同時に計算）、セッションにはその場所だけを持つ
+                    with get_stage_metrics().span("upload_spool"): talk_data, talk_hash = get_talk_spool().store(uploaded_file)
+                    encoding = None
                     try:
-                        decoded_data = raw_data.decode(encoding)
-                        st.caption(f"（ファイルを{encoding}で読み込みました）")
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                
-                if decoded_data:
-                    # ★重要★ セッション状態にデータを保存
-                    st.session_state.talk_data = decoded_data
-                    # アップロードされたファイルをクリアするため、ここで一度リセット
-                    
-                else:
-                    st.error("❌ ファイルの文字コードを判定できませんでした。")
+                        with get_stage_metrics().span("encoding_sniff"), talk_bytes(talk_data) as raw_data: encoding = sniff_encoding(raw_data)
+                    finally:
+                        # 読めたときだけ前の一時ファイルと入れ替える（読めなければ新しい方を捨て、前のトーク履歴はそのまま使える）
+                        if encoding: get_talk_spool().keep(get_session_key(), talk_data)
+                        else: get_talk_spool().discard(talk_data)
+                    if encoding:
+                        # ★重要★ セッション状態には元のバイト列（大きければ一時ファイル）を保存（デコード済みの文字列は持たない）
+                        st.session_state.talk_data = talk_data
+                        st.session_state.talk_encoding = encoding
+                        st.session_state.talk_hash = talk_hash
+                        st.session_state.talk_file_id = uploaded_file.file_id
+                    else:
+                        st.error("❌ ファイルの文字コードを判定できませんでした。")
+                if st.session_state.get("talk_file_id") == uploaded_file.file_id:
+                    st.caption(f"（ファイルを{st.session_state.talk_encoding}で読み込みました）")
             except Exception:
                 st.error("❌ ファイルの読み込み中にエラーが発生しました。")
 
@@ -529,82 +725,95 @@ def show_main_app():
             if text_input and text_input.strip():
                 # ★重要★ ボタンが押されたらセッション状態にデータを保存
                 st.session_state.talk_data = text_input
+                st.session_state.talk_hash = compute_talk_hash(text_input)
+                st.session_state.talk_file_id = None
+                get_talk_spool().release(get_session_key())
                 st.rerun() # データを確実に反映させるために再実行
             else:
                 st.warning("⚠️ トーク履歴のデータが貼り付けられていません。")
                 # もし空でボタンが押されたら、記憶していたデータも消す
                 st.session_state.talk_data = None
+                st.session_state.talk_hash = None
 
 
+    diagnosis_in_progress = False
+    if spool_expired and not st.session_state.talk_data:
+        st.warning("⏳ しばらく操作がなかったため、読み込んだトーク履歴を破棄しました。もう一度読み込んでください。")
+
     # --- ここからが共通の処理 ---
     # ★重要★ セッション状態にデータがあるかどうかをチェック
     if st.session_state.talk_data:
         # セッションからデータを取得（これで「鑑定」ボタンを押してもデータが消えない）
         talk_data = st.session_state.talk_data
-        
-        messages, _ = parse_line_chat(talk_data)
+        talk_hash = st.session_state.get("talk_hash") or compute_talk_hash(talk_data)
+        st.session_state.talk_hash = talk_hash
+
+        # ★ 解析結果は内容ハッシュ単位でキャッシュ（再実行のたびに全文を解析しない）
+        # 前回の鑑定のスナップショットは解析し直すときだけ読む（続きの部分だけを解析できる）
+        parsed_chat = load_parsed_chat(talk_hash, talk_data, lambda: load_chat_snapshot(st.session_state.user_id, partner_name))
+        messages = parsed_chat["messages"]
 
         if not messages:
             st.warning("⚠️ 有効なメッセージが見つかりませんでした。")
         else:
-            st.success(f"✅ {len(messages)}件のメッセージを読み込みました！鑑定を開始してください。")
+            st.success(f"✅ {parsed_chat['stats']['message_count']}件のメッセージを読み込みました！鑑定を開始してください。")
             with st.expander("🔍 読み込まれた内容の先頭部分を確認"):
-                st.code('\n'.join(talk_data.strip().split('\n')[:15]))
+                st.code(parsed_chat["preview"])
             
             st.write("---")
             
+            stream_output = st.checkbox("✨ 鑑定文を書き上がった部分から表示する", value=True, key="stream_output")
+            hedge = st.checkbox("⚡ 応答が遅いときは、予備のAIモデルにも同時に依頼する", value=False, key="hedge_generation",
+                                help=f"{HEDGE_AFTER_SECONDS:.0f}秒たっても書き始めない場合に、次の候補モデルにも依頼して早く届いた方を使います（APIの利用量は増えます）。")
+            json_output = st.checkbox("🧾 脈あり度を決まった形式（JSON）で受け取る", value=False, key="json_output",
+                                      help="脈あり度を文章から読み取らず、AIに数値の項目として返してもらいます（書き上がった部分からの表示はできません）。")
+            compare = st.checkbox("👥 3人の鑑定師に同時に鑑定してもらい、見比べる", value=False, key="compare_readers",
+                                  help="トーク履歴の準備は1回だけで、3人への依頼を同時に行います（APIの利用量は3回分です）。"
+                                       "終わった鑑定から並べて表示し、3人の鑑定をまとめた鑑定書PDFも作ります。")
+            force_fresh = st.checkbox("🔄 保存済みの鑑定結果を使わず、新しく鑑定する", value=False, key="force_fresh",
+                                      help="同じ内容で鑑定済みの場合、通常はその結果をすぐに表示します。")
+            # 同じセッションで同じトークを鑑定し直すときは、最初に読んだ前回データ（と前回以降の開始位置）を使う
+            # （今回の保存結果が「前回」に入れ替わってプロンプトが変わり、キャッシュが効かなくなるのを防ぐ）
+            previous_pins = st.session_state.setdefault("previous_data_pins", {})
+            pin_key = (talk_hash, partner_name)
+            if pin_key not in previous_pins:
+                previous = load_previous_diagnosis(st.session_state.user_id, partner_name)
+                previous_pins[pin_key] = (previous, find_new_messages_start(st.session_state.user_id, partner_name, previous, messages))
+            previous_data, since = previous_pins[pin_key]
+            if since is not None:
+                update_only = st.checkbox(f"📈 前回の鑑定以降の会話（{len(messages) - since}件）を中心に鑑定する", value=True, key="update_only",
+                                          help="前回の鑑定から何が変わったかを中心に見ます。AIに渡す会話が少ないので早く終わります。")
+                if not update_only: since = None
             if st.button("🔮 鑑定を開始する", type="primary", use_container_width=True):
-                with st.spinner("星々からのメッセージを読み解いています...✨"):
-
-
-                    previous_data = load_previous_diagnosis(st.session_state.user_id, partner_name)
-                    if previous_data: st.info(f"📖 {partner_name}さんとの前回の鑑定データが見つかりました。")
-                    color_map_graph = {"1. 優しく包み込む、お姉さん系": ("#ff69b4", "#ffb6c1"), "2. ロジカルに鋭く分析する、専門家系": ("#1e90ff", "#add8e6"), "3. 星の言葉で語る、ミステリアスな占い師系": ("#9370db", "#e6e6fa")}
-                    line_color, fill_color = color_map_graph.get(character, ("#ff69b4", "#ffb6c1"))
-                    temp_data, trend = calculate_temperature(messages)
-                    fig_graph, ax_graph = plt.subplots(figsize=(10, 6))
-                    if temp_data.get('labels'):
-                        ax_graph.plot(temp_data['labels'], temp_data['values'], marker='o', color=line_color, linewidth=2)
-                        ax_graph.fill_between(temp_data['labels'], temp_data['values'], color=fill_color, alpha=0.5)
-                        plt.xticks(rotation=45, ha="right")
-                    ax_graph.set_title('二人の恋の温度グラフ', fontsize=14, pad=20)
-                    plt.tight_layout()
-                    img_buffer = io.BytesIO()
-                    fig_graph.savefig(img_buffer, format='png', dpi=300, bbox_inches='tight')
-                    img_buffer.seek(0)
-                    st.pyplot(fig_graph); plt.close(fig_graph)
-                    try:
-                        genai.configure(api_key=st.session_state.api_key)
-                        user_override_model = cookies.get("user_custom_model")
-                        default_model = st.session_state.get("selected_model") or cookies.get("selected_model") or "models/gemini-2.5-flash"
-                        model_name_to_use = user_override_model if user_override_model else default_model
-                        st.caption(f"（使用AIモデル: {model_name_to_use}）")
-                        model = genai.GenerativeModel(model_name_to_use)
-                        messages_summary = smart_extract_text(messages, max_chars=8000)
-                        long_term_summary = create_long_term_summary(messages, max_chars=4000)
-                        final_prompt = build_prompt(character, tone, your_name, partner_name, counseling_text, messages_summary, long_term_summary, trend, previous_data)
-                        safety_settings = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
-                        response = model.generate_content(final_prompt, generation_config={"max_output_tokens": 8192, "temperature": 0.75}, safety_settings=safety_settings)
-                        ai_response_text = ""
-                        try: ai_response_text = response.text
-                        except Exception:
-                            if hasattr(response, "parts") and response.parts: ai_response_text = response.parts[0].text
-                        if not ai_response_text:
-                            st.error("💫 AIからの応答がブロックされたか、内容が空でした。")
-                            if hasattr(response, 'prompt_feedback'): st.write("🔍 **AIからのフィードバック:**"); st.code(f"{response.prompt_feedback}")
-                            return
-                        st.markdown("---"); st.markdown(ai_response_text)
-                        pulse_score = extract_pulse_score_from_response(ai_response_text)
-                        st.info(f"🔍 抽出された脈あり度: {pulse_score}% (この数値が保存されます)")
-                        summary = extract_summary_from_response(ai_response_text)
-                        save_diagnosis_result(st.session_state.user_id, partner_name, pulse_score, summary)
-                        if previous_data: st.info(f"📊 比較: 前回の脈あり度 {previous_data.get('pulse_score', 0)}% → 今回抽出された脈あり度 {pulse_score}%")
-                        pdf_data = create_pdf(ai_response_text, img_buffer, character)
-                        st.download_button("📄 鑑定書をPDFでダウンロード", pdf_data, f"恋の鑑定書.pdf", "application/pdf", use_container_width=True)
-                    except Exception:
-                        st.error("💫 ごめんなさい、星との交信が少し途切れちゃったみたいです...")
-                        with st.expander("🔧 詳細"): st.code(f"{traceback.format_exc()}")
-                        
+                temp_data, trend = parsed_chat["stats"]["temp_data"], parsed_chat["stats"]["trend"]
+                user_override_model = cookies.get("user_custom_model")
+                default_model = st.session_state.get("selected_model") or cookies.get("selected_model") or "models/gemini-2.5-flash"
+                model_name_to_use = user_override_model if user_override_model else default_model
+                view = {"partner_name": partner_name, "previous_data": previous_data, "model_name": model_name_to_use,
+                        "temp_hash": temperature_data_hash(temp_data), "temp_data": temp_data, "graph_colors": graph_colors(character),
+                        "compare": compare}
+                req = dict(view, backend=get_backend(st.session_state.api_key), user_id=st.session_state.user_id, messages=messages,
+                           character=character, tone=tone, your_name=your_name, counseling_text=counseling_text, trend=trend,
+                           stream_output=stream_output, json_output=json_output, force_fresh=force_fresh, hedge=hedge, since=since,
+                           talk_data=talk_data, encoding=parsed_chat["encoding"], scores=parsed_chat["scores"],
+                           conversation_stats=parsed_chat["stats"]["conversation"],
+                           history_store=get_history_store(), response_cache=get_response_cache(), snapshot_store=get_snapshot_store(),
+                           chart_cache=get_chart_cache(), pdf_cache=get_pdf_cache(), token_ratios=get_token_ratio_cache(), metrics=get_stage_metrics())
+                # 同じ依頼はジョブを作り直さない（「新しく鑑定する」のときだけ毎回別の依頼として扱う）
+                diagnosis_key = make_diagnosis_key(talk_hash, character, tone, your_name, partner_name, counseling_text,
+                                                   model_name_to_use, stream_output, json_output, previous_data and previous_data.get("id"), since,
+                                                   compare, time.time() if force_fresh else None)
+                try:
+                    job = get_job_manager().submit(st.session_state.user_id, diagnosis_key,
+                                                   run_comparison_job if compare else run_diagnosis_job, req)
+                    st.session_state.diagnosis_view = dict(view, job_id=job.job_id)
+                except JobLimitError:
+                    st.warning("⏳ 前の鑑定がまだ進行中です。終わってからもう一度お試しください。")
+
+            # 実行中・完了済みの鑑定があれば表示（再実行しても結果は消えない）
+            if st.session_state.get("diagnosis_view"):
+                diagnosis_in_progress = show_diagnosis_job(st.session_state.diagnosis_view)
+
     # ★★★【設定セクション】は、このブロックの外にあるので、変更の影響を受けません ★★★
     st.write("---")
     
@@ -649,11 +858,37 @@ def show_main_app():
         st.write("### アプリ情報")
         if st.session_state.user_id == "charo1118": 
             st.subheader("👑 管理者メニュー")
+            loaded_at = f"{datetime.fromtimestamp(VALID_USER_IDS.loaded_at):%Y/%m/%d %H:%M:%S}" if VALID_USER_IDS.loaded_at else "未取得"
+            st.caption(f"登録ユーザー数: {len(VALID_USER_IDS)}人（最終取得: {loaded_at}）")
+            if VALID_USER_IDS.last_error: st.warning(f"前回の取得は失敗しました: {VALID_USER_IDS.last_error}")
             if st.button("🔄 ユーザーリストを再読み込み"):
-                st.cache_data.clear()
-                st.success("✅ ユーザーリストのキャッシュをクリアしました。")
-                time.sleep(1)
-                st.rerun()
+                if VALID_USER_IDS.refresh_async():
+                    st.success("✅ ユーザーリストの再読み込みをバックグラウンドで開始しました。")
+                else:
+                    st.info("🔄 ユーザーリストは現在再読み込み中です。")
+            st.write("**⏱️ 処理時間（段階ごと・直近の記録から）**")
+            stage_summary = get_stage_metrics().summary()
+            if stage_summary:
+                to_ms = lambda seconds: f"{seconds * 1000:,.0f} ms" if seconds is not None else "-"
+                st.table([{"段階": stage, "件数": row["count"], "エラー": row["errors"], "p50": to_ms(row["p50"]),
+                           "p95": to_ms(row["p95"]), "p99": to_ms(row["p99"])} for stage, row in stage_summary.items()])
+                st.caption(f"p50/p95/p99 は段階ごとに直近{get_stage_metrics().window}件まで、件数・エラーは起動後の累計です。")
+            else:
+                st.caption("まだ記録がありません。")
+            st.write("**🧠 メモリ（このプロセス）**")
+            rss, budget, spool_stats = process_rss_bytes(), memory_budget_bytes(), get_talk_spool().stats()
+            to_mb = lambda n: f"{n / 1024 / 1024:,.0f} MB"
+            if rss is not None:
+                st.progress(min(rss / budget, 1.0), text=f"使用中 {to_mb(rss)} / 目安 {to_mb(budget)}")
+                if rss > budget:
+                    st.warning("⚠️ メモリの目安を超えています。解析結果のキャッシュを空にすると減らせます。")
+                    if st.button("🧹 解析結果のキャッシュを空にする"): load_parsed_chat.clear(); st.rerun()
+            else:
+                st.caption(f"使用中のメモリを取得できませんでした（目安 {to_mb(budget)}）。")
+            job_stats = get_job_manager().stats()
+            st.caption(f"一時ファイルに書き出したトーク履歴: {spool_stats['sessions']}セッション・{to_mb(spool_stats['bytes'])}（ディスク上）"
+                       f" / 使われなくなって削除: {spool_stats['evicted']}件 / 鑑定ジョブ: 実行中 {job_stats['running']}件・保持中 {job_stats['done'] + job_stats['error']}件")
+            st.caption(f"目安は環境変数 {MEMORY_BUDGET_ENV_VAR}（MB）で変更できます。")
 
         st.write("---")
 
@@ -668,6 +903,11 @@ def show_main_app():
             st.success("✅ ログアウトしました。"); st.info("🔄 ログイン画面に戻ります..."); st.balloons()
             time.sleep(2); st.rerun()
 
+    # 鑑定が進行中なら、少し待ってから続きを取りに来る
+    if diagnosis_in_progress:
+        time.sleep(DIAGNOSIS_POLL_SECONDS)
+        st.rerun()
+
 
 # --- メインの実行ロジック ---
 st.title("🌙 恋のオラクル AI恋星譚")
@@ -0,0 +1,199 @@
+"""
+鑑定のバッチ実行（Streamlit を使わないコマンドライン版）。
+
+トーク履歴のフォルダとマニフェスト（CSV または JSON）を受け取り、1行につき1件の鑑定を行って
+PDF を出力し、画面から鑑定したときと同じ履歴（data/history.sqlite3）に記録します。
+
+    python batch.py exports/ manifest.csv --output-dir out/ --concurrency 4 --rate-limit 30
+
+マニフェストの列: file, your_name, partner_name, character, tone, counseling_text, user_id
+（character / tone / counseling_text / user_id は省略可）。
+トーク履歴の解析・温度グラフの描画・PDF作成はプロセスプールで、Gemini への依頼はスレッドで並行して行い、
+依頼の間隔は --rate-limit（1分あたりの回数）で制限します。
+--backend stub:http://127.0.0.1:8765 を付けると、Gemini の代わりに llm_stub_server.py に依頼します（負荷試験用）。
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from charts import PRINT_DPI, graph_colors, render_temperature_png
+from chat_analytics import compute_conversation_stats, format_conversation_stats
+from context_selector import CONTEXT_TOKEN_BUDGET, TokenEstimator, select_context
+from history_store import HistoryStore
+from import_profile import timed_import
+from llm_backend import BACKEND_ENV_VAR, create_backend
+from line_chat import MessageStore
+from llm_retry import RateLimiter, generate_with_fallback
+from prompt_builder import build_prompt
+from report_generation import GENERATION_CONFIG, MODEL_CANDIDATES, SAFETY_SETTINGS
+from report_parser import parse_report
+from response_cache import ResponseCache, make_cache_key
+from temperature import calculate_temperature
+
+logger = logging.getLogger("batch")
+
+DEFAULT_CHARACTER = "1. 優しく包み込む、お姉さん系"
+DEFAULT_TONE = "癒し 50% × 論理 50%"
+DEFAULT_USER_ID = "batch"
+REQUIRED_COLUMNS = ("file", "your_name", "partner_name")
+API_KEY_ENV_VARS = ("GEMINI_API_KEY", "GOOGLE_API_KEY")
+
+
+def load_manifest(path):
+    """マニフェストを読み込み、鑑定1件ごとの辞書のリストを返します。必須の列が無い行があれば ValueError。"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        entries = json.load(f) if path.lower().endswith(".json") else list(csv.DictReader(f))
+    for i, entry in enumerate(entries, 1):
+        missing = [column for column in REQUIRED_COLUMNS if not (entry.get(column) or "").strip()]
+        if missing: raise ValueError(f"マニフェストの{i}件目に {', '.join(missing)} がありません。")
+        entry.setdefault("character", ""); entry.setdefault("tone", ""); entry.setdefault("counseling_text", "")
+        entry["character"] = entry["character"] or DEFAULT_CHARACTER
+        entry["tone"] = entry["tone"] or DEFAULT_TONE
+        entry["user_id"] = entry.get("user_id") or None
+    return entries
+
+
+def analyze_export(path, character):
+    """
+    （プロセスプールで実行）トーク履歴を読み込んで解析し、温度・会話の数値データと印刷用グラフまで用意します。
+    戻り値の辞書は pickle してメインプロセスに返します。
+    """
+    with open(path, "rb") as f: messages, encoding = MessageStore.from_export(f.read())
+    if messages is None: raise ValueError("ファイルの文字コードを判定できませんでした。")
+    if not messages: raise ValueError("有効なメッセージが見つかりませんでした。")
+    temp_data, trend = calculate_temperature(messages)
+    chart = render_temperature_png(temp_data, *graph_colors(character), PRINT_DPI)
+    return {"messages": messages, "encoding": encoding, "temp_data": temp_data, "trend": trend, "chart": chart,
+            "conversation_stats": compute_conversation_stats(messages)}
+
+
+def render_pdf(report, chart, character, output_path):
+    """
+    （プロセスプールで実行）解析済みのレポート（ReportDocument）から鑑定書PDFを作って書き出し、そのパスを返します。
+    フォントは各プロセスで最初の1件のときだけ読み込み、以降は使い回します。
+    """
+    return timed_import("pdf_report").write_pdf(report, chart, character, output_path)
+
+
+class BatchRunner:
+    """解析結果を受け取り、Gemini への依頼・履歴の保存・PDF作成の依頼までを1件ずつ行います。"""
+
+    def __init__(self, backend, model_name, data_dir, output_dir, pool, rate_limiter, use_cache=True):
+        self.backend = backend
+        self.model_name = model_name
+        self.candidates = [model_name] + [m for m in MODEL_CANDIDATES if m != model_name]
+        self.history_store = HistoryStore(data_dir)
+        self.response_cache = ResponseCache(data_dir) if use_cache else None
+        self.output_dir = output_dir
+        self.pool = pool
+        self.rate_limiter = rate_limiter
+        self._token_ratio = None
+        self._token_ratio_lock = threading.Lock()
+
+    def _estimator(self, messages):
+        """count_tokens での補正は最初の1件で1回だけ行い、以降は同じ係数を使います。"""
+        with self._token_ratio_lock:
+            if self._token_ratio is None:
+                sample = "\n".join(messages.iter_lines(max(0, len(messages) - 100)))
+                try:
+                    self.rate_limiter.acquire()
+                    self._token_ratio = TokenEstimator().calibrate(sample, lambda t: self.backend.count_tokens(self.model_name, t))
+                except Exception: self._token_ratio = 1.0
+            return TokenEstimator(self._token_ratio)
+
+    def diagnose(self, index, entry, analysis):
+        """1件分の鑑定を行い、結果の辞書を返します。PDF は pdf_future に作成中の Future が入ります。"""
+        started = time.perf_counter()
+        user_id = entry["user_id"] or DEFAULT_USER_ID
+        previous_data = self.history_store.latest(user_id, entry["partner_name"])
+        context = select_context(analysis["messages"], CONTEXT_TOKEN_BUDGET, self._estimator(analysis["messages"]))
+        prompt = build_prompt(entry["character"], entry["tone"], entry["your_name"], entry["partner_name"], entry["counseling_text"],
+                              context["recent"], context["digest"], analysis["trend"], previous_data,
+                              conversation_stats=format_conversation_stats(analysis["conversation_stats"]))
+
+        cache_key = make_cache_key(prompt, self.model_name, GENERATION_CONFIG, SAFETY_SETTINGS)
+        ai_response_text = self.response_cache.get(cache_key) if self.response_cache else None
+        used_model, attempts = self.model_name, []
+        if not ai_response_text:
+            def generate_once(candidate, on_text):
+                self.rate_limiter.acquire()
+                return self.backend.generate(candidate, prompt, GENERATION_CONFIG, SAFETY_SETTINGS)
+            used_model, generated, attempts = generate_with_fallback(self.candidates, generate_once)
+            ai_response_text = generated[0]
+            if not ai_response_text: raise ValueError("AIからの応答がブロックされたか、内容が空でした。")
+            if self.response_cache: self.response_cache.put(cache_key, self.model_name, ai_response_text)
+
+        report = parse_report(ai_response_text)
+        pulse_score = report.pulse_score
+        history_id = self.history_store.save(user_id, entry["partner_name"], pulse_score or 0, report.summary)
+        output_path = os.path.join(self.output_dir, f"{index:03d}_{os.path.splitext(os.path.basename(entry['file']))[0]}.pdf")
+        pdf_future = self.pool.submit(render_pdf, report, analysis["chart"], entry["character"], output_path)
+        return {"file": entry["file"], "partner_name": entry["partner_name"], "model": used_model,
+                "attempts": len(attempts), "from_cache": not attempts, "pulse_score": pulse_score,
+                "history_id": history_id, "seconds": round(time.perf_counter() - started, 2), "pdf_future": pdf_future}
+
+
+def run_batch(args, backend):
+    entries = load_manifest(args.manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = [{"file": entry["file"], "partner_name": entry["partner_name"], "status": "error"} for entry in entries]
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool, ThreadPoolExecutor(max_workers=args.concurrency) as threads:
+        analyses = [pool.submit(analyze_export, os.path.join(args.export_dir, entry["file"]), entry["character"]) for entry in entries]
+        runner = BatchRunner(backend, args.model, args.data_dir, args.output_dir, pool,
+                             RateLimiter(args.rate_limit), use_cache=not args.no_cache)
+
+        def diagnose_when_ready(index, entry, analysis_future):
+            return runner.diagnose(index, entry, analysis_future.result())
+
+        diagnoses = [threads.submit(diagnose_when_ready, i, entry, future)
+                     for i, (entry, future) in enumerate(zip(entries, analyses), 1)]
+        for result, future in zip(results, diagnoses):
+            try:
+                diagnosis = future.result()
+                diagnosis["pdf"] = diagnosis.pop("pdf_future").result()
+                result.update(diagnosis, status="ok")
+                logger.info("%s: 脈あり度 %s%% → %s", result["file"], diagnosis["pulse_score"], diagnosis["pdf"])
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+                logger.error("%s: 失敗しました (%s)", result["file"], result["error"])
+
+    with open(os.path.join(args.output_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="恋のオラクルの鑑定をまとめて実行します")
+    parser.add_argument("export_dir", help="トーク履歴（.txt）を置いたフォルダ")
+    parser.add_argument("manifest", help="鑑定内容のマニフェスト（.csv または .json）")
+    parser.add_argument("--output-dir", default="batch_output", help="PDF と results.json の出力先")
+    parser.add_argument("--data-dir", default="data", help="履歴・キャッシュの保存先（画面版と同じ data を共有できます）")
+    parser.add_argument("--api-key", default=next((os.environ[v] for v in API_KEY_ENV_VARS if os.environ.get(v)), None),
+                        help=f"Gemini APIキー（省略時は環境変数 {' / '.join(API_KEY_ENV_VARS)}）")
+    parser.add_argument("--model", default=MODEL_CANDIDATES[0])
+    parser.add_argument("--backend", help=f"gemini / stub / stub:http://host:port（省略時は環境変数 {BACKEND_ENV_VAR}、無ければ gemini）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="解析・PDF作成のプロセス数")
+    parser.add_argument("--concurrency", type=int, default=4, help="Gemini への同時依頼数")
+    parser.add_argument("--rate-limit", type=float, default=30, help="Gemini への1分あたりの依頼回数の上限（0 で無制限）")
+    parser.add_argument("--no-cache", action="store_true", help="保存済みの鑑定結果を使わず、すべて新しく鑑定する")
+    args = parser.parse_args(argv)
+    backend = create_backend(args.api_key, args.backend)
+    if backend.requires_api_key and not args.api_key: parser.error("Gemini APIキーを --api-key か環境変数で指定してください。")
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    for name in ("batch", "llm_retry"): logging.getLogger(name).setLevel(logging.INFO)  # フォント処理などの細かいログは出さない
+    results = run_batch(args, backend)
+    failed = sum(1 for result in results if result["status"] != "ok")
+    logger.info("%d件中 %d件が完了しました。", len(results), len(results) - failed)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
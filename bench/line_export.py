@@ -0,0 +1,62 @@
+"""
+ベンチマーク用の、それらしい LINE トーク履歴エクスポートを作る生成器。
+
+日付ヘッダ・タブ区切りのメッセージ・複数行メッセージの続き・[写真]/[スタンプ] などの
+プレースホルダーを含み、UTF-8 / UTF-8(BOM付き) / Shift_JIS(cp932) で出力できます。
+乱数の種を固定すれば、毎回まったく同じデータになります。
+"""
+import random
+from datetime import date, timedelta
+
+SENDERS = ("さくら", "たくや")
+SHORT_MESSAGES = ("おはよう！", "おやすみ〜", "うん", "了解です", "ありがとう！", "え、ほんと？", "笑", "今日は楽しかった!!",
+                  "また明日ね", "お疲れさま", "今なにしてる？", "それいいね✨", "わかる〜😂😂😂")
+LONG_MESSAGES = ("今日の帰り道にすごく綺麗な夕焼けを見たよ。写真撮ろうと思ったけど間に合わなかった",
+                 "この前話してたお店、予約取れたから来週の土曜日に行ってみない？駅から少し歩くけど雰囲気いいらしい",
+                 "最近ちょっと仕事が忙しくて返信遅くなっちゃってごめんね。落ち着いたらゆっくり電話したいな")
+CONTINUATIONS = ("あと、これも伝えたかった", "追伸：体調気をつけてね", "詳しくはまた話すね！")
+PLACEHOLDERS = ("[写真]", "[スタンプ]", "[動画]", "[ファイル]")
+WEEKDAYS = "月火水木金土日"
+ENCODINGS = {"utf-8": "utf-8", "utf-8-sig": "utf-8-sig", "shift_jis": "cp932"}
+
+
+def iter_export_lines(n_lines, seed=0, start=date(2021, 4, 1), messages_per_day=(5, 60)):
+    """ちょうど n_lines 行のトーク履歴を1行ずつ返します（改行は含まない）。"""
+    rng = random.Random(seed)
+    header = ["[LINE] さくらとのトーク履歴", f"保存日時：{start:%Y/%m/%d} 00:00", ""]
+    emitted = 0
+    for line in header:
+        if emitted >= n_lines: return
+        yield line
+        emitted += 1
+    day = start
+    while emitted < n_lines:
+        yield f"{day:%Y/%m/%d}({WEEKDAYS[day.weekday()]})"
+        emitted += 1
+        minute = rng.randint(6 * 60, 9 * 60)
+        for _ in range(rng.randint(*messages_per_day)):
+            if emitted >= n_lines: return
+            minute = min(minute + rng.randint(0, 40), 23 * 60 + 59)
+            roll = rng.random()
+            if roll < 0.12: body = rng.choice(PLACEHOLDERS)
+            elif roll < 0.27: body = rng.choice(LONG_MESSAGES)
+            else: body = rng.choice(SHORT_MESSAGES)
+            yield f"{minute // 60:02d}:{minute % 60:02d}\t{rng.choice(SENDERS)}\t{body}"
+            emitted += 1
+            if rng.random() < 0.05 and emitted < n_lines:
+                yield rng.choice(CONTINUATIONS)
+                emitted += 1
+        day += timedelta(days=rng.randint(1, 2))
+
+
+def make_export_text(n_lines, seed=0):
+    """トーク履歴を文字列で返します（貼り付け入力の想定）。"""
+    return "\n".join(iter_export_lines(n_lines, seed)) + "\n"
+
+
+def make_export_bytes(n_lines, encoding="utf-8", seed=0):
+    """
+    トーク履歴をファイルのバイト列で返します。encoding は ENCODINGS のキーのいずれか。
+    Shift_JIS で表せない絵文字は、古い端末のエクスポートと同じく「?」になります。
+    """
+    return make_export_text(n_lines, seed).encode(ENCODINGS[encoding], errors="replace")
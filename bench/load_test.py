@@ -0,0 +1,75 @@
+"""
+スタブのAI（llm_stub_server）を相手に、鑑定パイプライン全体をオフラインで並行実行する負荷試験。
+
+合成したトーク履歴を batch.py と同じ処理（解析 → 会話選択 → 生成 → 履歴保存 → PDF作成）に流し、
+全体のスループットと1件あたりの所要時間の分布を表示します。APIキーもクォータも使いません。
+
+    python bench/load_test.py --readings 40 --concurrency 8 --latency 2.0 --error-rate 0.05
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from batch import run_batch  # noqa: E402
+from bench.line_export import make_export_bytes  # noqa: E402
+from llm_backend import StubBackend  # noqa: E402
+from llm_stub_server import StubConfig, server_url, start_server  # noqa: E402
+from stage_metrics import percentile  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スタブのAIを使った鑑定パイプラインの負荷試験")
+    parser.add_argument("--readings", type=int, default=20, help="鑑定の件数")
+    parser.add_argument("--lines", type=int, default=5000, help="トーク履歴1件あたりの行数")
+    parser.add_argument("--concurrency", type=int, default=8, help="AIへの同時依頼数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="解析・PDF作成のプロセス数")
+    parser.add_argument("--rate-limit", type=float, default=0, help="1分あたりの依頼回数の上限（0 で無制限）")
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    config = StubConfig(args.latency, args.jitter, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    server = start_server(config)
+    with tempfile.TemporaryDirectory() as work_dir:
+        export_dir = os.path.join(work_dir, "exports")
+        os.makedirs(export_dir)
+        manifest_path = os.path.join(work_dir, "manifest.csv")
+        with open(manifest_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "your_name", "partner_name", "user_id"])
+            for i in range(args.readings):
+                file_name = f"talk_{i:04d}.txt"
+                with open(os.path.join(export_dir, file_name), "wb") as export:
+                    export.write(make_export_bytes(args.lines, seed=args.seed + i))
+                writer.writerow([file_name, "さくら", f"お相手{i}", f"load-test-{i}"])
+
+        batch_args = argparse.Namespace(
+            manifest=manifest_path, export_dir=export_dir, output_dir=os.path.join(work_dir, "out"),
+            data_dir=os.path.join(work_dir, "data"), model=config.models[0], workers=args.workers,
+            concurrency=args.concurrency, rate_limit=args.rate_limit, no_cache=True)
+        started = time.perf_counter()
+        results = run_batch(batch_args, StubBackend(server_url(server)))
+        elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    ok = [result for result in results if result["status"] == "ok"]
+    seconds = sorted(result["seconds"] for result in ok)
+    print(f"readings: {len(ok)}/{len(results)} ok in {elapsed:.1f}s ({len(ok) / elapsed * 60:.1f} readings/min)")
+    if seconds:
+        print("per reading: " + ", ".join(f"p{int(q * 100)} {percentile(seconds, q):.2f}s" for q in (0.5, 0.95, 0.99)))
+    print(f"stub: {config.stats}, retries: {sum(result.get('attempts', 1) - 1 for result in ok)}")
+    return 0 if len(ok) == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
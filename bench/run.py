@@ -0,0 +1,156 @@
+"""
+ホットパスのベンチマーク。
+
+合成した LINE トーク履歴で、読み込み・温度計算・会話の数値データの集計・プロンプト用の会話選択・脈あり度の読み取り・
+PDF作成の時間（N回中の最速）とメモリのピーク（tracemalloc）を測り、JSON に保存します。
+--compare で過去の結果と比べ、しきい値を超えて遅く（または重く）なったものがあれば終了コード1で終わります。
+
+    python bench/run.py --sizes 1000 100000 --output bench/baseline.json
+    python bench/run.py --sizes 1000 100000 --compare bench/baseline.json --threshold 0.2
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.line_export import ENCODINGS, make_export_bytes, make_export_text  # noqa: E402
+from chat_analytics import compute_conversation_stats  # noqa: E402
+from context_selector import select_context  # noqa: E402
+from line_chat import MessageStore, parse_line_chat  # noqa: E402
+from report_parser import parse_pulse_score, parse_report  # noqa: E402
+from temperature import calculate_temperature  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+BENCH_CHARACTER = "1. 優しく包み込む、お姉さん系"
+PDF_MAX_LINES = 10000  # PDF はサイズに依存しないので小さいデータでだけ測る
+PDF_BULK_REPORTS = 8
+PDF_CASES = ("create_pdf", f"create_pdf_files_x{PDF_BULK_REPORTS}")
+SAMPLE_REPORT = """# 💖 二人の恋愛鑑定書 💖
+
+## 【総合脈あり度】: **78%**
+
+### 📊 会話の温度感
+最近の二人はメッセージのやりとりがとても活発で、相手からの質問も増えています。
+
+### 🔮 これからのアドバイス
+次の週末に、前から話していたお店へ誘ってみましょう。相手もきっと楽しみにしています。
+""" * 3
+
+
+def measure(fn, repeat):
+    """fn() を repeat 回実行して最速の秒数を、もう1回 tracemalloc 下で実行してピークのバイト数を返します。"""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def bench_cases(n_lines, encoding, only=None):
+    """(名前, 関数) の組を順に返します。入力の準備は計測に含めません。only を渡すと、PDF 用のグラフは要るときだけ作ります。"""
+    raw = make_export_bytes(n_lines, encoding)
+    text = make_export_text(n_lines)
+    store = MessageStore.from_source(raw, ENCODINGS[encoding])
+    yield "parse_line_chat", lambda: parse_line_chat(text)
+    yield "message_store_from_bytes", lambda: MessageStore.from_source(raw, ENCODINGS[encoding])
+    yield "message_store_from_export", lambda: MessageStore.from_export(raw, 15)
+    yield "calculate_temperature", lambda: calculate_temperature(store)
+    yield "conversation_stats", lambda: compute_conversation_stats(store)
+    # 旧 smart_extract_text / create_long_term_summary は select_context に置き換わっている
+    yield "select_context", lambda: select_context(store)
+    yield "parse_pulse_score", lambda: parse_pulse_score(SAMPLE_REPORT)
+    yield "parse_report", lambda: parse_report(SAMPLE_REPORT)
+    if n_lines <= PDF_MAX_LINES and (not only or any(name in only for name in PDF_CASES)):
+        try:
+            from pdf_report import create_pdf, create_pdf_files
+            png = _render_chart(store)
+        except ImportError:  # matplotlib / fpdf が入っていない環境では PDF のベンチを飛ばす
+            png = None
+        if png is not None:
+            report = parse_report(SAMPLE_REPORT)
+            yield "create_pdf", lambda: create_pdf(report, png, BENCH_CHARACTER)
+            # 一括作成（プロセスの起動とフォントの読み込みを含む。メモリのピークは親プロセスの分だけ）
+            with tempfile.TemporaryDirectory() as output_dir:
+                jobs = [(report, png, BENCH_CHARACTER, os.path.join(output_dir, f"{i}.pdf")) for i in range(PDF_BULK_REPORTS)]
+                yield f"create_pdf_files_x{PDF_BULK_REPORTS}", lambda: create_pdf_files(jobs)
+
+
+def _render_chart(store):
+    from charts import PRINT_DPI, graph_colors, render_temperature_png
+    temp_data, _ = calculate_temperature(store)
+    if not temp_data: return None
+    line, fill = graph_colors(BENCH_CHARACTER)
+    return render_temperature_png(temp_data, line, fill, PRINT_DPI)
+
+
+def run(sizes, encodings, repeat, only=None):
+    results = {}
+    for encoding in encodings:
+        for n_lines in sizes:
+            for name, fn in bench_cases(n_lines, encoding, only):
+                if only and name not in only: continue
+                key = f"{name}[{encoding},{n_lines}]"
+                results[key] = measure(fn, repeat)
+                print(f"{key:<48} {results[key]['seconds'] * 1000:10.2f} ms  {results[key]['peak_bytes'] / 1024 / 1024:8.2f} MiB",
+                      flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """baseline より threshold（割合）以上悪化した項目のリストを返します。"""
+    regressions = []
+    for key, current in results.items():
+        before = baseline.get(key)
+        if before is None: continue
+        for metric in ("seconds", "peak_bytes"):
+            if before[metric] > 0 and current[metric] > before[metric] * (1 + threshold):
+                regressions.append((key, metric, before[metric], current[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="恋愛鑑定のホットパスのベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="トーク履歴の行数（1000〜2000000）")
+    parser.add_argument("--encodings", nargs="+", default=["utf-8"], choices=sorted(ENCODINGS))
+    parser.add_argument("--repeat", type=int, default=3, help="時間は repeat 回中の最速を採用")
+    parser.add_argument("--only", nargs="+", help="指定した名前のベンチマークだけ実行")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--compare", help="比較するベースラインの JSON ファイル")
+    parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす割合（0.2 = 20%%）")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.encodings, args.repeat, args.only)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, ensure_ascii=False, indent=2)
+    if not args.compare: return 0
+
+    with open(args.compare, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for key, metric, before, after in regressions:
+        print(f"REGRESSION {key} {metric}: {before:.6g} -> {after:.6g} (+{(after / before - 1) * 100:.0f}%)")
+    if not regressions: print(f"ベースラインとの差はしきい値 {args.threshold:.0%} 以内です。")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
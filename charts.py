@@ -0,0 +1,81 @@
+"""
+恋の温度グラフの描画（画面用・印刷用のPNGを作る）。
+
+pyplot のグローバル状態を使わず Figure を直接作るので、別スレッドや別プロセスからも安全に呼べます。
+matplotlib は描画する時に初めて読み込みます。
+"""
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+
+from import_profile import timed_import
+
+SCREEN_DPI = 100
+PRINT_DPI = 300
+GRAPH_COLOR_MAP = {
+    "1. 優しく包み込む、お姉さん系": ("#ff69b4", "#ffb6c1"),
+    "2. ロジカルに鋭く分析する、専門家系": ("#1e90ff", "#add8e6"),
+    "3. 星の言葉で語る、ミステリアスな占い師系": ("#9370db", "#e6e6fa"),
+}
+DEFAULT_GRAPH_COLORS = ("#ff69b4", "#ffb6c1")
+
+
+def graph_colors(character):
+    """鑑定師キャラクターに合わせた (線の色, 塗りの色) を返します。"""
+    return GRAPH_COLOR_MAP.get(character, DEFAULT_GRAPH_COLORS)
+
+
+def temperature_data_hash(temp_data):
+    """温度データ {'labels', 'values'} の内容ハッシュを返します（描画キャッシュのキー用）。"""
+    payload = json.dumps([temp_data.get('labels', []), temp_data.get('values', [])], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def render_temperature_png(temp_data, line_color, fill_color, dpi):
+    """温度グラフを描画し、指定 dpi の PNG バイト列を返します。"""
+    timed_import("japanize_matplotlib")  # 日本語フォントを matplotlib に登録する
+    Figure = timed_import("matplotlib.figure").Figure
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    if temp_data.get('labels'):
+        ax.plot(temp_data['labels'], temp_data['values'], marker='o', color=line_color, linewidth=2)
+        ax.fill_between(temp_data['labels'], temp_data['values'], color=fill_color, alpha=0.5)
+        for tick_label in ax.get_xticklabels():
+            tick_label.set_rotation(45)
+            tick_label.set_horizontalalignment("right")
+    ax.set_title('二人の恋の温度グラフ', fontsize=14, pad=20)
+    fig.tight_layout()
+    img_buffer = io.BytesIO()
+    fig.savefig(img_buffer, format='png', dpi=dpi, bbox_inches='tight')
+    return img_buffer.getvalue()
+
+
+class ChartCache:
+    """
+    描画済みPNGを (温度データのハッシュ, 線の色, 塗りの色, dpi) ごとに保持するLRUキャッシュ。
+    スレッドセーフなので、画面表示とバックグラウンドの鑑定処理から共有できます。
+    metrics（StageMetrics）を渡すと、実際に描画したときだけ所要時間を chart_render として記録します。
+    """
+
+    def __init__(self, max_entries=32, metrics=None):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, temp_hash, temp_data, line_color, fill_color, dpi):
+        key = (temp_hash, line_color, fill_color, dpi)
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                return png
+        if self.metrics is None: png = render_temperature_png(temp_data, line_color, fill_color, dpi)
+        else:
+            with self.metrics.span("chart_render", dpi=dpi): png = render_temperature_png(temp_data, line_color, fill_color, dpi)
+        with self._lock:
+            self._entries[key] = png
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return png
@@ -0,0 +1,138 @@
+"""
+会話の数値データ（送信者ごと）のローカル集計。
+
+返信までの時間の分布・質問の多さと質問返し・絵文字や「!」の多さ・メッセージの長さの変化・
+会話を始めた割合を、MessageStore の配列から NumPy でまとめて求めます（本文は1回なめるだけ）。
+AIに生の会話から推測させる代わりに、format_conversation_stats() の短い文章をプロンプトに入れます。
+Streamlit には依存しません。
+"""
+import numpy as np
+
+from context_selector import QUESTION_MARKS
+from line_chat import NO_TIMESTAMP
+
+EXCLAMATION_MARKS = ('!', '！')
+EMOJI_RANGES = ((0x1F300, 0x1FAFF), (0x2600, 0x27BF))  # context_selector.EMOJI_PATTERN と同じ範囲
+SIGNAL_CHUNK_CHARS = 1 << 20  # 本文を数値の配列にして数えるときの1回分の文字数（一時的に4倍のバイト数を使う）
+CONVERSATION_GAP_SECONDS = 6 * 3600  # これ以上間が空いたら、次のメッセージを「会話を始めた」とみなす
+MAX_SENDERS = 4  # グループトークでは発言の多い順にこの人数まで
+TREND_FRACTION = 3  # 長さの変化は、各送信者の最初と最後の 1/3 ずつを比べる
+
+
+def _signal_counts(text, offsets):
+    """
+    メッセージごとの「?」「!」絵文字の個数を (3, メッセージ数) の配列で返します。
+    本文を区切りごとに UTF-32 の数値の配列にして比べるので、文字ごとの Python の処理はありません。
+    """
+    n = offsets.size - 1
+    hits = ([], [], [])
+    begin, end = int(offsets[0]), int(offsets[-1])
+    for chunk_start in range(begin, end, SIGNAL_CHUNK_CHARS):
+        chunk = text[chunk_start:min(chunk_start + SIGNAL_CHUNK_CHARS, end)]
+        codes = np.frombuffer(chunk.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        masks = (np.isin(codes, [ord(c) for c in QUESTION_MARKS]), np.isin(codes, [ord(c) for c in EXCLAMATION_MARKS]),
+                 np.logical_or.reduce([(codes >= low) & (codes <= high) for low, high in EMOJI_RANGES]))
+        for kind, mask in enumerate(masks): hits[kind].append(np.flatnonzero(mask) + chunk_start)
+    counts = np.zeros((3, n), dtype=np.int64)
+    for kind, positions in enumerate(hits):
+        positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+        if positions.size: counts[kind] = np.bincount(np.searchsorted(offsets, positions, side='right') - 1, minlength=n)
+    return counts
+
+
+def compute_conversation_stats(messages, start=0):
+    """
+    messages[start:] の送信者ごとの数値データを返します（メッセージが無ければ None）。
+    戻り値: {"messages", "conversations", "senders": [送信者ごとの辞書（件数の多い順）]}
+    返信は「相手の発言の直後の、別の送信者の最初のメッセージ」として数え、時間は分単位です。
+    """
+    n = len(messages) - start
+    if n <= 0: return None
+    offsets = np.frombuffer(messages.offsets, dtype=np.uint64)[start:].astype(np.int64)
+    timestamps = np.frombuffer(messages.timestamps, dtype=np.int64)[start:]
+    sender_ids = np.frombuffer(messages.sender_ids, dtype=np.uint32)[start:].astype(np.int64)
+    n_senders = max(len(messages.senders), 1)
+
+    questions, exclamations, emojis = _signal_counts(messages.text, offsets)
+    lengths = np.diff(offsets)
+
+    # 送信者が切り替わるところで区切った「ターン」ごとに、返信・質問返し・会話の開始を見る
+    turn_starts = np.flatnonzero(np.r_[True, sender_ids[1:] != sender_ids[:-1]])
+    turn_ids = np.cumsum(np.r_[True, sender_ids[1:] != sender_ids[:-1]]) - 1
+    turn_senders = sender_ids[turn_starts]
+    turn_has_question = np.bincount(turn_ids, weights=questions > 0, minlength=turn_starts.size) > 0
+    replies = turn_starts[1:]  # 2つ目以降のターンの先頭 = 返信
+    prev_ends = replies - 1
+    timed = (timestamps[replies] != NO_TIMESTAMP) & (timestamps[prev_ends] != NO_TIMESTAMP)
+    latencies = (timestamps[replies] - timestamps[prev_ends])[timed]
+    latency_senders = turn_senders[1:][timed]
+    asked = turn_has_question[:-1]
+    asked_back = turn_has_question[1:][asked]
+    asked_back_senders = turn_senders[1:][asked]
+
+    valid = timestamps != NO_TIMESTAMP
+    valid_ts, valid_senders = timestamps[valid], sender_ids[valid]
+    starts = np.r_[True, np.diff(valid_ts) >= CONVERSATION_GAP_SECONDS] if valid_ts.size else np.zeros(0, dtype=bool)
+    initiations = np.bincount(valid_senders[starts], minlength=n_senders)
+
+    counts = np.bincount(sender_ids, minlength=n_senders)
+    senders = []
+    for sid in np.argsort(-counts, kind='stable')[:MAX_SENDERS]:
+        count = int(counts[sid])
+        if count == 0: break
+        mine = sender_ids == sid
+        own_lengths = lengths[mine]
+        edge = max(own_lengths.size // TREND_FRACTION, 1)
+        early, recent = float(own_lengths[:edge].mean()), float(own_lengths[-edge:].mean())
+        own_latencies = latencies[latency_senders == sid] / 60
+        own_asked_back = asked_back[asked_back_senders == sid]
+        senders.append({
+            "name": messages.senders[sid],
+            "messages": count,
+            "share": round(count / n, 3),
+            "avg_length": round(float(own_lengths.mean()), 1),
+            "early_length": round(early, 1),
+            "recent_length": round(recent, 1),
+            "question_rate": round(float((questions[mine] > 0).mean()), 3),
+            "question_back_rate": round(float(own_asked_back.mean()), 3) if own_asked_back.size else None,
+            "exclamation_per_message": round(float(exclamations[mine].mean()), 2),
+            "emoji_per_message": round(float(emojis[mine].mean()), 2),
+            "replies": int(own_latencies.size),
+            "reply_minutes": {
+                "median": round(float(np.median(own_latencies)), 1),
+                "p75": round(float(np.percentile(own_latencies, 75)), 1),
+                "p90": round(float(np.percentile(own_latencies, 90)), 1),
+                "within_hour": round(float((own_latencies <= 60).mean()), 3),
+            } if own_latencies.size else None,
+            "initiation_rate": round(float(initiations[sid] / starts.sum()), 3) if starts.any() else None,
+        })
+    return {"messages": n, "conversations": int(starts.sum()), "senders": senders}
+
+
+def _duration(minutes):
+    if minutes < 60: return f"{minutes:.0f}分"
+    if minutes < 24 * 60: return f"{minutes / 60:.1f}時間"
+    return f"{minutes / 60 / 24:.1f}日"
+
+
+def _percent(rate):
+    return "-" if rate is None else f"{rate * 100:.0f}%"
+
+
+def format_conversation_stats(stats):
+    """compute_conversation_stats() の結果を、プロンプトに入れる短い箇条書きにします。"""
+    if not stats: return ""
+    lines = [f"（対象 {stats['messages']:,}件・会話のまとまり {stats['conversations']:,}回。"
+             f"返信は相手の発言の直後のメッセージ、会話の始まりは{CONVERSATION_GAP_SECONDS // 3600}時間以上空いた後の最初の発言）"]
+    for s in stats["senders"]:
+        reply = s["reply_minutes"]
+        reply_text = (f"返信まで 中央値{_duration(reply['median'])}・75%が{_duration(reply['p75'])}以内・90%が{_duration(reply['p90'])}以内"
+                      f"（1時間以内 {_percent(reply['within_hour'])}）" if reply else "返信までの時間 -")
+        change = (s["recent_length"] - s["early_length"]) / s["early_length"] if s["early_length"] else 0.0
+        lines.append(
+            f"- {s['name']}: {s['messages']:,}件（{_percent(s['share'])}） / {reply_text} / "
+            f"質問を含む {_percent(s['question_rate'])}・質問返し {_percent(s['question_back_rate'])} / "
+            f"1通あたり 絵文字{s['emoji_per_message']}個・「!」{s['exclamation_per_message']}個 / "
+            f"平均{s['avg_length']:.0f}文字（初期{s['early_length']:.0f}→最近{s['recent_length']:.0f}文字、{change * 100:+.0f}%） / "
+            f"会話を始めた割合 {_percent(s['initiation_rate'])}")
+    return "\n".join(lines)
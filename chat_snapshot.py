@@ -0,0 +1,197 @@
+"""
+トーク履歴のスナップショット（前回の鑑定のときの解析結果）と、続きの部分だけの解析。
+
+同じお相手とのトーク履歴は、書き足されたものが1〜2週間おきにアップロードされます。
+鑑定を履歴に保存するたびに (user_id, partner_name) ごとに、解析済みのメッセージ（最後の日付より前の分）・
+温度スコア・元のバイト列の指紋を保存しておき、次のアップロードが前回の続きなら、
+最後の日付の見出しから後ろだけを解析してつなげます（load_with_snapshot）。
+スナップショットは鑑定履歴の記録ID（history_id）にひも付けて保存し、前回の鑑定以降のメッセージが
+どこから始まるか（new_messages_start）もここから求めます。Streamlit には依存しません。
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+
+from line_chat import MessageStore, read_preview
+from temperature import message_scores
+
+DB_FILE_NAME = "snapshots.sqlite3"
+LOCK_TIMEOUT_SECONDS = 10
+DEFAULT_TTL_SECONDS = 180 * 24 * 3600  # 半年使われなかったスナップショットは削除
+# 日付の見出し行の先頭。Shift_JIS / cp932 でも ASCII の部分は同じバイトで、2バイト目が改行や数字になることもない
+DATE_HEADER_PATTERN = re.compile(rb'^\d{4}/\d{2}/\d{2}\(', re.MULTILINE)
+TAIL_SEARCH_BYTES = 256 * 1024  # 最後の日付の見出しを探すとき、末尾から見る範囲（見つからなければ広げる）
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    user_id TEXT NOT NULL,
+    partner_name TEXT NOT NULL,
+    history_id INTEGER,
+    created_at REAL NOT NULL,
+    encoding TEXT NOT NULL,
+    prefix_start INTEGER NOT NULL,
+    cut_offset INTEGER NOT NULL,
+    prefix_hash TEXT NOT NULL,
+    tail_header BLOB NOT NULL,
+    message_count INTEGER NOT NULL,
+    last_timestamp INTEGER NOT NULL,
+    senders TEXT NOT NULL,
+    timestamps BLOB NOT NULL,
+    sender_ids BLOB NOT NULL,
+    offsets BLOB NOT NULL,
+    text TEXT NOT NULL,
+    scores BLOB NOT NULL,
+    PRIMARY KEY (user_id, partner_name)
+);
+CREATE INDEX IF NOT EXISTS idx_snapshots_created_at ON snapshots (created_at);
+"""
+INFO_COLUMNS = ("history_id", "created_at", "message_count", "last_timestamp")
+
+
+class ChatSnapshot:
+    """
+    前回の鑑定のときのトーク履歴。
+    - prefix_start / cut_offset: 元のバイト列での最初と最後の日付の見出しの位置。prefix_hash はその間の SHA-256
+    - tail_header: 最後の日付の見出し行（次のアップロードの同じ位置にあるか確かめる）
+    - base: 最後の日付より前のメッセージ（MessageStore）、base_scores: その温度スコア
+    - message_count / last_timestamp: 鑑定のときに読んだメッセージの件数と、最後のメッセージの日時
+    """
+
+    def __init__(self, user_id, partner_name, history_id, encoding, prefix_start, cut_offset, prefix_hash, tail_header,
+                 base, base_scores, message_count, last_timestamp, created_at=None):
+        self.user_id = user_id
+        self.partner_name = partner_name
+        self.history_id = history_id
+        self.encoding = encoding
+        self.prefix_start = prefix_start
+        self.cut_offset = cut_offset
+        self.prefix_hash = prefix_hash
+        self.tail_header = tail_header
+        self.base = base
+        self.base_scores = base_scores
+        self.message_count = message_count
+        self.last_timestamp = last_timestamp
+        self.created_at = created_at or time.time()
+
+
+def _find_date_headers(view):
+    """最初と最後の日付の見出しの位置を返します。見出しが無ければ None。"""
+    first = DATE_HEADER_PATTERN.search(view)
+    if first is None: return None
+    window = TAIL_SEARCH_BYTES
+    while True:
+        start, last = max(first.start(), len(view) - window), None
+        for last in DATE_HEADER_PATTERN.finditer(view, start): pass
+        if last is not None or start == first.start(): return first.start(), (last or first).start()
+        window *= 4
+
+
+def _header_line(view, offset):
+    return bytes(view[offset:offset + 64]).split(b'\n', 1)[0].rstrip(b'\r')
+
+
+def make_snapshot(raw_data, encoding, messages, scores, user_id, partner_name, history_id):
+    """
+    解析済みのトーク履歴からスナップショットを作ります。最後の日付の見出しより後ろは次回に解析し直すので、
+    その前までのメッセージだけを持ちます。日付の見出しが無いなど、続きを判定できない履歴なら None。
+    """
+    view = memoryview(raw_data)
+    headers = _find_date_headers(view)
+    if headers is None or not len(messages): return None
+    prefix_start, cut_offset = headers
+    tail = MessageStore.from_source(view[cut_offset:], encoding)
+    base_count = len(messages) - len(tail)
+    # 最後の日付だけを読んだ結果が全体の末尾と一致しなければ（見出しの直後に続きの行があるなど）使わない
+    if base_count < 0 or messages.timestamps[base_count:] != tail.timestamps: return None
+    base = MessageStore.from_columns(messages.timestamps[:base_count], messages.sender_ids[:base_count], messages.senders,
+                                     messages.offsets[:base_count + 1], messages.text[:messages.offsets[base_count]])
+    return ChatSnapshot(user_id, partner_name, history_id, encoding, prefix_start, cut_offset,
+                        hashlib.sha256(view[prefix_start:cut_offset]).hexdigest(), _header_line(view, cut_offset),
+                        base, np.asarray(scores, dtype=np.int64)[:base_count], len(messages), messages.timestamps[-1])
+
+
+def load_with_snapshot(raw_data, snapshot, preview_lines=0):
+    """
+    raw_data が前回のスナップショットの続き（最後の日付の見出しまでが同じ）なら、その見出しから後ろだけを解析して
+    (ストア, 温度スコア) を返します。続きでなければ None を返すので、呼び出し側で全体を解析してください。
+    """
+    view = memoryview(raw_data)
+    first = DATE_HEADER_PATTERN.search(view)
+    if first is None: return None
+    # 先頭の「保存日時」などは毎回変わるので、最初の日付の見出しからの位置で比べる
+    cut_offset = first.start() + snapshot.cut_offset - snapshot.prefix_start
+    if _header_line(view, cut_offset) != snapshot.tail_header: return None
+    if hashlib.sha256(view[first.start():cut_offset]).hexdigest() != snapshot.prefix_hash: return None
+    try: tail = MessageStore.from_source(view[cut_offset:], snapshot.encoding)
+    except UnicodeDecodeError: return None
+    messages = MessageStore.from_columns(snapshot.base.timestamps, snapshot.base.sender_ids, snapshot.base.senders,
+                                         snapshot.base.offsets, snapshot.base.text)
+    messages.extend(tail)
+    if preview_lines: messages.preview = read_preview(view, snapshot.encoding, preview_lines)
+    return messages, np.concatenate([snapshot.base_scores, message_scores(tail)]) if len(tail) else snapshot.base_scores
+
+
+def new_messages_start(messages, message_count, last_timestamp):
+    """前回の鑑定で読んだ最後のメッセージの次の位置を返します。前回の続きだと確かめられなければ None。"""
+    if not 0 < message_count <= len(messages): return None
+    if messages.timestamps[message_count - 1] != last_timestamp: return None
+    return message_count
+
+
+class SnapshotStore:
+    """(user_id, partner_name) ごとに最新のスナップショットを1つ保存します。接続は操作ごとに開くのでスレッドをまたいで使えます。"""
+
+    def __init__(self, data_dir, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.db_path = os.path.join(data_dir, DB_FILE_NAME)
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(data_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def save(self, snapshot):
+        """同じ (user_id, partner_name) のスナップショットは置き換え、古くなったものを削除します。"""
+        base = snapshot.base
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshots (user_id, partner_name, history_id, created_at, encoding, prefix_start, cut_offset,"
+                " prefix_hash, tail_header, message_count, last_timestamp, senders, timestamps, sender_ids, offsets, text, scores)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (snapshot.user_id, snapshot.partner_name, snapshot.history_id, snapshot.created_at, snapshot.encoding,
+                 snapshot.prefix_start, snapshot.cut_offset, snapshot.prefix_hash, snapshot.tail_header,
+                 snapshot.message_count, snapshot.last_timestamp, json.dumps(base.senders, ensure_ascii=False),
+                 base.timestamps.tobytes(), base.sender_ids.tobytes(), base.offsets.tobytes(), base.text,
+                 snapshot.base_scores.tobytes()))
+            conn.execute("DELETE FROM snapshots WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+            conn.execute("COMMIT")
+
+    def load(self, user_id, partner_name):
+        """スナップショットを読み込みます。無ければ None。"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM snapshots WHERE user_id = ? AND partner_name = ?", (user_id, partner_name)).fetchone()
+        if row is None: return None
+        base = MessageStore.from_columns(row["timestamps"], row["sender_ids"], json.loads(row["senders"]), row["offsets"], row["text"])
+        return ChatSnapshot(row["user_id"], row["partner_name"], row["history_id"], row["encoding"], row["prefix_start"],
+                            row["cut_offset"], row["prefix_hash"], row["tail_header"], base,
+                            np.frombuffer(row["scores"], dtype=np.int64), row["message_count"], row["last_timestamp"],
+                            row["created_at"])
+
+    def info(self, user_id, partner_name):
+        """メッセージ本体は読まずに {history_id, created_at, message_count, last_timestamp} だけを返します。無ければ None。"""
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(INFO_COLUMNS)} FROM snapshots WHERE user_id = ? AND partner_name = ?",
+                               (user_id, partner_name)).fetchone()
+        return dict(row) if row else None
@@ -0,0 +1,164 @@
+"""
+プロンプトに入れる会話の選び方（トークン予算つき）。
+
+文字数ではなくモデルのトークン数で予算を管理し、
+「直近の会話」「関係の初期」「関係の中期」「印象的なやりとり（長文・質問・絵文字の多い発言）」を
+ひとつの予算の中で配分します。どの処理もメッセージ数に比例した時間で終わります。
+前回の鑑定からの変化を見るときは、select_update_context で前回以降の会話だけを小さな予算で選びます。
+"""
+import heapq
+import re
+
+CONTEXT_TOKEN_BUDGET = 6000  # 返信間隔などの数値は chat_analytics で集計して別に渡すので、生の会話は少なめ
+# 予算の配分（合計 1.0）。使い切れなかった分は直近の会話に回します
+SECTION_SHARES = {"初期": 0.125, "中期": 0.125, "印象的なやりとり": 0.2, "直近": 0.55}
+UPDATE_CONTEXT_TOKEN_BUDGET = 4000  # 前回からの変化を見る鑑定は、前回以降の会話だけなので小さめ
+UPDATE_SECTION_SHARES = {"前回以降": 0.8, "前回の直前": 0.2}  # 前回以降が余った分は直前の会話に回します
+LONG_MESSAGE_CHARS = 40
+EMOJI_PATTERN = re.compile('[\U0001F300-\U0001FAFF☀-➿]')
+QUESTION_MARKS = ('?', '？')
+
+
+class TokenEstimator:
+    """
+    トークン数のローカル見積もり。ASCII は4文字で1トークン、それ以外は1文字1トークンとして数え、
+    calibrate() で実際のモデルの count_tokens と比べた補正係数を掛けます。
+    """
+
+    def __init__(self, ratio=1.0):
+        self.ratio = ratio
+
+    def estimate(self, text):
+        n_chars = len(text)
+        n_multibyte = (len(text.encode('utf-8')) - n_chars) // 2  # 日本語は UTF-8 で3バイト
+        return ((n_chars - n_multibyte) / 4 + n_multibyte) * self.ratio
+
+    def calibrate(self, sample_text, count_tokens):
+        """count_tokens(text) -> 実トークン数 を1回呼び、補正係数を更新して返します。"""
+        raw = TokenEstimator().estimate(sample_text)
+        actual = count_tokens(sample_text)
+        if raw > 0 and actual > 0: self.ratio = actual / raw
+        return self.ratio
+
+
+def _signal_score(message):
+    """長文・質問・絵文字の多さから「印象的な発言」らしさを点数にします。"""
+    score = min(len(message) / LONG_MESSAGE_CHARS, 3.0)
+    if any(mark in message for mark in QUESTION_MARKS): score += 2.0
+    emoji_count = len(EMOJI_PATTERN.findall(message))
+    if emoji_count >= 3: score += 1.0 + min(emoji_count, 10) * 0.2
+    return score
+
+
+def _take(indices, costs, budget, chosen):
+    """indices の順に、予算に収まるだけ取ります。(取った添字のリスト, 使ったトークン) を返します。"""
+    taken, used = [], 0.0
+    for i in indices:
+        if i in chosen: continue
+        if used + costs[i] > budget: break
+        taken.append(i)
+        used += costs[i]
+    chosen.update(taken)
+    return taken, used
+
+
+def select_context(messages, budget_tokens=CONTEXT_TOKEN_BUDGET, estimator=None):
+    """
+    MessageStore からプロンプト用の会話を選びます。戻り値の辞書:
+    - recent: 直近の詳細な会話（「送信者: 本文」の行）
+    - digest: 関係性の歴史のダイジェスト（初期・中期・印象的なやりとり）
+    - section_tokens: セクションごとの推定トークン数
+    - total_tokens: 合計の推定トークン数
+    """
+    estimator = estimator or TokenEstimator()
+    n = len(messages)
+    if n == 0:
+        return {"recent": "", "digest": "会話データがありません。", "section_tokens": {}, "total_tokens": 0}
+
+    text, offsets, sender_ids = messages.text, messages.offsets, messages.sender_ids
+    sender_costs = [estimator.estimate(f"{sender}: ") for sender in messages.senders]
+    costs, bodies_cost = [], 0.0
+    for i in range(n):
+        cost = sender_costs[sender_ids[i]] + estimator.estimate(text[offsets[i]:offsets[i + 1]]) + estimator.ratio
+        costs.append(cost)
+        bodies_cost += cost
+
+    def render(indices):
+        return "\n".join(f"{messages.senders[sender_ids[i]]}: {text[offsets[i]:offsets[i + 1]]}" for i in indices)
+
+    if bodies_cost <= budget_tokens:
+        return {"recent": render(range(n)),
+                "digest": "（全期間の会話を「直近の詳細な会話」にすべて含めています）",
+                "section_tokens": {"直近": round(bodies_cost)}, "total_tokens": round(bodies_cost)}
+
+    chosen, section_tokens, third = set(), {}, n // 3
+    early, section_tokens["初期"] = _take(range(0, third), costs, budget_tokens * SECTION_SHARES["初期"], chosen)
+    middle, section_tokens["中期"] = _take(range(third, third * 2), costs, budget_tokens * SECTION_SHARES["中期"], chosen)
+
+    # 直近の会話は後ろから詰め、直近に入らなかった範囲から印象的な発言を選ぶ
+    recent_budget = budget_tokens * SECTION_SHARES["直近"]
+    recent, section_tokens["直近"] = _take(range(n - 1, -1, -1), costs, recent_budget, chosen)
+    recent.reverse()
+    recent_start = recent[0] if recent else n
+    highlight_budget = budget_tokens * SECTION_SHARES["印象的なやりとり"]
+    candidates = heapq.nlargest(
+        max(1, int(highlight_budget // 20)),
+        (i for i in range(recent_start) if i not in chosen),
+        key=lambda i: _signal_score(text[offsets[i]:offsets[i + 1]]))
+    highlights, section_tokens["印象的なやりとり"] = [], 0.0
+    for i in candidates:
+        if section_tokens["印象的なやりとり"] + costs[i] > highlight_budget: continue
+        highlights.append(i)
+        section_tokens["印象的なやりとり"] += costs[i]
+    highlights.sort()
+
+    # 残った予算で直近の会話をさらに遡る
+    leftover = budget_tokens - sum(section_tokens.values())
+    if leftover > 0 and recent_start > 0:
+        chosen.update(highlights)
+        more, used = _take(range(recent_start - 1, -1, -1), costs, leftover, chosen)
+        more.reverse()
+        recent = more + recent
+        section_tokens["直近"] += used
+
+    digest = "\n\n".join([
+        "--- 関係の初期 ---\n" + render(early),
+        "--- 関係の中期 ---\n" + render(middle),
+        "--- 印象的なやりとり ---\n" + render(highlights),
+    ])
+    section_tokens = {name: round(tokens) for name, tokens in section_tokens.items()}
+    return {"recent": render(recent), "digest": digest,
+            "section_tokens": section_tokens, "total_tokens": sum(section_tokens.values())}
+
+
+def select_update_context(messages, since, budget_tokens=UPDATE_CONTEXT_TOKEN_BUDGET, estimator=None):
+    """
+    前回の鑑定以降（messages[since:]）の会話を中心に選びます。戻り値は select_context と同じ形で、
+    recent は前回以降の会話（入りきらなければ新しい方から）、digest は前回の鑑定の直前の会話です。
+    見積もるのは選ぶ範囲のメッセージだけなので、履歴全体の長さには左右されません。
+    """
+    estimator = estimator or TokenEstimator()
+    text, offsets, sender_ids = messages.text, messages.offsets, messages.sender_ids
+    sender_costs = [estimator.estimate(f"{sender}: ") for sender in messages.senders]
+
+    def take_backward(start, stop, budget):
+        taken, used = [], 0.0
+        for i in range(start - 1, stop - 1, -1):
+            cost = sender_costs[sender_ids[i]] + estimator.estimate(text[offsets[i]:offsets[i + 1]]) + estimator.ratio
+            if used + cost > budget: break
+            taken.append(i)
+            used += cost
+        taken.reverse()
+        return taken, used
+
+    def render(indices):
+        return "\n".join(f"{messages.senders[sender_ids[i]]}: {text[offsets[i]:offsets[i + 1]]}" for i in indices)
+
+    recent, recent_used = take_backward(len(messages), since, budget_tokens * UPDATE_SECTION_SHARES["前回以降"])
+    before, before_used = take_backward(since, 0, budget_tokens - recent_used)
+    skipped = len(messages) - since - len(recent)
+    digest = "--- 前回の鑑定の直前の会話 ---\n" + render(before)
+    if skipped: digest += f"\n（前回の鑑定以降の会話のうち、古い方の{skipped}件は省略しています）"
+    section_tokens = {"前回以降": round(recent_used), "前回の直前": round(before_used)}
+    return {"recent": render(recent), "digest": digest,
+            "section_tokens": section_tokens, "total_tokens": sum(section_tokens.values())}
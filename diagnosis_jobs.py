@@ -0,0 +1,121 @@
+"""
+鑑定処理をバックグラウンドで実行するジョブキュー。
+
+Streamlit の再実行（ウィジェット操作やリロード）とは切り離してスレッドプールで処理し、
+画面側はジョブIDで進み具合と結果を取りに来ます。同じ内容の依頼は同じジョブにまとめ、
+1人あたりの同時実行数には上限を設けます。Streamlit には依存しません。
+"""
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_JOBS_PER_USER = 1
+DEFAULT_RETENTION_SECONDS = 3600  # 終わったジョブの結果を保持する秒数
+
+
+class JobLimitError(Exception):
+    """同じユーザーの実行中ジョブが上限に達しているときに投げます。"""
+
+
+class DiagnosisJob:
+    """1回分の鑑定。status は queued / running / done / error のいずれかです。"""
+
+    def __init__(self, user_id, dedupe_key):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.dedupe_key = dedupe_key
+        self.status = "queued"
+        self.stage = "順番待ちをしています..."
+        self.partial_text = ""
+        self.notes = []
+        self.parts = {}  # 複数の鑑定をまとめて行うとき、鑑定ごとの {stage, partial_text, result}
+        self.result = None
+        self.error = None
+        self.reusable = True  # False なら、同じ依頼が来ても使い回さずにやり直す（ブロックされた・空の結果など）
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def is_finished(self):
+        return self.status in ("done", "error")
+
+    def update(self, stage=None, partial_text=None):
+        """処理スレッドから進み具合を書き込みます。"""
+        if stage is not None: self.stage = stage
+        if partial_text is not None: self.partial_text = partial_text
+
+    def update_part(self, key, stage=None, partial_text=None, result=None):
+        """
+        複数の鑑定をまとめて行うジョブで、key の鑑定の進み具合・結果を書き込みます。
+        画面側は parts を見て、終わった鑑定から先に表示できます。
+        """
+        part = self.parts.get(key)
+        if part is None: part = self.parts[key] = {"stage": "順番待ちをしています...", "partial_text": "", "result": None}
+        if stage is not None: part["stage"] = stage
+        if partial_text is not None: part["partial_text"] = partial_text
+        if result is not None: part["result"] = result
+
+    def note(self, message):
+        """画面に表示したいお知らせを追加します。"""
+        self.notes.append(message)
+
+
+class JobManager:
+    """ジョブの受付・実行・結果の保持を行います。全セッションで1つを共有する想定です。"""
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_jobs_per_user=DEFAULT_MAX_JOBS_PER_USER,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="diagnosis")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self.max_jobs_per_user = max_jobs_per_user
+        self.retention_seconds = retention_seconds
+
+    def submit(self, user_id, dedupe_key, fn, *args):
+        """
+        fn(job, *args) をバックグラウンドで実行し、ジョブを返します。
+        同じユーザー・同じ dedupe_key のジョブが実行中または保持中なら、新しく作らずにそれを返します。
+        失敗したジョブと、fn が reusable を False にしたジョブは使い回しません。
+        """
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if job.user_id == user_id and job.dedupe_key == dedupe_key and job.status != "error" and job.reusable:
+                    return job
+            active = sum(1 for job in self._jobs.values() if job.user_id == user_id and not job.is_finished)
+            if active >= self.max_jobs_per_user:
+                raise JobLimitError(f"実行中の鑑定が{active}件あります。")
+            job = DiagnosisJob(user_id, dedupe_key)
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args):
+        job.status = "running"
+        try:
+            job.result, status = fn(job, *args), "done"
+        except Exception:
+            job.error, status = traceback.format_exc(), "error"
+        # 終わった状態は最後に書く（is_finished を見た側が、必ず finished_at も読めるように）
+        job.finished_at = time.time()
+        job.status = status
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.is_finished and job.finished_at is not None and now - job.finished_at > self.retention_seconds]
+        for job_id in expired: del self._jobs[job_id]
+
+    def stats(self):
+        """管理画面向けに、状態ごとのジョブ数を返します。"""
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "error": 0}
+            for job in self._jobs.values(): counts[job.status] += 1
+        return counts
@@ -0,0 +1,106 @@
+"""
+鑑定履歴の保存先（SQLite）。
+
+1件ごとの追記と「ユーザー×お相手の最新1件」の取得をインデックスで行います。
+書き込みはトランザクション単位で原子的に行われ、複数セッション・複数プロセスからの
+同時書き込みは SQLite のファイルロックで直列化されます。
+以前の data/{user_id}.json 形式の履歴は、初回オープン時に一度だけ取り込みます。
+"""
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+DB_FILE_NAME = "history.sqlite3"
+MIGRATED_SUFFIX = ".migrated"
+LOCK_TIMEOUT_SECONDS = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diagnoses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    partner_name TEXT,
+    date TEXT NOT NULL,
+    pulse_score INTEGER,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_latest ON diagnoses (user_id, partner_name, id);
+CREATE TABLE IF NOT EXISTS migrated_files (
+    file_name TEXT PRIMARY KEY,
+    migrated_at TEXT NOT NULL
+);
+"""
+
+
+class HistoryStore:
+    """鑑定履歴の追記・最新取得を行います。接続は操作ごとに開くのでスレッドをまたいで使えます。"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.db_path = os.path.join(data_dir, DB_FILE_NAME)
+        os.makedirs(data_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # 自動コミットモード。明示的な BEGIN が無い文は1文ずつ原子的に確定し、
+        # COMMIT 前に閉じたトランザクションは SQLite が自動でロールバックする
+        conn = sqlite3.connect(self.db_path, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def save(self, user_id, partner_name, pulse_score, summary, date=None):
+        """1件追記し、その記録のIDを返します。"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO diagnoses (user_id, partner_name, date, pulse_score, summary) VALUES (?, ?, ?, ?, ?)",
+                (user_id, partner_name, date or datetime.now().isoformat(), pulse_score, summary))
+            return cursor.lastrowid
+
+    def latest(self, user_id, partner_name):
+        """(user_id, partner_name) の最新の記録を辞書で返します。無ければ None。"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, date, partner_name, pulse_score, summary FROM diagnoses"
+                " WHERE user_id = ? AND partner_name = ? ORDER BY id DESC LIMIT 1",
+                (user_id, partner_name)).fetchone()
+        return dict(row) if row else None
+
+    def migrate_json_files(self):
+        """
+        data/{user_id}.json の履歴を取り込み、取り込んだファイルは .migrated を付けて退避します。
+        取り込み済みのファイル名は DB に記録するので、複数プロセスが同時に呼んでも二重に入りません。
+        戻り値は実際に書き込んだ記録の件数です（辞書でない記録は飛ばし、数にも入れません）。
+        """
+        migrated = 0
+        for file_name in sorted(os.listdir(self.data_dir)):
+            if not file_name.endswith(".json"): continue
+            file_path = os.path.join(self.data_dir, file_name)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f: records = json.load(f)
+            except (OSError, ValueError):
+                continue
+            user_id = file_name[:-len(".json")]
+            # 辞書でない記録（壊れた行など）は取り込まない。件数も実際に書き込んだ分だけ数える
+            rows = [(user_id, r.get("partner_name"), r.get("date") or "", r.get("pulse_score"), r.get("summary"))
+                    for r in (records if isinstance(records, list) else []) if isinstance(r, dict)]
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")  # 書き込みロックを取ってから取り込み済みか確認する
+                if conn.execute("SELECT 1 FROM migrated_files WHERE file_name = ?", (file_name,)).fetchone():
+                    conn.execute("COMMIT")
+                else:
+                    conn.executemany(
+                        "INSERT INTO diagnoses (user_id, partner_name, date, pulse_score, summary) VALUES (?, ?, ?, ?, ?)", rows)
+                    conn.execute("INSERT INTO migrated_files (file_name, migrated_at) VALUES (?, ?)",
+                                 (file_name, datetime.now().isoformat()))
+                    conn.execute("COMMIT")
+                    migrated += len(rows)
+            try:
+                os.replace(file_path, file_path + MIGRATED_SUFFIX)
+            except OSError:
+                pass
+        return migrated
+
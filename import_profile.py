@@ -0,0 +1,64 @@
+"""
+重いライブラリの遅延 import と、import にかかった時間の記録。
+
+timed_import で読み込んだモジュールは、初回の import 時間（ミリ秒）が記録されます。
+app.py 先頭の import 文は timed_import を通らないので、record_import_time でまとめて記録します。
+環境変数 KOI_ORACLE_IMPORT_REPORT=1 を付けて起動すると、
+app.py の import が終わった時点（st.stop() で止まる前）に、ここまでの時間をサーバーログへ出力します。
+起動時間が STARTUP_BUDGET_MS を超えたときは、環境変数が無くても出力します。
+（streamlit run で起動したときは、streamlit 本体はスクリプトより前にサーバーが読み込み済みです）
+"""
+import importlib
+import os
+import sys
+import threading
+import time
+
+STARTUP_BUDGET_MS = 500  # app.py の import が終わるまでの目安（これを超えたらログに警告）
+REPORT_ENV_VAR = "KOI_ORACLE_IMPORT_REPORT"
+
+IMPORT_TIMINGS = {}  # モジュール名 → 初回 import の所要ミリ秒
+_lock = threading.Lock()
+_startup = {"reported": False}
+
+
+def timed_import(module_name):
+    """モジュールを import して返します。初回だけ所要時間を記録します。"""
+    module = sys.modules.get(module_name)
+    if module is not None: return module
+    with _lock:  # 複数スレッドから同時に初回 import されても、記録は1回にする
+        module = sys.modules.get(module_name)
+        if module is not None: return module
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        IMPORT_TIMINGS[module_name] = (time.perf_counter() - started) * 1000
+    return module
+
+
+def record_import_time(label, started, finished=None):
+    """timed_import を通らない import（スクリプト先頭の import 文など）の所要時間を記録します。
+    再実行のたびに呼ばれても、初回（コールドスタート）の値を残します。"""
+    elapsed_ms = ((finished if finished is not None else time.perf_counter()) - started) * 1000
+    with _lock: IMPORT_TIMINGS.setdefault(label, elapsed_ms)
+
+
+def format_import_report(startup_ms=None):
+    """記録済みの import 時間を、遅い順に並べた文字列で返します。"""
+    lines = ["[import report]"]
+    if startup_ms is not None:
+        status = "OK" if startup_ms <= STARTUP_BUDGET_MS else "OVER BUDGET"
+        lines.append(f"  startup: {startup_ms:.1f} ms (budget {STARTUP_BUDGET_MS} ms, {status})")
+        lines.append("  (startup = script start to end of app.py imports; modules loaded later by timed_import are not loaded yet)")
+    for module_name, ms in sorted(IMPORT_TIMINGS.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"  {ms:8.1f} ms  {module_name}")
+    return "\n".join(lines)
+
+
+def report_startup_once(script_started):
+    """プロセスで最初の1回だけ、起動時間を確認してレポートを出力します。起動ミリ秒を返します。"""
+    if _startup["reported"]: return None
+    _startup["reported"] = True
+    startup_ms = (time.perf_counter() - script_started) * 1000
+    if os.environ.get(REPORT_ENV_VAR) == "1" or startup_ms > STARTUP_BUDGET_MS:
+        print(format_import_report(startup_ms), file=sys.stderr, flush=True)
+    return startup_ms
@@ -0,0 +1,291 @@
+"""
+LINEトーク履歴（.txt エクスポート）の解析処理。
+
+Streamlit に依存しないので、バッチ処理やベンチマークからもそのまま import できます。
+"""
+import io
+import re
+import codecs
+import calendar
+from array import array
+from datetime import datetime, timezone
+
+# ★ パターンはすべてモジュール読み込み時に一度だけコンパイル
+DATE_PATTERN = re.compile(r'^\d{4}/\d{2}/\d{2}\(.\)')
+MESSAGE_PATTERN = re.compile(r'^(\d{1,2}:\d{2})\t([^\t]+)\t(.*)')
+SKIP_MESSAGES = frozenset(["[写真]", "[動画]", "[スタンプ]", "[ファイル]"])
+UNKNOWN_DATE = "日付不明"
+NO_TIMESTAMP = -1  # 日付ヘッダより前のメッセージなど、日時が特定できない場合
+WEEKDAYS = "月火水木金土日"
+EXPORT_ENCODINGS = ('utf-8', 'shift_jis', 'cp932')  # 試す順番（BOM付きUTF-8は先頭の3バイトで判定）
+SNIFF_PREFIX_BYTES = 64 * 1024  # 文字コードの判定に使う先頭のバイト数
+DECODE_CHUNK_BYTES = 1024 * 1024  # 少しずつデコードするときの1回分のバイト数
+
+
+def _iter_text_lines(text):
+    """文字列を1行ずつ返します（split のように全行のリストを作らない）。"""
+    start, length = 0, len(text)
+    while start < length:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def iter_source_lines(source, encoding='utf-8'):
+    """
+    str / bytes / バイナリ or テキストのファイルオブジェクト / 行のイテラブル
+    のいずれかを受け取り、改行を除いた行を順に返します。
+    """
+    if isinstance(source, str):
+        yield from _iter_text_lines(source)
+        return
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield from iter_decoded_lines(source, encoding)
+        return
+    if isinstance(source, io.IOBase) and not isinstance(source, io.TextIOBase):
+        source = io.TextIOWrapper(source, encoding=encoding, newline='')
+    for line in source:
+        yield line.rstrip('\r\n')
+
+
+def iter_decoded_lines(raw_data, encoding='utf-8', chunk_bytes=DECODE_CHUNK_BYTES):
+    """
+    バイト列を memoryview で少しずつ切り出してデコードしながら、改行を除いた行を順に返します。
+    全体をデコードした文字列は作らないので、元のバイト列のコピーも巨大な文字列もできません。
+    """
+    view = memoryview(raw_data)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    for start in range(0, len(view), chunk_bytes):
+        text = pending + decoder.decode(view[start:start + chunk_bytes], final=start + chunk_bytes >= len(view))
+        lines = text.split('\n')
+        pending = lines.pop()
+        for line in lines: yield line.rstrip('\r')
+    if pending: yield pending.rstrip('\r')
+
+
+def sniff_encoding(raw_data, encodings=EXPORT_ENCODINGS, prefix_bytes=SNIFF_PREFIX_BYTES):
+    """
+    先頭 prefix_bytes だけを見て文字コードを判定します。読めるものが無ければ None。
+    先頭より後ろに判定外のバイトがあった場合は、解析時に UnicodeDecodeError になります。
+    """
+    view = memoryview(raw_data)
+    if view[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8: return 'utf-8-sig'
+    prefix = view[:prefix_bytes]
+    for encoding in encodings:
+        # 末尾で途切れた多バイト文字は保留されるだけなので、全体を読み切るときだけ final にする
+        try: codecs.getincrementaldecoder(encoding)().decode(prefix, final=len(prefix) == len(view))
+        except UnicodeDecodeError: continue
+        return encoding
+    return None
+
+
+def _tap_preview(lines, n_lines, preview):
+    """行をそのまま流しつつ、最初の空でない行から n_lines 行を preview に追加します。"""
+    for line in lines:
+        if len(preview) < n_lines and (preview or line.strip()): preview.append(line)
+        yield line
+
+
+def read_preview(raw_data, encoding, n_lines, prefix_bytes=SNIFF_PREFIX_BYTES):
+    """先頭 prefix_bytes だけをデコードし、最初の空でない行から n_lines 行を返します（解析せずにプレビューだけ欲しいとき用）。"""
+    text = codecs.decode(bytes(memoryview(raw_data)[:prefix_bytes]), encoding, 'ignore')  # 末尾で途切れた文字は捨てる
+    preview = []
+    for _ in _tap_preview(_iter_text_lines(text), n_lines, preview):
+        if len(preview) >= n_lines: break
+    return '\n'.join(preview).strip()
+
+
+def _iter_raw_messages(source, encoding='utf-8'):
+    """
+    トーク履歴を1行ずつ読みながら (日付, 時刻, 送信者, 本文) を1件ずつ yield します。
+    複数行メッセージの続きは次のメッセージが現れるまで保留し、確定した時点で返します。
+    """
+    current_date, pending = UNKNOWN_DATE, None
+    for raw_line in iter_source_lines(source, encoding):
+        if raw_line.startswith('[') and raw_line.endswith(']'): continue
+        line = raw_line.strip()
+        if not line: continue
+        date_match = DATE_PATTERN.match(line)
+        if date_match:
+            current_date = date_match.group(0)
+            continue
+        message_match = MESSAGE_PATTERN.match(line)
+        if message_match:
+            time_str, sender, message = message_match.groups()
+            sender, message = sender.strip(), message.strip()
+            if message not in SKIP_MESSAGES:
+                if pending is not None: yield tuple(pending)
+                pending = [current_date, time_str, sender, message]
+            continue
+        if pending is not None:
+            pending[3] += '\n' + line
+    if pending is not None:
+        yield tuple(pending)
+
+
+def iter_line_messages(source, encoding='utf-8'):
+    """トーク履歴からメッセージ辞書 {'timestamp', 'sender', 'message'} を1件ずつ yield します。"""
+    for date_str, time_str, sender, message in _iter_raw_messages(source, encoding):
+        yield {'timestamp': f"{date_str} {time_str}", 'sender': sender, 'message': message}
+
+
+def parse_line_chat(text_data, encoding='utf-8'):
+    """iter_line_messages の結果をリストにまとめ、(メッセージ一覧, 全文) を返します。"""
+    messages = list(iter_line_messages(text_data, encoding))
+    full_text = " ".join(msg['message'].replace('\n', ' ') for msg in messages)
+    return messages, full_text
+
+
+# ---------------------------------------------------------------------
+# --- 列指向のメッセージストア ---
+# ---------------------------------------------------------------------
+def _date_to_epoch(date_str):
+    """'2024/01/31(水)' 形式の日付をその日0時のエポック秒（UTC扱い）に変換します。"""
+    try:
+        return calendar.timegm((int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]), 0, 0, 0))
+    except (ValueError, IndexError):
+        return None
+
+
+class MessageStore:
+    """
+    メッセージを配列でまとめて保持するコンパクトな入れ物です。
+
+    - timestamps: エポック秒（int64配列）。日時不明は NO_TIMESTAMP
+    - sender_ids: senders への添字（uint32配列）。送信者名は1人1回だけ保持
+    - offsets: 共有テキストバッファ text 上の各本文の開始位置（末尾に番兵つき）
+    """
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.sender_ids = array('I')
+        self.senders = []
+        self._sender_lookup = {}
+        self.offsets = array('Q', [0])
+        self._writer = io.StringIO()
+        self._text = ""
+        self._dirty = False
+        self.preview = ""  # from_source(preview_lines=...) で読んだ先頭の行
+
+    @classmethod
+    def from_source(cls, source, encoding='utf-8', preview_lines=0):
+        """
+        トーク履歴（str / bytes / ファイル）をストリーミング解析してストアを作ります。
+        preview_lines を指定すると、同じ読み込みの途中で先頭の行（空行を除いた最初の行から）を preview に残します。
+        """
+        store, day_epochs = cls(), {}
+        if preview_lines:
+            preview = []
+            source = _tap_preview(iter_source_lines(source, encoding), preview_lines, preview)
+        for date_str, time_str, sender, message in _iter_raw_messages(source, encoding):
+            if date_str not in day_epochs: day_epochs[date_str] = _date_to_epoch(date_str)
+            day_epoch = day_epochs[date_str]
+            if day_epoch is None:
+                timestamp = NO_TIMESTAMP
+            else:
+                hour, minute = time_str.split(':')
+                timestamp = day_epoch + int(hour) * 3600 + int(minute) * 60
+            store.append(timestamp, sender, message)
+        if preview_lines: store.preview = '\n'.join(preview).strip()
+        return store
+
+    @classmethod
+    def from_export(cls, raw_data, preview_lines=0):
+        """
+        アップロードされたバイト列を、先頭で文字コードを判定してから1回のデコードで解析します。
+        (ストア, 文字コード) を返し、どの文字コードでも読めなければ (None, None) を返します。
+        """
+        encoding = sniff_encoding(raw_data)
+        if encoding is None: return None, None
+        for candidate in [encoding] + [e for e in EXPORT_ENCODINGS if e != encoding]:
+            try: return cls.from_source(raw_data, candidate, preview_lines), candidate
+            except UnicodeDecodeError: continue  # 判定に使った先頭より後ろで読めなかったときだけ読み直す
+        return None, None
+
+    @classmethod
+    def from_columns(cls, timestamps, sender_ids, senders, offsets, text):
+        """配列（array または bytes）と本文バッファからストアを作り直します（保存したスナップショットの読み込み用）。"""
+        store = cls()
+        store.timestamps = array('q', timestamps)
+        store.sender_ids = array('I', sender_ids)
+        store.senders = list(senders)
+        store._sender_lookup = {name: i for i, name in enumerate(store.senders)}
+        store.offsets = array('Q', offsets)
+        store._writer.write(text)
+        store._text = text
+        return store
+
+    def extend(self, other):
+        """other のメッセージをすべて末尾に追加します。送信者の番号はこのストアの番号に付け直します。"""
+        remap = [self._sender_id(sender) for sender in other.senders]
+        self.timestamps.extend(other.timestamps)
+        self.sender_ids.extend(remap[sender_id] for sender_id in other.sender_ids)
+        base = self.offsets[-1]
+        self.offsets.extend(base + offset for offset in other.offsets[1:])
+        self._writer.write(other.text)
+        self._dirty = True
+
+    def _sender_id(self, sender):
+        sender_id = self._sender_lookup.get(sender)
+        if sender_id is None:
+            sender_id = self._sender_lookup[sender] = len(self.senders)
+            self.senders.append(sender)
+        return sender_id
+
+    def append(self, timestamp, sender, message):
+        sender_id = self._sender_id(sender)
+        self.timestamps.append(timestamp)
+        self.sender_ids.append(sender_id)
+        self._writer.write(message)
+        self.offsets.append(self.offsets[-1] + len(message))
+        self._dirty = True
+
+    @property
+    def text(self):
+        """全メッセージ本文を連結した共有バッファ。"""
+        if self._dirty:
+            self._text, self._dirty = self._writer.getvalue(), False
+        return self._text
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def sender(self, i):
+        return self.senders[self.sender_ids[i]]
+
+    def message(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def format_timestamp(self, i):
+        """旧形式（'2024/01/31(水) 21:05'）のタイムスタンプ文字列を返します。"""
+        timestamp = self.timestamps[i]
+        if timestamp == NO_TIMESTAMP: return UNKNOWN_DATE
+        dt = datetime.fromtimestamp(timestamp, timezone.utc)
+        return f"{dt:%Y/%m/%d}({WEEKDAYS[dt.weekday()]}) {dt:%H:%M}"
+
+    def __getitem__(self, i):
+        """互換用に、従来のメッセージ辞書として1件を返します。"""
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        return {'timestamp': self.format_timestamp(i), 'sender': self.sender(i), 'message': self.message(i)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def iter_lines(self, start=0, stop=None):
+        """「送信者: 本文」形式の行を順に返します（プロンプト作成用）。"""
+        text, offsets, senders, sender_ids = self.text, self.offsets, self.senders, self.sender_ids
+        stop = len(self) if stop is None else stop
+        for i in range(start, stop):
+            yield f"{senders[sender_ids[i]]}: {text[offsets[i]:offsets[i + 1]]}"
+
+    def sender_counts(self):
+        """送信者ごとのメッセージ件数を {送信者名: 件数} で返します。"""
+        counts = [0] * len(self.senders)
+        for sender_id in self.sender_ids: counts[sender_id] += 1
+        return dict(zip(self.senders, counts))
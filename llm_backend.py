@@ -0,0 +1,177 @@
+"""
+鑑定文を生成するAIの呼び出し口（バックエンド）。
+
+画面・バッチ処理・負荷試験は LLMBackend の generate / stream / count_tokens / list_models だけを使い、
+実際の呼び出し先は create_backend() で切り替えます。
+
+- GeminiBackend: google.generativeai を使う本番用
+- StubBackend: llm_stub_server.py（ローカルのHTTPスタブ）を使う負荷試験用。APIキーもクォータも不要
+
+環境変数 KOI_ORACLE_LLM_BACKEND に "stub" または "stub:http://host:port" を指定するとスタブを使います。
+generate / stream はどちらも (全文, 最初のテキストが届くまでの秒数, 全体の秒数, フィードバック) を返します。
+フィードバックは応答がブロックされたときの理由など（無ければ None）です。
+"""
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from import_profile import timed_import
+from report_generation import StreamedText, generate_report, generate_report_stream
+
+BACKEND_ENV_VAR = "KOI_ORACLE_LLM_BACKEND"
+DEFAULT_STUB_URL = "http://127.0.0.1:8765"
+STUB_TIMEOUT_SECONDS = 120
+
+
+class LLMBackend:
+    """バックエンドの共通インターフェース。"""
+
+    name = "base"
+    requires_api_key = True
+
+    def generate(self, model_name, prompt, generation_config=None, safety_settings=None):
+        raise NotImplementedError
+
+    def stream(self, model_name, prompt, generation_config=None, safety_settings=None, on_text=None):
+        raise NotImplementedError
+
+    def count_tokens(self, model_name, text):
+        raise NotImplementedError
+
+    def list_models(self):
+        raise NotImplementedError
+
+
+def _prompt_feedback(response):
+    return f"{response.prompt_feedback}" if hasattr(response, 'prompt_feedback') else None
+
+
+def bind_generative_client(model, client):
+    """
+    GenerativeModel に、APIキーごとのクライアントを使わせます（google.generativeai の内部に触るのはここだけ）。
+    公開の引数が無く、モデルは _client が None のときだけ genai.configure の全体の設定からクライアントを作るので、
+    作った直後に _client を設定します。ライブラリの作りが変わって _client が無いときは、全体の設定のキーで
+    呼んでしまわないよう RuntimeError にします。
+    """
+    if getattr(model, "_client", False) is not None:
+        raise RuntimeError("この google-generativeai ではAPIキーごとのクライアントを設定できません。")
+    model._client = client
+    return model
+
+
+class GeminiBackend(LLMBackend):
+    """
+    google.generativeai を使うバックエンド。APIキーごとのクライアントを持ちます。
+    genai.configure はプロセス全体の設定で、同時に動いている他のセッションの鑑定まで最後に設定したキーで
+    呼ばれてしまうので使いません。クライアント（接続）は最初に使うときに作り、同じバックエンドの中で使い回します。
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key):
+        self.genai = timed_import("google.generativeai")
+        self._api_key = api_key
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, service):
+        """service（"GenerativeService" / "ModelService"）のクライアントを返します。"""
+        with self._lock:
+            client = self._clients.get(service)
+            if client is None:
+                glm = timed_import("google.ai.generativelanguage")
+                client = self._clients[service] = getattr(glm, service + "Client")(client_options={"api_key": self._api_key})
+        return client
+
+    def _model(self, model_name):
+        return bind_generative_client(self.genai.GenerativeModel(model_name), self._client("GenerativeService"))
+
+    def generate(self, model_name, prompt, generation_config=None, safety_settings=None):
+        text, first_token_seconds, total_seconds, response = generate_report(
+            self._model(model_name), prompt, generation_config, safety_settings)
+        return text, first_token_seconds, total_seconds, _prompt_feedback(response)
+
+    def stream(self, model_name, prompt, generation_config=None, safety_settings=None, on_text=None):
+        text, first_token_seconds, total_seconds, response = generate_report_stream(
+            self._model(model_name), prompt, generation_config, safety_settings, on_text=on_text)
+        return text, first_token_seconds, total_seconds, _prompt_feedback(response)
+
+    def count_tokens(self, model_name, text):
+        return self._model(model_name).count_tokens(text).total_tokens
+
+    def list_models(self):
+        return [m.name for m in self.genai.list_models(client=self._client("ModelService"))
+                if "generateContent" in m.supported_generation_methods]
+
+
+class StubBackend(LLMBackend):
+    """llm_stub_server.py に HTTP で依頼するバックエンド。エラーは本番と同じく "503 ..." のような文面の例外になります。"""
+
+    name = "stub"
+    requires_api_key = False
+
+    def __init__(self, base_url=DEFAULT_STUB_URL, timeout=STUB_TIMEOUT_SECONDS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _open(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(self.base_url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try: message = json.loads(e.read().decode("utf-8"))["error"]
+            except Exception: message = e.reason
+            raise RuntimeError(f"{e.code} {message}") from None
+
+    def _generate(self, model_name, prompt, generation_config, stream, on_text):
+        started = time.perf_counter()
+        first_token_seconds, text = None, StreamedText()
+        payload = {"prompt": prompt, "generation_config": generation_config or {}, "stream": stream}
+        with self._open(f"/v1/{model_name}:generate", payload) as response:
+            for line in response:
+                if not line.strip(): continue
+                chunk = json.loads(line)
+                if "error" in chunk: raise RuntimeError(chunk["error"])  # ストリームの途中で切れた場合
+                if not chunk.get("text"): continue
+                if first_token_seconds is None: first_token_seconds = time.perf_counter() - started
+                text.append(chunk["text"])
+                if on_text: on_text(text)
+        total_seconds = time.perf_counter() - started
+        return str(text), first_token_seconds if stream else total_seconds, total_seconds, None
+
+    def generate(self, model_name, prompt, generation_config=None, safety_settings=None):
+        return self._generate(model_name, prompt, generation_config, False, None)
+
+    def stream(self, model_name, prompt, generation_config=None, safety_settings=None, on_text=None):
+        return self._generate(model_name, prompt, generation_config, True, on_text)
+
+    def count_tokens(self, model_name, text):
+        with self._open(f"/v1/{model_name}:countTokens", {"text": text}) as response:
+            return json.loads(response.read())["total_tokens"]
+
+    def list_models(self):
+        with self._open("/v1/models") as response:
+            return json.loads(response.read())["models"]
+
+
+def _resolve_spec(spec):
+    """spec（省略時は環境変数 KOI_ORACLE_LLM_BACKEND）から (バックエンドのクラス, スタブのURL) を返します。"""
+    spec = spec if spec is not None else os.environ.get(BACKEND_ENV_VAR, "")
+    if spec == "stub" or spec.startswith("stub:"): return StubBackend, spec[len("stub:"):] or DEFAULT_STUB_URL
+    if spec not in ("", "gemini"): raise ValueError(f"不明なバックエンドです: {spec}")
+    return GeminiBackend, None
+
+
+def requires_api_key(spec=None):
+    """spec のバックエンドがAPIキーを必要とするか。バックエンドは作らないので、キーの形式を確かめる前に使えます。"""
+    return _resolve_spec(spec)[0].requires_api_key
+
+
+def create_backend(api_key=None, spec=None):
+    """spec（省略時は環境変数 KOI_ORACLE_LLM_BACKEND）に合わせたバックエンドを作ります。"""
+    backend_class, stub_url = _resolve_spec(spec)
+    return StubBackend(stub_url) if backend_class is StubBackend else GeminiBackend(api_key)
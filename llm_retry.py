@@ -0,0 +1,171 @@
+"""
+生成時のリトライ・予備モデルへの切り替え・ヘッジ（並行リクエスト）。
+
+429 / 503 などの一時的なエラーはジッター付きの指数バックオフで再試行し、
+それでもだめなら候補リストの次のモデルに切り替えます。
+ヘッジを有効にすると、最初のモデルが一定時間内に何も出力しない場合に
+次のモデルへも同時に依頼し、先に出力し始めた方を採用します。
+試行ごとのモデル名・結果・所要時間は logging に出力し、戻り値にも含めます。
+RateLimiter は、バッチ処理などで同時に多数の生成を行うときの呼び出し間隔の制御に使います。
+"""
+import logging
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RETRIES = 2
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_CAP_SECONDS = 16.0
+RETRYABLE_MARKERS = ("429", "500", "503", "504", "resource exhausted", "resource_exhausted", "quota",
+                     "unavailable", "overloaded", "deadline", "timed out", "timeout", "internal error")
+MODEL_UNAVAILABLE_MARKERS = ("404", "not found", "is not supported", "unsupported")
+
+
+class GenerationFailed(Exception):
+    """すべてのモデル・すべての再試行が失敗したときに投げます。attempts に試行の記録が入ります。"""
+
+    def __init__(self, message, attempts, last_error=None):
+        super().__init__(message)
+        self.attempts = attempts
+        self.last_error = last_error
+
+
+def is_retryable(error):
+    """同じモデルで再試行すれば通りそうな、一時的なエラーかどうか。"""
+    message = str(error).lower()
+    return any(marker in message for marker in RETRYABLE_MARKERS)
+
+
+def should_fall_back(error):
+    """次のモデルに切り替えるべきエラーかどうか（一時的なエラー、またはモデルが使えない）。"""
+    message = str(error).lower()
+    return is_retryable(error) or any(marker in message for marker in MODEL_UNAVAILABLE_MARKERS)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_CAP_SECONDS, rng=random):
+    """attempt 回目（0始まり）の再試行前の待ち時間。上限つき指数バックオフに full jitter をかけます。"""
+    return rng.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RateLimiter:
+    """
+    複数スレッドで共有する、1分あたりのリクエスト数の上限。acquire() は次の枠まで待ってから戻ります。
+    枠は一定間隔で割り当てるので、同時に呼ばれてもリクエストが一度に集中しません。
+    """
+
+    def __init__(self, requests_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._clock, self._sleep = clock, sleep
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def acquire(self):
+        if not self.interval: return
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now: self._sleep(slot - now)
+
+
+def _run_chain(model_names, call, on_text, max_retries, attempts, sleep):
+    """model_names を順に試し、各モデルでは一時的なエラーを max_retries 回まで再試行します。"""
+    last_error = None
+    for model_name in model_names:
+        for attempt in range(max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = call(model_name, on_text)
+            except Exception as e:
+                latency = time.perf_counter() - started
+                attempts.append({"model": model_name, "attempt": attempt, "outcome": "error", "latency": latency, "error": str(e)})
+                logger.warning("generate %s attempt %d failed after %.2fs: %s", model_name, attempt, latency, e)
+                last_error = e
+                if is_retryable(e) and attempt < max_retries:
+                    sleep(backoff_delay(attempt))
+                    continue
+                if should_fall_back(e): break
+                raise GenerationFailed(f"{model_name} で回復できないエラーが発生しました。", attempts, e) from e
+            latency = time.perf_counter() - started
+            attempts.append({"model": model_name, "attempt": attempt, "outcome": "ok", "latency": latency, "error": None})
+            logger.info("generate %s attempt %d succeeded in %.2fs", model_name, attempt, latency)
+            return model_name, result
+    raise GenerationFailed("すべての候補モデルで生成に失敗しました。", attempts, last_error)
+
+
+def generate_with_fallback(model_names, call, on_text=None, max_retries=DEFAULT_MAX_RETRIES,
+                           hedge_after=None, sleep=time.sleep):
+    """
+    call(model_name, on_text) -> 結果 を、リトライと予備モデルへの切り替えつきで実行します。
+    戻り値は (実際に使ったモデル名, call の結果, 試行の記録のリスト)。
+
+    hedge_after（秒）を指定すると、先頭モデルがその時間内に on_text を一度も呼ばなければ
+    残りのモデルでも並行して生成を始め、先に出力し始めた（または先に成功した）方を採用します。
+    採用されなかった方の出力は on_text に流しません。採用した方が失敗したら、もう一方の結果（成功済みならそれ）を使います。
+    """
+    attempts = []
+    if not hedge_after or len(model_names) < 2:
+        model_name, result = _run_chain(model_names, call, on_text, max_retries, attempts, sleep)
+        return model_name, result, attempts
+
+    lock, winner, finished = threading.Lock(), {}, queue.Queue()
+    progressed = threading.Event()  # 最初の出力か、どちらかのレーンの終了（成功・失敗とも）で起こす
+
+    def gated_on_text(lane):
+        def forward(partial):
+            with lock:
+                winner.setdefault("lane", lane)
+                if winner["lane"] != lane: return
+            progressed.set()
+            if on_text: on_text(partial)
+        return forward
+
+    def run_lane(lane, lane_models):
+        try:
+            finished.put((lane, _run_chain(lane_models, call, gated_on_text(lane), max_retries, attempts, sleep), None))
+        except Exception as e:
+            finished.put((lane, None, e))
+        progressed.set()
+
+    lanes = {"primary": model_names[:1], "hedge": model_names[1:]}
+    threading.Thread(target=run_lane, args=("primary", lanes["primary"]), daemon=True).start()
+    started_lanes = 1
+    if not progressed.wait(hedge_after) and finished.empty():
+        logger.info("no output from %s after %.1fs; hedging with %s", model_names[0], hedge_after, lanes["hedge"][0])
+        threading.Thread(target=run_lane, args=("hedge", lanes["hedge"]), daemon=True).start()
+        started_lanes = 2
+
+    errors, completed, fatal = [], {}, None  # completed: 採用されずに先に成功したレーン → 結果
+    for received in range(1, started_lanes + 1):
+        lane, outcome, error = finished.get()
+        pending = started_lanes - received  # まだ終わっていないレーンの数
+        if error is not None:
+            errors.append(error)
+            if completed: lane, outcome = completed.popitem()  # もう一方が成功済みなら、その結果を使う
+            else:
+                last_error = getattr(error, "last_error", None)
+                if last_error is not None and not should_fall_back(last_error):
+                    # 回復できないエラーでも、もう一方のレーンが動いていればその結果を待つ
+                    if not pending: raise fatal or error
+                    fatal = fatal or error
+                # 主系が出力前に失敗し、まだヘッジしていなければ、残りのモデルで続行する
+                elif lane == "primary" and started_lanes == 1:
+                    model_name, result = _run_chain(lanes["hedge"], call, on_text, max_retries, attempts, sleep)
+                    return model_name, result, attempts
+                with lock:  # 採用していた方が途中で失敗したら、もう一方に出力を引き継ぐ
+                    if winner.get("lane") == lane: winner["lane"] = "hedge" if lane == "primary" else "primary"
+                continue
+        else:
+            with lock:
+                winner.setdefault("lane", lane)
+                if winner["lane"] != lane:  # 先に出力し始めた方の完了を待つ（失敗したらこちらを使う）
+                    completed[lane] = outcome
+                    continue
+        for attempt in attempts:
+            if attempt["outcome"] == "ok" and attempt["model"] != outcome[0]: attempt["outcome"] = "abandoned"
+        return outcome[0], outcome[1], attempts
+    if fatal is not None: raise fatal
+    raise GenerationFailed("すべての候補モデルで生成に失敗しました。", attempts, errors[-1] if errors else None)
@@ -0,0 +1,173 @@
+"""
+負荷試験用の、Gemini の代わりに応答するローカルHTTPスタブ。
+
+    python llm_stub_server.py --port 8765 --latency 2.0 --jitter 0.5 --error-rate 0.05 --rate-limit-rate 0.05
+    KOI_ORACLE_LLM_BACKEND=stub:http://127.0.0.1:8765 streamlit run app.py
+
+応答の遅れ（最初のテキストまでの秒数とそのばらつき）、チャンクの間隔、503 / 429 エラーの割合を指定でき、
+本文は【総合脈あり度】を含む定型の鑑定レポートから選んで返します（generation_config が JSON出力モードなら JSON）。
+llm_backend.StubBackend が使うエンドポイント:
+
+- GET  /v1/models                    → {"models": [...]}
+- POST /v1/models/{name}:generate    → stream=true なら1行1チャンクの JSON Lines、false なら1行
+- POST /v1/models/{name}:countTokens → {"total_tokens": n}
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from report_generation import MODEL_CANDIDATES
+
+CANNED_REPORTS = [
+    """## 導入
+こんにちは、鑑定師の碧月よ。{your_name}さんの恋、星たちもやさしく見守っているわ。
+
+## 恋の温度グラフの解説
+最近の二人はやりとりの回数が増えていて、会話の温度もゆるやかに上がっているの。
+
+## 総合脈あり度
+【総合脈あり度】: {score}%
+相手からの質問返しが多く、返信の間隔も安定しているのが大きな根拠よ。
+
+## 恋の未来予測
+このまま自然体でいれば、次の季節には二人の距離がもっと縮まっているはず。
+
+## 恋の処方箋・アクションチェックリスト
+- 今日送ると効果的なメッセージ例: 「この前の話の続き、今度ゆっくり聞かせて！」
+- 今は控えるべきNG行動: 返信を急かすこと
+""",
+    """## 導入
+こんにちは、鑑定師の詩音です。データから冷静に分析していきますね。
+
+## 総合脈あり度
+【総合脈あり度】: {score}%
+返信間隔の中央値と、相手から話題を広げた回数の多さを重視して算出しました。
+
+## 恋の心理レポート
+相手は「一緒に過ごす時間」を大切にする価値観が強く、予定の話題に積極的です。
+
+## 恋の処方箋・アクションチェックリスト
+- 次回鑑定のおすすめタイミング: 2週間後
+""",
+]
+
+
+def json_report(report):
+    """JSON出力モード用に、定型レポートを report_generation.REPORT_RESPONSE_SCHEMA の形にします。"""
+    score = int(report.split("【総合脈あり度】: ", 1)[1].split("%", 1)[0])
+    return json.dumps({"pulse_score": score, "summary": f"総合脈あり度は{score}%です。",
+                       "report_markdown": report}, ensure_ascii=False)
+
+
+class StubConfig:
+    def __init__(self, latency=1.0, jitter=0.3, chunk_delay=0.05, chunk_chars=40,
+                 error_rate=0.0, rate_limit_rate=0.0, models=None, seed=None):
+        self.latency, self.jitter = latency, jitter
+        self.chunk_delay, self.chunk_chars = chunk_delay, chunk_chars
+        self.error_rate, self.rate_limit_rate = error_rate, rate_limit_rate
+        self.models = list(models or MODEL_CANDIDATES)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()  # random.Random をスレッドから共有するため
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    def roll(self):
+        """(最初のテキストまでの秒数, 返すエラー or None, 本文) を決めます。"""
+        with self.lock:
+            self.stats["requests"] += 1
+            r = self.rng.random()
+            delay = max(0.0, self.rng.gauss(self.latency, self.jitter))
+            report = self.rng.choice(CANNED_REPORTS).format(your_name="あなた", score=self.rng.randint(30, 95))
+            if r < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return delay / 4, (429, "Resource exhausted (stub)"), None
+            if r < self.rate_limit_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return delay, (503, "Service unavailable (stub)"), None
+        return delay, None, report
+
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.0"  # 本文の終わりは接続を閉じて伝える（ストリーミング用）
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/v1/models": return self._send_json(200, {"models": config.models})
+            self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model_name, _, method = self.path[len("/v1/"):].partition(":")
+            if model_name not in config.models:
+                return self._send_json(404, {"error": f"model {model_name} is not found (stub)"})
+            if method == "countTokens":
+                return self._send_json(200, {"total_tokens": max(1, len(payload.get("text", "")))})
+            if method != "generate": return self._send_json(404, {"error": "not found"})
+
+            delay, error, report = config.roll()
+            time.sleep(delay)
+            if error: return self._send_json(error[0], {"error": error[1]})
+            if (payload.get("generation_config") or {}).get("response_mime_type") == "application/json":
+                report = json_report(report)
+            if not payload.get("stream"):
+                return self._send_json(200, {"text": report})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for i in range(0, len(report), config.chunk_chars):
+                if i: time.sleep(config.chunk_delay)
+                self.wfile.write(json.dumps({"text": report[i:i + config.chunk_chars]}, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+    return StubHandler
+
+
+def start_server(config, host="127.0.0.1", port=0):
+    """スタブを裏のスレッドで起動し、サーバーを返します（port=0 なら空いているポート）。URL は server_url(server)。"""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="負荷試験用の Gemini スタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0, help="最初のテキストまでの平均秒数")
+    parser.add_argument("--jitter", type=float, default=0.3, help="遅れのばらつき（標準偏差の秒数）")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="ストリーミング時のチャンクの間隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429 を返す割合")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    config = StubConfig(args.latency, args.jitter, args.chunk_delay, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    server.daemon_threads = True
+    print(f"stub LLM server on {server_url(server)}", flush=True)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    print(json.dumps(config.stats), flush=True)
+
+
+if __name__ == "__main__":
+    main()
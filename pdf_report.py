@@ -0,0 +1,214 @@
+"""
+鑑定書PDFの作成（fpdf2）。
+
+Streamlit に依存しないので、バッチ処理からもそのまま使えます。
+使う日本語フォント（とそれが読めるか）はプロセスごとに1回だけ決め、登録はPDFごとに行います
+（fpdf は書き出すときにフォントをその文書の文字だけに削るので、文書をまたいで使い回せません）。
+- PdfCache: 作成済みPDFをレポートごとに保持し、作成はバックグラウンドのスレッドで行う（画面版）
+- create_pdf_files: たくさんのレポートを複数プロセスで並行してPDFにする（一括作成）
+- create_comparison_pdf: 複数の鑑定師の鑑定を1冊にまとめる（表紙とグラフは共通）
+"""
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from fpdf import FPDF
+
+from import_profile import timed_import
+from report_parser import ReportDocument, parse_report
+
+EMOJI_PATTERN = re.compile(r'[\U0001F300-\U0001F9FF\u2600-\u26FF\u2700-\u27BF\uFE0F]+')
+THEME_COLORS = {"1. 優しく包み込む、お姉さん系": (255, 182, 193), "2. ロジカルに鋭く分析する、専門家系": (135, 206, 235), "3. 星の言葉で語る、ミステリアスな占い師系": (186, 85, 211)}
+DEFAULT_THEME_COLOR = (200, 200, 200)
+
+_font_setup = {}  # "path" → 日本語フォントのパス（使えなければ None）、"name" → フォント名
+_lock = threading.Lock()
+
+
+def get_japanese_font():
+    font_path = "./fonts/ipaexg.ttf"
+    if os.path.exists(font_path): return font_path
+    try: return timed_import("japanize_matplotlib").get_font_ttf_path()
+    except: return None
+
+class MyPDF(FPDF):
+    def footer(self): pass
+
+def preload_fonts():
+    """
+    使う日本語フォントをこのプロセスで1回だけ決めます（2回目以降は何もしません）。
+    フォントが読めるかもここで1回だけ確かめ、読めなければ Arial を使います。戻り値はフォント名です。
+    """
+    if _font_setup: return _font_setup["name"]
+    with _lock:
+        if _font_setup: return _font_setup["name"]
+        font_path, font_name = get_japanese_font(), 'Arial'
+        if font_path is not None:
+            try:
+                MyPDF().add_font('Japanese', '', font_path)
+                font_name = 'Japanese'
+            except Exception: font_path = None
+        _font_setup.update(path=font_path, name=font_name)
+    return font_name
+
+def _new_pdf():
+    """日本語フォント（使えるとき）を登録した MyPDF と、そのフォント名を返します。"""
+    font_name = preload_fonts()
+    pdf = MyPDF(orientation='P', unit='mm', format='A4')
+    if _font_setup["path"] is not None:
+        pdf.add_font('Japanese', '', _font_setup["path"])
+        pdf.add_font('Japanese', 'B', _font_setup["path"])
+    return pdf, font_name
+
+def _prepare_inputs(graph_img_buffer):
+    if isinstance(graph_img_buffer, (bytes, bytearray)): graph_img_buffer = io.BytesIO(graph_img_buffer)
+    pdf, font_name = _new_pdf()
+    pdf.set_auto_page_break(auto=True, margin=25)
+    pdf.set_margins(left=20, top=20, right=20)
+    return pdf, font_name, graph_img_buffer
+
+def _cover_page(pdf, font_name, character):
+    pdf.add_page()
+    pdf.set_fill_color(*THEME_COLORS.get(character, DEFAULT_THEME_COLOR))
+    pdf.rect(0, 0, 210, 297, 'F')
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_y(110)
+    pdf.set_font(font_name, 'B', 26)
+    pdf.cell(0, 15, "恋のオラクル AI恋星譚", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.set_font(font_name, '', 14)
+    pdf.cell(0, 10, "- 心の羅針盤 Edition -", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.ln(40)
+    pdf.set_font(font_name, '', 11)
+    pdf.cell(0, 10, f"鑑定日: {datetime.now().strftime('%Y年%m月%d日')}", align='C')
+
+def _report_body(pdf, font_name, report):
+    LINE_HEIGHT_NORMAL, LINE_HEIGHT_H2 = 8, 12
+    for kind, _, spans in report.blocks:
+        spans = [(EMOJI_PATTERN.sub('', text), bold) for text, bold in spans]
+        spans = [(text, bold) for text, bold in spans if text]
+        if not spans:
+            pdf.ln(LINE_HEIGHT_NORMAL / 2)
+            continue
+        if kind == "heading":
+            pdf.ln(LINE_HEIGHT_NORMAL)
+            pdf.set_font(font_name, 'B', 16)
+            pdf.multi_cell(0, LINE_HEIGHT_H2, "".join(text for text, _ in spans).strip(), align='L')
+            pdf.set_font(font_name, '', 11)
+        else:
+            for text, bold in spans:
+                if bold:
+                    pdf.set_font(font_name, 'B', 11)
+                    pdf.write(LINE_HEIGHT_NORMAL, text)
+                    pdf.set_font(font_name, '', 11)
+                else:
+                    pdf.write(LINE_HEIGHT_NORMAL, text)
+            pdf.ln(LINE_HEIGHT_NORMAL)
+
+def _graph_page(pdf, font_name, graph_img_buffer):
+    pdf.add_page()
+    pdf.set_font(font_name, 'B', 15)
+    pdf.cell(0, 12, "二人の恋の温度グラフ", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.ln(8)
+    graph_img_buffer.seek(0)
+    pdf.image(graph_img_buffer, x=20, y=pdf.get_y(), w=170)
+    pdf.set_auto_page_break(auto=False)
+    pdf.set_y(-25)
+    pdf.set_font(font_name, '', 8)
+    pdf.set_text_color(128, 128, 128)
+    pdf.cell(0, 10, "本鑑定はAIによる心理分析です。", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.cell(0, 5, "あなたの恋を心から応援しています♡", align='C')
+
+def create_pdf(report, graph_img_buffer, character):
+    """
+    report には report_parser.parse_report() の ReportDocument（鑑定文の文字列でも可）を、
+    graph_img_buffer には描画済みPNGのバイト列か、そのバッファを渡します。
+    """
+    if not isinstance(report, ReportDocument): report = parse_report(report)
+    pdf, font_name, graph_img_buffer = _prepare_inputs(graph_img_buffer)
+    _cover_page(pdf, font_name, character)
+    pdf.add_page()
+    pdf.set_text_color(0, 0, 0)
+    _report_body(pdf, font_name, report)
+    _graph_page(pdf, font_name, graph_img_buffer)
+    return bytes(pdf.output())
+
+def create_comparison_pdf(readings, graph_img_buffer, character):
+    """
+    複数の鑑定師の鑑定を1冊にまとめます。readings は (見出し, キャラクター, ReportDocument) のリストで、
+    鑑定師ごとにその色の帯と見出しを付けて章を分けます。表紙と温度グラフは character の分を1つだけ入れます。
+    """
+    pdf, font_name, graph_img_buffer = _prepare_inputs(graph_img_buffer)
+    _cover_page(pdf, font_name, character)
+    for title, reading_character, report in readings:
+        if not isinstance(report, ReportDocument): report = parse_report(report)
+        pdf.add_page()
+        pdf.set_fill_color(*THEME_COLORS.get(reading_character, DEFAULT_THEME_COLOR))
+        pdf.rect(0, 0, 210, 12, 'F')
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font(font_name, 'B', 18)
+        pdf.multi_cell(0, 12, EMOJI_PATTERN.sub('', title).strip(), align='L', new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font(font_name, '', 11)
+        _report_body(pdf, font_name, report)
+    _graph_page(pdf, font_name, graph_img_buffer)
+    return bytes(pdf.output())
+
+
+def write_pdf(report, graph_img_buffer, character, output_path):
+    """鑑定書PDFを作ってファイルに書き出し、そのパスを返します（プロセスプールからも呼べます）。"""
+    pdf = create_pdf(report, graph_img_buffer, character)
+    with open(output_path, "wb") as f: f.write(pdf)
+    return output_path
+
+def create_pdf_files(jobs, max_workers=None):
+    """
+    (レポート, グラフPNG, キャラクター, 出力先) の組をまとめて受け取り、複数プロセスで並行してPDFにします。
+    各プロセスは起動時にフォントを1回だけ読み込みます。戻り値は出力先のリスト（順番は jobs と同じ）です。
+    """
+    jobs = list(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=preload_fonts) as pool:
+        futures = [pool.submit(write_pdf, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+class PdfCache:
+    """
+    作成済みPDFをレポートごとに保持するLRUキャッシュ。作成はバックグラウンドのスレッドで行います。
+    request() は Future を返すので、画面側は done() を見て、できていればダウンロードボタンを出します。
+    作成時に使うフォントも先に決めておくので、最初のPDFでフォントを探して確かめる時間がかかりません。
+    metrics（StageMetrics）を渡すと、実際に作成したときだけ所要時間を pdf として記録します。
+    """
+
+    def __init__(self, max_entries=16, max_workers=2, metrics=None):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor.submit(preload_fonts)
+
+    def request(self, key, report, graph_img_buffer, character):
+        """key のPDFを返す Future。まだ無いか、前回失敗していれば作成を依頼します。"""
+        return self._request(key, create_pdf, report, graph_img_buffer, character)
+
+    def request_comparison(self, key, readings, graph_img_buffer, character):
+        """複数の鑑定師の鑑定をまとめたPDF（create_comparison_pdf）を返す Future。使い方は request() と同じです。"""
+        return self._request(key, create_comparison_pdf, readings, graph_img_buffer, character)
+
+    def _request(self, key, render, *args):
+        with self._lock:
+            future = self._entries.get(key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                self._entries.move_to_end(key)
+                return future
+            future = self._executor.submit(self._render, render, *args)
+            self._entries[key] = future
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return future
+
+    def _render(self, render, *args):
+        if self.metrics is None: return render(*args)
+        with self.metrics.span("pdf"): return render(*args)
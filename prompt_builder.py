@@ -0,0 +1,103 @@
+"""
+鑑定師への依頼文（プロンプト）の組み立て。
+
+Streamlit に依存しないので、画面からもバッチ処理からも同じプロンプトを作れます。
+"""
+
+# キャラクター（画面の選択肢） → (役割, 名前)。「鑑定師を見比べる」ではこの全員に同時に依頼します
+CHARACTER_MAP = {
+    "1. 優しく包み込む、お姉さん系": ("優しく包み込むお姉さんタイプの鑑定師", "碧月（みつき）"),
+    "2. ロジカルに鋭く分析する、専門家系": ("ロジカルに鋭く分析する専門家タイプの鑑定師", "詩音（しおん）"),
+    "3. 星の言葉で語る、ミステリアスな占い師系": ("星の言葉で語るミステリアスな占い師", "セレスティア")
+}
+DEFAULT_CHARACTER_NAME = "AI鑑定師"
+
+
+def character_name(character):
+    """キャラクターの選択肢から鑑定師の名前（例: 碧月（みつき））を返します。"""
+    return CHARACTER_MAP.get(character, (character, DEFAULT_CHARACTER_NAME))[1]
+
+
+def build_prompt(character, tone, your_name, partner_name, counseling_text, messages_summary, long_term_summary, trend, previous_data=None,
+                 new_message_count=None, conversation_stats=None):
+    """
+    new_message_count を渡すと「前回の鑑定からの変化」を見る鑑定になります（previous_data が必要）。
+    このとき messages_summary は前回以降の会話、long_term_summary は前回の直前の会話です（select_update_context）。
+    conversation_stats には chat_analytics.format_conversation_stats() の集計を渡します（返信間隔などの採点の根拠にする）。
+    """
+    # ★★★ ここからが重要 ★★★
+    # キャラクターの「役割」と「名前」は CHARACTER_MAP にセットで定義しています
+    char_info, char_name = CHARACTER_MAP.get(character, (character, DEFAULT_CHARACTER_NAME))
+    # ★★★ ここまでを追加・修正 ★★★
+
+    tone_instruction = {"癒し 100%": "とにかく優しく、温かく包み込むような言葉遣いで。否定的な表現は避け、常に希望を見出してください。", "癒し 50% × 論理 50%": "優しさと客観性のバランスを保ちながら、事実も伝えつつ励ましてください。", "冷静にロジカル": "感情に流されず、客観的なデータと論理的な分析を中心に伝えてください。"}
+    
+    # ↓↓↓ これで char_info と char_name が正しく使われます
+    prompt = f"""あなたは【{char_info}】の**{char_name}**です。導入部分で「こんにちは、鑑定師の{char_name}よ。」のように、必ず自分の名前をはっきりと名乗ってから会話を始めてください。ユーザーは【{tone}】のスタイルでの鑑定を望んでいます。{tone_instruction.get(tone, '')} このトーンと言葉遣いを、出力の最後まで徹底して維持してください。**重要: あなたは鑑定の最初から最後まで、キャラクターの口調・語尾・ニュアンスを完全に一定に保ち、文体が途中で絶対に変化しないよう、強く意識してください。**以下のデータを基に、単なる占いではない、心理分析に基づいた詳細な「恋の心理レポート」を作成してください。
+
+# ユーザー情報
+- ユーザー名: {your_name}
+- 相手の名前: {partner_name}
+- ユーザーの悩み: {counseling_text}
+"""
+    comparison_instruction = ""
+    if previous_data:
+        prev_score = previous_data.get('pulse_score', 0)
+        prompt += f"""
+# 過去の鑑定データ
+- 前回の鑑定日: {previous_data.get('date', '不明')}
+- **前回の脈あり度: {prev_score}%**
+- 前回の鑑定サマリー: {previous_data.get('summary', 'なし')}
+
+**【最重要】過去データに関する指示**:
+- あなたはユーザーの{your_name}さんを覚えています。導入文で「{your_name}さん、こんにちは。前回の鑑定から少し時間が経ちましたね」のように、再会を喜ぶ自然な語り口で始めてください。
+- **前回の脈あり度は「{prev_score}%」でした。この数値を絶対に創作せず、そのまま使用してください。**
+"""
+        comparison_instruction = f"""   **【前回との比較】**: 前回の鑑定では脈あり度が **{prev_score}%** でした。今回の結果と比較し、「前回の{prev_score}%から、今回は〇〇%へと変化しました」のように、数値を正確に使って必ず言及してください。"""
+        if new_message_count is not None:
+            prompt += f"""
+# 前回の鑑定からの変化
+- 前回の鑑定以降に増えたメッセージ: {new_message_count}件
+- 下の【直近の詳細な会話】は前回の鑑定以降の会話、【関係性の歴史】は前回の鑑定の直前の会話です。それより前の関係は、前回の鑑定サマリーを参考にしてください。
+- **前回の鑑定から「何が変わったか」「何が続いているか」を中心に**分析してください。
+"""
+    stats_section, stats_instruction = "", ""
+    if conversation_stats:
+        stats_label = "前回の鑑定以降の会話" if new_message_count is not None else "トーク履歴全体"
+        stats_section = f"""- 会話の数値データ（{stats_label}をプログラムで集計した正確な値）:
+{conversation_stats}
+"""
+        stats_instruction = """   **返信間隔・質問返し・絵文字や「!」の頻度・会話を始めた割合は、上の「会話の数値データ」を根拠に評価し、解説でもその数値を使ってください（数値を創作しないこと）。**
+"""
+    prompt += f"""
+# 基本データ分析
+- 会話の温度グラフの傾向: {trend}
+{stats_section}
+# ★★★ 変更点2: AIへの指示に「関係性の歴史」の項目を追加 ★★★
+- 【関係性の歴史（全期間のダイジェスト）】:
+{long_term_summary}
+
+- 【直近の詳細な会話（分析対象）】:
+{messages_summary}
+
+
+# AIによる深層分析依頼
+1. **感情の波の分析**: トーク履歴全体を通して、「ポジティブ」「ネガティブ」な感情表現は、それぞれどのような傾向で推移していますか？
+2. **脈ありシグナルのスコア化**: 以下の項目を0〜10点で評価し、総合的な「脈あり度」をパーセンテージで算出してください。 (質問返しの積極性, ポジティブな絵文字・表現の使用頻度, 返信間隔の安定性・速さ, 相手からの賞賛・共感の言葉, 会話を広げようとする意図)
+{stats_instruction}   **【絶対厳守】出力形式:** 以下の形式を絶対に守ってください。他の表現は一切使わず、数値は太字（**）にしないでください。
+   【総合脈あり度】: 80%
+   （上記の例のように、必ず「【総合脈あり度】: 数字%」の形式で出力してください）
+{comparison_instruction}
+   - なぜそのスコアになったのか、根拠を優しく解説してください。
+3. **相手の"隠れ心理"抽出**: 会話の中から、相手が特に「大切にしている価値観」や「本音だと感じられる発言」を3つ抜粋し、解説してください。
+4. **コミュニケーション相性診断**: 二人の言葉遣いや会話のテンポから、コミュニケーションのスタイルを分析し、「〇〇で繋がりを深めるタイプ」といった形で相性を診断してください。
+5. **「最高の瞬間」ハイライト**: このトーク履歴の中で、二人の心が最も通い合ったと感じられる瞬間を1つ選び出し、その時の会話の素晴らしい点を解説してください。
+6. **恋の未来予測**: これまでの会話データと心理分析に基づき、二人の関係性がポジティブに進展するための、心理学的な観点からの**優しい未来予測**を記述してください。
+7. **恋の処方箋・アクションチェックリスト**: 以下の4項目について、具体的かつ実践的なアドバイスを箇条書きで作成してください。(今日送ると効果的なメッセージ例:（★★1つにつき80文字以内で、最大3つ★★）, 相手のタイプ別・心に刺さるキーワード, 今は控えるべきNG行動, 次回鑑定のおすすめタイミング)
+
+# 最終出力
+上記の分析結果をすべて含め、以下の構成でレポートを作成してください。
+- 導入文, **恋の温度グラフの解説**, 総合脈あり度と、その理由, 恋の心理レポート, 「最高の瞬間」の振り返り, **恋の未来予測**, **恋の処方箋・アクションチェックリスト**, ユーザーへのケアメッセージ, 最後に、ユーザーを温かく励ます一言
+重要: 必ず日本語で、{your_name}さんに語りかけるような親しみやすい文体で書いてください。出力は最大8000文字以内に抑えてください。
+"""
+    return prompt
@@ -0,0 +1,97 @@
+"""
+Gemini での鑑定文の生成（ストリーミング / 一括）。
+
+モデルオブジェクト（genai.GenerativeModel）を受け取って生成するだけで、Streamlit には依存しません。
+どちらの関数も (全文, 最初のテキストが届くまでの秒数, 全体の秒数, レスポンス) を返します。
+ストリーミング中の途中経過は StreamedText で渡し、全文の文字列は読まれたときにだけ作ります。
+JSON出力モードでは json_generation_config() の設定を使い、プロンプトの末尾に JSON_OUTPUT_INSTRUCTION を付けます。
+"""
+import threading
+import time
+
+# 優先順位の高い順。先頭が使えないときの切り替え先にもなります
+MODEL_CANDIDATES = [
+    "models/gemini-2.5-flash",
+    "models/gemini-flash-latest",
+    "models/gemini-2.5-pro",
+    "models/gemini-pro-latest",
+    "models/gemini-2.0-flash-001"
+]
+SAFETY_SETTINGS = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
+GENERATION_CONFIG = {"max_output_tokens": 8192, "temperature": 0.75}
+
+# JSON出力モード: 脈あり度を型付きの項目で受け取る（report_parser.parse_report がそのまま読めます）
+REPORT_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "pulse_score": {"type": "integer", "description": "総合脈あり度（0〜100）"},
+        "summary": {"type": "string", "description": "鑑定結果の要約（150文字程度）"},
+        "report_markdown": {"type": "string", "description": "鑑定書の本文（マークダウン）"},
+    },
+    "required": ["pulse_score", "report_markdown"],
+}
+JSON_OUTPUT_INSTRUCTION = """
+# 出力形式（JSON）
+- 鑑定書の本文は、これまでの指示どおりのマークダウンで report_markdown に入れてください。
+- 総合脈あり度の数値（0〜100の整数）を pulse_score に、150文字程度の要約を summary に入れてください。
+"""
+
+
+def json_generation_config(generation_config):
+    """generation_config に JSON出力モード（response_mime_type / response_schema）を加えたものを返します。"""
+    return {**generation_config, "response_mime_type": "application/json", "response_schema": REPORT_RESPONSE_SCHEMA}
+
+
+class StreamedText:
+    """
+    ストリーミングで届いたここまでの全文。チャンクごとに全文をつなげ直すと長い鑑定で2乗の時間がかかるので、
+    チャンクは貯めておき、str() で読まれたときにだけつなげます（画面が読むのは一定間隔なので回数は少ない）。
+    len() はつなげずに返します。生成中のスレッドと画面のスレッドから同時に使えます。
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def append(self, text):
+        with self._lock:
+            self._parts.append(text)
+            self._length += len(text)
+
+    def __str__(self):
+        with self._lock:
+            if len(self._parts) > 1: self._parts[:] = ["".join(self._parts)]
+            return self._parts[0] if self._parts else ""
+
+    def __len__(self):
+        return self._length
+
+
+def generate_report_stream(model, prompt, generation_config, safety_settings, on_text=None):
+    """
+    stream=True で生成し、チャンクが届くたびに on_text(ここまでの全文の StreamedText) を呼びます。
+    戻り値は (全文, 最初のテキストが届くまでの秒数, 全体の秒数, レスポンス)。
+    """
+    started = time.perf_counter()
+    first_token_seconds, text = None, StreamedText()
+    response = model.generate_content(prompt, generation_config=generation_config, safety_settings=safety_settings, stream=True)
+    for chunk in response:
+        try: chunk_text = chunk.text
+        except Exception: continue  # ブロックされたチャンクなど、テキストを持たないもの
+        if not chunk_text: continue
+        if first_token_seconds is None: first_token_seconds = time.perf_counter() - started
+        text.append(chunk_text)
+        if on_text: on_text(text)
+    return str(text), first_token_seconds, time.perf_counter() - started, response
+
+
+def generate_report(model, prompt, generation_config, safety_settings, on_text=None):
+    """一括で生成します。全文が届くまで待つので、最初のテキストまでの秒数は全体の秒数と同じです。"""
+    started = time.perf_counter()
+    response = model.generate_content(prompt, generation_config=generation_config, safety_settings=safety_settings)
+    elapsed = time.perf_counter() - started
+    try: text = response.text
+    except Exception:
+        text = response.parts[0].text if hasattr(response, "parts") and response.parts else ""
+    return text, elapsed, elapsed, response
@@ -0,0 +1,141 @@
+"""
+AIの鑑定レポート（マークダウン）を構造化する処理。
+
+parse_report() がレポートを1回走査して、見出し・段落・太字・セクション・脈あり度・サマリーを
+まとめた ReportDocument を作ります。画面表示・履歴保存・PDF作成はすべてこの結果を使います。
+JSON出力モード（report_generation.REPORT_RESPONSE_SCHEMA）の応答もそのまま渡せます。
+Streamlit に依存しないので、バッチ処理やベンチマークからもそのまま使えます。
+"""
+import json
+import re
+
+# 脈あり度の書き方の候補（優先順）。書き出しの文字が互いに違うので、1回の走査でどれが当たったか区別できる
+PULSE_SCORE_PATTERNS = [
+    r'【総合脈あり度】\s*[:：]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])',
+    r'総合脈あり度\s*[:：]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])',
+    r'脈あり度[はが]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])',
+    r'(\d{1,3})\s*[%％パーセント](?:くらい|ほど|程度)?(?:の)?(?:脈あり|可能性)',
+    r'スコア[はが]?\s*(?:\*\*|約|およそ|大体)?\s*(\d{1,3})\s*(?:\*\*|[%％パーセント])',
+]
+# 先読みの中に入れて、重なり合う位置も含めてすべての書き出し位置を1回の finditer で調べる
+PULSE_SCORE_PATTERN = re.compile(
+    "(?=" + "|".join(pattern.replace("(\\d{1,3})", f"(?P<p{i}>\\d{{1,3}})", 1)
+                     for i, pattern in enumerate(PULSE_SCORE_PATTERNS)) + ")",
+    flags=re.DOTALL | re.IGNORECASE)
+BOLD_PATTERN = re.compile(r'\*\*(.*?)\*\*')
+HEADING_PATTERN = re.compile(r'^(#{1,6})\s*(.*)$')
+SUMMARY_KEYWORDS = ('脈あり度', '総合')
+SUMMARY_MIN_LINE_CHARS = 15
+SUMMARY_TARGET_CHARS = 150
+SUMMARY_MAX_CHARS = 200
+
+
+class ReportDocument:
+    """
+    構造化した鑑定レポート。
+    - text: 元のマークダウン（画面にはこれをそのまま表示）
+    - blocks: ("heading", レベル, spans) / ("paragraph", 0, spans) / ("blank", 0, []) のリスト。spans は (文字列, 太字か)
+    - sections: 見出しごとの {"heading", "level", "body"}。最初の見出しより前の部分は heading が None
+    - pulse_score: 脈あり度（0〜100）。読み取れなければ None
+    - summary: 履歴に保存する短いサマリー
+    """
+
+    def __init__(self, text, blocks, sections, pulse_score, summary):
+        self.text = text
+        self.blocks = blocks
+        self.sections = sections
+        self.pulse_score = pulse_score
+        self.summary = summary
+
+    @property
+    def headings(self):
+        return [section["heading"] for section in self.sections if section["heading"] is not None]
+
+
+def _split_bold(line):
+    """1行を (文字列, 太字か) の並びに分けます。"""
+    spans, position = [], 0
+    for match in BOLD_PATTERN.finditer(line):
+        if match.start() > position: spans.append((line[position:match.start()], False))
+        if match.group(1): spans.append((match.group(1), True))
+        position = match.end()
+    if position < len(line): spans.append((line[position:], False))
+    return spans
+
+
+def _find_pulse_score(text):
+    """候補の書き方を優先順に見て、それぞれ最初に現れた箇所の数値が 0〜100 なら採用します。"""
+    first_hits = {}
+    for match in PULSE_SCORE_PATTERN.finditer(text):
+        index = int(match.lastgroup[1:])
+        first_hits.setdefault(index, int(match.group(match.lastgroup)))
+        if 0 <= first_hits.get(0, -1) <= 100: break  # 最優先の書き方で決まれば、それより後ろは見なくてよい
+    for index in sorted(first_hits):
+        if 0 <= first_hits[index] <= 100: return first_hits[index]
+    return None
+
+
+def _build_summary(text, keyword_line, long_lines):
+    parts = [keyword_line] if keyword_line is not None else []
+    for line in long_lines:
+        parts.append(line)
+        if len(" ".join(parts)) > SUMMARY_TARGET_CHARS: break
+    summary = " ".join(parts)
+    if not summary: return text[:SUMMARY_TARGET_CHARS] + '...'
+    return summary[:SUMMARY_MAX_CHARS] + '...' if len(summary) > SUMMARY_MAX_CHARS else summary
+
+
+def parse_report(text, pulse_score=None):
+    """
+    マークダウンのレポートを1回の走査で ReportDocument にします。
+    JSON出力モードの応答（{"report_markdown": ..., "pulse_score": ..., "summary": ...}）なら中身を取り出し、
+    型付きの脈あり度と、AIが書いた要約を優先します（本文からの抜き出しは、無いときだけ）。
+    """
+    text, pulse_score, summary = _unwrap_json_report(text, pulse_score)
+    blocks, sections = [], [{"heading": None, "level": 0, "body": []}]
+    keyword_line, long_lines, long_chars = None, [], 0
+    for raw_line in text.split('\n'):
+        line = raw_line.strip()
+        if not line:
+            blocks.append(("blank", 0, []))
+            continue
+        if keyword_line is None and any(keyword in line for keyword in SUMMARY_KEYWORDS): keyword_line = line
+        heading = HEADING_PATTERN.match(line) if line.startswith('#') else None
+        if heading:
+            level, title = len(heading.group(1)), heading.group(2).strip()
+            blocks.append(("heading", level, _split_bold(title)))
+            sections.append({"heading": BOLD_PATTERN.sub(r'\1', title), "level": level, "body": []})
+            continue
+        blocks.append(("paragraph", 0, _split_bold(line)))
+        sections[-1]["body"].append(line)
+        if len(line) > SUMMARY_MIN_LINE_CHARS and long_chars <= SUMMARY_TARGET_CHARS:
+            long_lines.append(line)
+            long_chars += len(line) + 1
+    for section in sections: section["body"] = "\n".join(section["body"])
+    if not sections[0]["body"]: sections.pop(0)
+    if pulse_score is None: pulse_score = _find_pulse_score(text)
+    if summary is None: summary = _build_summary(text, keyword_line, long_lines)
+    return ReportDocument(text, blocks, sections, pulse_score, summary)
+
+
+def _unwrap_json_report(text, pulse_score):
+    """(本文, 脈あり度, 要約) を返します。JSON出力モードの応答でなければ本文はそのままで、要約は None。"""
+    if not text.lstrip().startswith('{'): return text, pulse_score, None
+    try: payload = json.loads(text)
+    except ValueError: return text, pulse_score, None
+    if not isinstance(payload, dict) or not isinstance(payload.get("report_markdown"), str): return text, pulse_score, None
+    score = payload.get("pulse_score")
+    if pulse_score is None and isinstance(score, int) and 0 <= score <= 100: pulse_score = score
+    summary = payload.get("summary")
+    summary = " ".join(summary.split()) if isinstance(summary, str) else ""
+    if len(summary) > SUMMARY_MAX_CHARS: summary = summary[:SUMMARY_MAX_CHARS] + '...'
+    return payload["report_markdown"], pulse_score, summary or None
+
+
+def parse_pulse_score(ai_response):
+    """AIの応答から脈あり度（0〜100）を読み取ります。見つからなければ None。"""
+    return parse_report(ai_response).pulse_score
+
+
+def extract_summary_from_response(ai_response):
+    return parse_report(ai_response).summary
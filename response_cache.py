@@ -0,0 +1,87 @@
+"""
+AIの鑑定結果のディスクキャッシュ（SQLite）。
+
+キーは (プロンプト, モデル名, generation_config, safety_settings) のハッシュです。
+エントリごとに有効期限（TTL）があり、合計サイズが上限を超えたら
+最後に使われたのが古いものから削除します（LRU）。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+DB_FILE_NAME = "response_cache.sqlite3"
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+LOCK_TIMEOUT_SECONDS = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    cache_key TEXT PRIMARY KEY,
+    model_name TEXT NOT NULL,
+    response_text TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access);
+"""
+
+
+def make_cache_key(prompt, model_name, generation_config, safety_settings):
+    """生成条件をまとめてハッシュにします。辞書のキー順には左右されません。"""
+    payload = json.dumps([prompt, model_name, generation_config, safety_settings],
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """get / put だけのシンプルなキャッシュ。接続は操作ごとに開くのでスレッドをまたいで使えます。"""
+
+    def __init__(self, data_dir, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.db_path = os.path.join(data_dir, DB_FILE_NAME)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        os.makedirs(data_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def get(self, cache_key):
+        """有効なエントリがあれば本文を返し、最終利用時刻を更新します。無ければ None。"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response_text, expires_at FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row is None: return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+        return row[0]
+
+    def put(self, cache_key, model_name, response_text, ttl_seconds=None):
+        """保存（同じキーは上書き）したあと、期限切れと容量超過のエントリを削除します。"""
+        now = time.time()
+        size = len(response_text.encode('utf-8'))
+        expires_at = now + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (cache_key, model_name, response_text, size, created_at, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", (cache_key, model_name, response_text, size, now, expires_at, now))
+            conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                for key, entry_size in conn.execute("SELECT cache_key, size FROM responses ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes: break
+                    conn.execute("DELETE FROM responses WHERE cache_key = ?", (key,))
+                    total -= entry_size
+            conn.execute("COMMIT")
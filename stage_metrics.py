@@ -0,0 +1,125 @@
+"""
+処理段階（デコード・解析・グラフ描画・プロンプト作成・生成・PDF作成など）ごとの所要時間の記録。
+
+span() で囲んだ区間の時間を JSONL のメトリクスログに1行ずつ追記し、
+段階ごとに直近 window 件を保持して p50 / p95 / p99 を計算します。
+prometheus_path を指定すると、記録のたびに Prometheus のテキスト形式でも書き出します
+（node_exporter の textfile collector などで読み込む想定）。Streamlit には依存しません。
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+METRICS_FILE_NAME = "metrics.jsonl"
+PROMETHEUS_ENV_VAR = "KOI_ORACLE_PROMETHEUS_FILE"
+DEFAULT_WINDOW = 500  # 段階ごとにパーセンタイル計算に使う直近の件数
+DEFAULT_MAX_LOG_BYTES = 5 * 1024 * 1024  # これを超えたらログを .1 に回して新しく始める
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(sorted_values, q):
+    """昇順に並んだ値の q 分位点（最近接順位法）。"""
+    if not sorted_values: return None
+    return sorted_values[max(1, math.ceil(len(sorted_values) * q)) - 1]
+
+
+class StageMetrics:
+    """段階ごとの所要時間を記録します。全セッション・全スレッドで1つを共有する想定です。"""
+
+    def __init__(self, log_path=None, window=DEFAULT_WINDOW, prometheus_path=None, max_log_bytes=DEFAULT_MAX_LOG_BYTES):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.max_log_bytes = max_log_bytes
+        self.window = window
+        self._lock = threading.Lock()
+        self._recent = defaultdict(lambda: deque(maxlen=window))
+        self._totals = defaultdict(lambda: {"count": 0, "sum": 0.0, "errors": 0})
+        if log_path: self._load_recent()
+
+    def _load_recent(self):
+        """再起動しても直近の分布が見えるように、既存のログから読み戻します。"""
+        try:
+            with open(self.log_path, encoding="utf-8") as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    if entry.get("status") == "ok": self._recent[entry["stage"]].append(entry["seconds"])
+        except OSError:
+            pass
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """with の中の処理時間を stage として記録します。例外は記録したうえでそのまま投げ直します。"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(stage, time.perf_counter() - started, status="error", **labels)
+            raise
+        self.record(stage, time.perf_counter() - started, **labels)
+
+    def record(self, stage, seconds, status="ok", **labels):
+        entry = {"ts": time.time(), "stage": stage, "seconds": round(seconds, 6), "status": status}
+        if labels: entry["labels"] = labels
+        with self._lock:
+            totals = self._totals[stage]
+            totals["count"] += 1
+            totals["sum"] += seconds
+            if status == "ok": self._recent[stage].append(seconds)
+            else: totals["errors"] += 1
+            if self.log_path: self._append_log(entry)
+            if self.prometheus_path: self._write_prometheus()
+
+    def _append_log(self, entry):
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.max_log_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError:
+            pass  # 計測の失敗で本来の処理を止めない
+
+    def summary(self):
+        """段階ごとの {count, errors, p50, p95, p99}（秒）を返します。count はプロセス起動後の件数です。"""
+        with self._lock:
+            stages = {stage: sorted(values) for stage, values in self._recent.items()}
+            totals = {stage: dict(values) for stage, values in self._totals.items()}
+        result = {}
+        for stage, values in sorted(stages.items()):
+            row = {"count": totals.get(stage, {}).get("count", 0), "errors": totals.get(stage, {}).get("errors", 0),
+                   "window": len(values)}
+            for q in QUANTILES: row[f"p{int(q * 100)}"] = percentile(values, q)
+            result[stage] = row
+        return result
+
+    def prometheus_text(self):
+        """Prometheus のテキスト形式（summary 型）で返します。"""
+        with self._lock: return self._prometheus_text()
+
+    def _prometheus_text(self):
+        lines = ["# HELP koi_oracle_stage_seconds Time spent in each diagnosis stage.",
+                 "# TYPE koi_oracle_stage_seconds summary"]
+        for stage in sorted(self._totals):
+            values = sorted(self._recent[stage])
+            for q in QUANTILES:
+                value = percentile(values, q)
+                if value is not None: lines.append(f'koi_oracle_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'koi_oracle_stage_seconds_sum{{stage="{stage}"}} {self._totals[stage]["sum"]:.6f}')
+            lines.append(f'koi_oracle_stage_seconds_count{{stage="{stage}"}} {self._totals[stage]["count"]}')
+        lines += ["# HELP koi_oracle_stage_errors_total Spans that ended with an exception.",
+                  "# TYPE koi_oracle_stage_errors_total counter"]
+        for stage in sorted(self._totals):
+            lines.append(f'koi_oracle_stage_errors_total{{stage="{stage}"}} {self._totals[stage]["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    def _write_prometheus(self):
+        tmp_path = self.prometheus_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(self._prometheus_text())
+            os.replace(tmp_path, self.prometheus_path)  # 読み込み側に書きかけのファイルを見せない
+        except OSError:
+            pass
@@ -0,0 +1,168 @@
+"""
+大きなトーク履歴の一時ファイル置き場と、プロセスのメモリの目安。
+
+数MBのトーク履歴をセッションごとにメモリに持ち続けると、同時に使う人が増えたときにプロセスが
+メモリ不足で落ちます。一定より大きいアップロードはセッションごとの一時ファイルに書き出し
+（内容ハッシュも書き出しながら計算）、セッションには SpooledTalk（ファイルの場所だけ）を持たせます。
+解析のときは talk_bytes() で mmap して読むので、元のバイト列はメモリに載せ続けません。
+しばらく使われていないセッションの一時ファイルは削除します。Streamlit には依存しません。
+"""
+import atexit
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+SPOOL_THRESHOLD_BYTES = 512 * 1024  # これより大きいアップロードは一時ファイルに書き出す
+COPY_CHUNK_BYTES = 1024 * 1024
+DEFAULT_IDLE_SECONDS = 1800  # この秒数使われなかったセッションの一時ファイルは削除
+MEMORY_BUDGET_ENV_VAR = "KOI_ORACLE_MEMORY_BUDGET_MB"
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+class SpooledTalk:
+    """一時ファイルに書き出したトーク履歴。中身は talk_bytes() で読みます。ファイルが削除されていたら FileNotFoundError。"""
+
+    def __init__(self, path, size, talk_hash):
+        self.path = path
+        self.size = size
+        self.talk_hash = talk_hash
+
+    def __len__(self):
+        return self.size
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+@contextmanager
+def talk_bytes(talk_data):
+    """
+    トーク履歴をバイト列として読める形で渡します。SpooledTalk なら読み取り専用の mmap の memoryview、
+    それ以外（bytes / str）はそのまま渡します。with を抜けたあとは使わないでください。
+    """
+    if not isinstance(talk_data, SpooledTalk):
+        yield talk_data
+        return
+    with open(talk_data.path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        try:
+            view.release()
+            mapped.close()
+        except BufferError: pass  # 切り出した memoryview がまだ残っていれば、それが消えたときに閉じられる
+
+
+class TalkSpool:
+    """
+    セッションごとの一時ファイルと、最後に使われた時刻を管理します。1セッションにつき1ファイルです。
+    store で書き出したファイルは、keep でセッションのものにしたときに前のファイルと入れ替わり、
+    使わないときは discard で削除します（読み込みに失敗しても前のトーク履歴は残ります）。
+    全セッションで1つを共有する想定です。
+    """
+
+    def __init__(self, spool_dir=None, idle_seconds=DEFAULT_IDLE_SECONDS, threshold_bytes=SPOOL_THRESHOLD_BYTES):
+        self.spool_dir = spool_dir or tempfile.mkdtemp(prefix="koi-oracle-spool-")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.idle_seconds = idle_seconds
+        self.threshold_bytes = threshold_bytes
+        self._lock = threading.Lock()
+        self._sessions = {}  # session_key -> [SpooledTalk, 最後に使われた時刻]
+        self.evicted = 0
+        atexit.register(self.close)
+
+    def store(self, fileobj):
+        """
+        アップロードされたファイルを読み、(トーク履歴, 内容ハッシュ) を返します。
+        threshold_bytes 以下ならそのまま bytes で、それより大きければ一時ファイルに書き出して SpooledTalk で返します。
+        この時点ではどのセッションのものでもないので、keep か discard のどちらかを必ず呼んでください。
+        """
+        fileobj.seek(0)
+        head = fileobj.read(self.threshold_bytes + 1)
+        if len(head) <= self.threshold_bytes: return head, hashlib.sha256(head).hexdigest()
+        digest, size = hashlib.sha256(), 0
+        fd, path = tempfile.mkstemp(suffix=".txt", dir=self.spool_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                chunk = head
+                while chunk:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                    chunk = fileobj.read(COPY_CHUNK_BYTES)
+        except BaseException:
+            _remove(path)
+            raise
+        talk = SpooledTalk(path, size, digest.hexdigest())
+        return talk, talk.talk_hash
+
+    def keep(self, session_key, talk_data):
+        """store で読んだトーク履歴をセッションのものにし、セッションの前の一時ファイルを削除します。"""
+        if not isinstance(talk_data, SpooledTalk):
+            self.release(session_key)  # 小さいトーク履歴はメモリに持つので、前の一時ファイルは要らない
+            return
+        with self._lock:
+            previous = self._sessions.get(session_key)
+            self._sessions[session_key] = [talk_data, time.time()]
+        if previous is not None and previous[0].path != talk_data.path: _remove(previous[0].path)
+
+    def discard(self, talk_data):
+        """store で読んだが使わなかったトーク履歴の一時ファイルを削除します（セッションの今のファイルはそのまま）。"""
+        if isinstance(talk_data, SpooledTalk): _remove(talk_data.path)
+
+    def touch(self, session_key):
+        """セッションが使われたことを記録し、しばらく使われていないセッションの一時ファイルを削除します。"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_key)
+            if entry is not None: entry[1] = now
+            idle = [key for key, (_, last_used) in self._sessions.items() if now - last_used > self.idle_seconds]
+            expired = [self._sessions.pop(key)[0] for key in idle]
+            self.evicted += len(expired)
+        for talk in expired: _remove(talk.path)
+
+    def release(self, session_key):
+        """セッションの一時ファイルを削除します（別のトーク履歴を読み込んだときなど）。"""
+        with self._lock: entry = self._sessions.pop(session_key, None)
+        if entry is not None: _remove(entry[0].path)
+
+    def stats(self):
+        """管理画面向けに {sessions, bytes, evicted} を返します。"""
+        with self._lock:
+            return {"sessions": len(self._sessions), "bytes": sum(talk.size for talk, _ in self._sessions.values()),
+                    "evicted": self.evicted}
+
+    def close(self):
+        with self._lock: self._sessions.clear()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def _remove(path):
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+
+def memory_budget_bytes():
+    """プロセスのメモリの目安（環境変数 KOI_ORACLE_MEMORY_BUDGET_MB、既定は 1024MB）をバイトで返します。"""
+    try: budget_mb = float(os.environ.get(MEMORY_BUDGET_ENV_VAR, DEFAULT_MEMORY_BUDGET_MB))
+    except ValueError: budget_mb = DEFAULT_MEMORY_BUDGET_MB
+    return int(budget_mb * 1024 * 1024)
+
+
+def process_rss_bytes():
+    """このプロセスの現在の使用メモリ（RSS）を返します。Linux 以外ではピーク値、取れなければ None。"""
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError): pass
+    try: import resource
+    except ImportError: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
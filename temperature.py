@@ -0,0 +1,124 @@
+"""
+会話の「温度」集計エンジン（NumPyでまとめて計算）。
+
+MessageStore の配列をそのまま使い、日別・週別・時間帯別のスコアと
+送信者ごとの内訳、移動平均による傾向をメッセージ数に比例した時間で求めます。
+"""
+import re
+from datetime import datetime, timezone
+
+import numpy as np
+
+from line_chat import NO_TIMESTAMP
+
+SECONDS_PER_DAY = 86400
+ROLLING_WINDOW = 3
+EMPHASIS_PATTERN = re.compile('[!？]')  # 「!」「？」は1つにつき2点加算
+EMPHASIS_WEIGHT = 2
+
+
+def message_scores(messages, start=0):
+    """
+    各メッセージの温度スコア（文字数 + 「!」「？」の数×2）を配列で返します。
+    start を指定すると messages[start:] の分だけを数えます（前回のスナップショットの続きを足すとき用）。
+    """
+    offsets = np.frombuffer(messages.offsets, dtype=np.uint64)[start:].astype(np.int64)
+    scores = np.diff(offsets)
+    positions = np.fromiter((m.start() for m in EMPHASIS_PATTERN.finditer(messages.text, int(offsets[0]))), dtype=np.int64)
+    if positions.size:
+        owners = np.searchsorted(offsets, positions, side='right') - 1
+        scores += np.bincount(owners, minlength=scores.size)[:scores.size] * EMPHASIS_WEIGHT
+    return scores
+
+
+def _day_label(day, fmt):
+    return datetime.fromtimestamp(int(day) * SECONDS_PER_DAY, timezone.utc).strftime(fmt)
+
+
+def _bucket(keys, scores, sender_ids, senders):
+    """keys ごとにスコアを合計し、(昇順のキー, 合計, 送信者別の合計) を返します。"""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inverse, weights=scores, minlength=unique_keys.size)
+    n_senders = max(len(senders), 1)
+    split = np.bincount(inverse * n_senders + sender_ids, weights=scores, minlength=unique_keys.size * n_senders)
+    split = split.reshape(unique_keys.size, n_senders)
+    by_sender = {name: split[:, i].astype(np.int64).tolist() for i, name in enumerate(senders)}
+    return unique_keys, totals.astype(np.int64), by_sender
+
+
+def rolling_average(values, window=ROLLING_WINDOW):
+    """単純移動平均（先頭の window-1 件は取れる分だけで平均）を返します。"""
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0: return []
+    cumsum = np.cumsum(np.insert(values, 0, 0.0))
+    counts = np.minimum(np.arange(1, values.size + 1), window)
+    starts = np.arange(1, values.size + 1) - counts
+    return ((cumsum[1:] - cumsum[starts]) / counts).round(1).tolist()
+
+
+def judge_trend(values, window=ROLLING_WINDOW):
+    """直近 window 件の移動平均と、それ以前の平均を比べて傾向を判定します。"""
+    trend = "安定"
+    if len(values) >= window + 1:
+        last_avg = float(np.mean(values[-window:]))
+        prev_avg = float(np.mean(values[:-window]))
+        if prev_avg > 0 and last_avg > prev_avg * 1.2: trend = "上昇傾向"
+        elif prev_avg > 0 and last_avg < prev_avg * 0.8: trend = "下降傾向"
+    return trend
+
+
+def compute_temperature_profile(messages, scores=None):
+    """
+    日別・週別（月曜始まり）・時間帯別の温度を送信者別の内訳つきで返します。
+    日時が分からないメッセージは集計しません。データが無ければ None を返します。
+    scores に計算済みの message_scores() を渡すと、数え直さずにそれを使います。
+    """
+    timestamps = np.frombuffer(messages.timestamps, dtype=np.int64)
+    valid = timestamps != NO_TIMESTAMP
+    if not valid.any(): return None
+    scores = (message_scores(messages) if scores is None else np.asarray(scores, dtype=np.int64))[valid]
+    timestamps = timestamps[valid]
+    sender_ids = np.frombuffer(messages.sender_ids, dtype=np.uint32)[valid].astype(np.int64)
+    senders = messages.senders
+
+    days = timestamps // SECONDS_PER_DAY
+    day_keys, day_values, day_by_sender = _bucket(days, scores, sender_ids, senders)
+    # 年をまたぐ履歴は年も表示し、同じ月日の別の年が混ざらないようにする
+    multi_year = _day_label(day_keys[0], '%Y') != _day_label(day_keys[-1], '%Y')
+    day_fmt = '%Y/%m/%d' if multi_year else '%m/%d'
+
+    weeks = (days + 3) // 7  # 1970/01/01 は木曜日なので、+3 で月曜始まりにそろえる
+    week_keys, week_values, week_by_sender = _bucket(weeks, scores, sender_ids, senders)
+
+    hours = (timestamps % SECONDS_PER_DAY) // 3600
+    hourly = np.bincount(hours, weights=scores, minlength=24).astype(np.int64)
+    hour_split = np.bincount(hours * max(len(senders), 1) + sender_ids, weights=scores, minlength=24 * max(len(senders), 1))
+    hour_split = hour_split.reshape(24, max(len(senders), 1)).astype(np.int64)
+
+    daily_values = day_values.tolist()
+    return {
+        'daily': {
+            'labels': [_day_label(d, day_fmt) for d in day_keys],
+            'values': daily_values,
+            'by_sender': day_by_sender,
+            'rolling': rolling_average(daily_values),
+        },
+        'weekly': {
+            'labels': [_day_label(w * 7 - 3, '%Y/%m/%d') for w in week_keys],
+            'values': week_values.tolist(),
+            'by_sender': week_by_sender,
+        },
+        'hourly': {
+            'labels': [f"{h}時" for h in range(24)],
+            'values': hourly.tolist(),
+            'by_sender': {name: hour_split[:, i].tolist() for i, name in enumerate(senders)},
+        },
+        'trend': judge_trend(daily_values),
+    }
+
+
+def calculate_temperature(messages):
+    """日別の温度 {'labels', 'values'} と傾向を返します（従来の呼び出し口）。"""
+    profile = compute_temperature_profile(messages)
+    if profile is None: return {}, "データ不足"
+    return {'labels': profile['daily']['labels'], 'values': profile['daily']['values']}, profile['trend']